@@ -0,0 +1,82 @@
+"""Defines the lease table, which keeps track of the tasks currently allocated to the nodes"""
+
+import heapq
+import itertools
+
+
+class TableBaux():
+    """The tasks currently held by at least one node, ordered by their last allocation date.
+
+    It is a heap with lazy deletion: an entry is only discarded when it reaches the top of the
+    heap. Each task carries:
+        -> bail_actif: whether the task is in the table
+        -> version_bail: incremented each time the task is (re)inserted or removed, so that
+                         only its latest entry is considered valid
+        -> date_derniere_allocation and norealloc (see tacheCalcul)
+    """
+
+    def __init__(self):
+        self.tas = []
+        self.nb_baux = 0
+        self.compteur = itertools.count()   # breaks ties, so that tasks are never compared
+
+    def __len__(self):
+        return self.nb_baux
+
+    def ajouter(self, tache) -> None:
+        """Adds the task to the table, or moves it if it was already there (for instance
+        because its last allocation date changed)
+
+        Params:
+            tache: the task
+        """
+
+        if not tache.bail_actif:
+            tache.bail_actif = True
+            self.nb_baux += 1
+        tache.version_bail += 1
+        heapq.heappush(self.tas, (tache.date_derniere_allocation, next(self.compteur),
+                                  tache.version_bail, tache))
+
+        # stale entries are only removed when they reach the top of the heap: we don't want
+        # them to pile up if the oldest task stays around for long
+        if len(self.tas) > 2 * self.nb_baux + 64:
+            self.compacter()
+
+    def retirer(self, tache) -> None:
+        """Removes the task from the table (its entry becomes stale)
+
+        Params:
+            tache: the task
+        """
+
+        if tache.bail_actif:
+            tache.bail_actif = False
+            tache.version_bail += 1
+            self.nb_baux -= 1
+
+    def plus_ancienne(self):
+        """Returns the task that was allocated the longest time ago and that may be
+        reallocated (ie its norealloc flag isn't set), or None if there is none.
+        The task is NOT removed from the table."""
+
+        while len(self.tas) > 0:
+            tache = self.tas[0][3]
+            if self._valide(self.tas[0]) and not tache.norealloc:
+                return tache
+            heapq.heappop(self.tas)
+        return None
+
+    def taches(self) -> list:
+        """Returns the tasks in the table"""
+        return [e[3] for e in self.tas if self._valide(e)]
+
+    def compacter(self) -> None:
+        """Rebuilds the heap with the valid entries only"""
+        self.tas = [e for e in self.tas if self._valide(e)]
+        heapq.heapify(self.tas)
+
+    @staticmethod
+    def _valide(entree) -> bool:
+        tache = entree[3]
+        return tache.bail_actif and entree[2] == tache.version_bail
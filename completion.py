@@ -0,0 +1,145 @@
+"""Defines the completion bitmap, which remembers the points of the grid being enumerated
+that were already computed, so that the producer doesn't have to ask the database"""
+
+from typing import Dict, Iterable, Tuple
+
+import threading
+
+from compteur import Compteur
+from vartypes import csc_var
+
+
+class CarteCompletion():
+    """A bitmap indexed by the position of the points in the grid of the current scheme (the
+    mixed-radix index of the sequencer, the first variable being the fastest one).
+
+    It is rebuilt each time the sequencer is reloaded, filled from the records already in the
+    database, then kept up to date as the results are submitted. A point that can't be found
+    in the grid gets None as an answer: the caller should then ask the database.
+
+    The index of a value on an axis is found in a dictionnary built from the range, or computed
+    by the counter if the axis is a lazy one (see compteur.py)."""
+
+    def __init__(self, taille_max: int = 2**31):
+        """Initializes an empty bitmap
+
+        Params:
+            taille_max: the maximum number of points of a grid; above, the bitmap is disabled
+                        (it would take taille_max/8 bytes)
+        """
+
+        self.taille_max = taille_max
+        self.verrou = threading.Lock()
+        # for each variable: (name, type, function returning the index of a value on the axis,
+        # step)
+        self.axes = []
+        self.bits = None    # None when the bitmap is disabled
+        self.nb_points = 0
+        self.nb_marques = 0
+
+    def charger(self, sequenceur) -> Dict[str, Tuple[float, float]]:
+        """Rebuilds an empty bitmap for the grid of the sequencer
+
+        Params:
+            sequenceur: the sequencer, freshly (re)loaded
+
+        Returns:
+            dict: the limits of the grid for each variable, {'<var name>': (min, max)}, to look
+                  for the records already computed; None if the bitmap is disabled
+        """
+
+        axes = []
+        bornes = {}
+        pas = 1
+        for nom, vartype, params, plage, valeur in sequenceur.espace_variables:
+            if isinstance(plage, Compteur):
+                # the counters are monotonic: the bounds are their first and last values
+                extremes = [vartype(plage[0]).value, vartype(plage[-1]).value] \
+                    if len(plage) > 0 else [0]
+                axes.append((nom, vartype, self._indice_compteur(plage, vartype), pas))
+                bornes[nom] = (min(extremes), max(extremes))
+                pas *= len(plage)
+                continue
+
+            # the values are compared once casted, as they are sent and stored
+            valeurs = [vartype(v).value for v in plage]
+            correspondance = {}
+            for i, v in enumerate(valeurs):
+                # a value can appear twice once casted (eg an integer on a fine linspace):
+                # both points are the same
+                correspondance.setdefault(v, i)
+            axes.append((nom, vartype, correspondance.get, pas))
+            bornes[nom] = (min(valeurs), max(valeurs)) if len(valeurs) > 0 else (0, 0)
+            pas *= len(valeurs)
+
+        with self.verrou:
+            self.axes = axes
+            self.nb_points = pas if len(axes) > 0 else 0
+            self.nb_marques = 0
+            if 0 < self.nb_points <= self.taille_max:
+                self.bits = bytearray((self.nb_points + 7) // 8)
+            else:
+                self.bits = None
+
+        return bornes if self.bits is not None else None
+
+    def indice(self, valeurs: Dict[str, csc_var]) -> int:
+        """Returns the index of the point in the grid, or None if it isn't part of it
+
+        Params:
+            valeurs: the point, either as cascada types or as raw values (eg from the database)
+        """
+
+        indice = 0
+        for nom, vartype, correspondance, pas in self.axes:
+            v = valeurs.get(nom)
+            if v is None:
+                return None
+            i = correspondance(v.value if isinstance(v, csc_var) else vartype(v).value)
+            if i is None:
+                return None
+            indice += i * pas
+        return indice
+
+    @staticmethod
+    def _indice_compteur(compteur: Compteur, vartype):
+        """Returns the function finding the index of a (casted) value on the axis of the
+        counter"""
+
+        def caster(v):
+            return vartype(v).value
+
+        def indice(valeur):
+            return compteur.indice(valeur, caster)
+        return indice
+
+    def marquer(self, valeurs: Dict[str, csc_var]) -> None:
+        """Records that the point was computed (nothing happens if it isn't in the grid)"""
+        with self.verrou:
+            if self.bits is None:
+                return
+            i = self.indice(valeurs)
+            if i is not None and not self.bits[i >> 3] & (1 << (i & 7)):
+                self.bits[i >> 3] |= 1 << (i & 7)
+                self.nb_marques += 1
+
+    def marquer_tous(self, enregistrements: Iterable[Dict]) -> None:
+        """Records that each of the points was computed"""
+        for e in enregistrements:
+            self.marquer(e)
+
+    def contient(self, valeurs: Dict[str, csc_var]) -> bool:
+        """Checks whether the point was computed
+
+        Returns:
+            bool: True or False, or None if the point isn't in the grid (or if the bitmap is
+                  disabled), in which case the database should be checked
+        """
+
+        with self.verrou:
+            if self.bits is None:
+                return None
+            i = self.indice(valeurs)
+            if i is None:
+                return None
+            return bool(self.bits[i >> 3] & (1 << (i & 7)))
@@ -1,25 +1,110 @@
-"""Defines a counter used to sweep the domain defined in the scheme"""
+"""Defines the counters used to sweep the domain defined in the scheme.
 
-from typing import Tuple
+A counter computes the value at any index arithmetically, instead of holding the whole range in
+memory: an axis of 10^8 points takes as little memory as an axis of 10. The counter classes can
+be given to the sequencer in place of numpy.linspace, eg {"X": (0, 1, 10**8, CompteurRange)}"""
+
+from typing import Tuple, Union
 
 import math
-from Numbers import Number
+from numbers import Number
+
+import numpy as np
+
+
+class CompteurError(Exception):
+    """Counter error"""
+    pass
 
 
 class Compteur():
     """Defines a counter used to sweep the domain defined in the scheme
-    A counter has to implement two functions
-            -> incremente: returns the current value then increment
+
+    A counter behaves like a read-only array of nb values: it supports len() and indexing by an
+    integer, a slice or an array of integers (the last two returning a NumPy array). A counter
+    has to implement two functions
             -> setup: prepares the counter
+            -> valeurs: computes the values at an array of indexes
+    and may implement a third one, used to find the index of a value
+            -> indice_approche: the (real) index at which the counter would take a value
     """
 
     def __init__(self, debut: Number, fin: Number, nb: int, **kwargs):
+        if nb is None or nb < 0:
+            raise CompteurError
         self.debut = debut
         self.fin = fin
-        self.nb = nb
+        self.nb = int(nb)
         self.args = kwargs
+        self.i = 0      # index read by incremente()
         self.setup()
 
+    def setup(self):
+        """Setups the counter"""
+        pass
+
+    def valeurs(self, indices: np.ndarray) -> np.ndarray:
+        """Computes the values of the counter at indices
+
+        Params:
+            indices: an array of indexes, all in [0, nb)
+
+        Returns:
+            numpy.ndarray: the values, as float64
+        """
+
+        raise NotImplementedError
+
+    def indice_approche(self, valeur: Number) -> float:
+        """Returns the (real) index at which the counter would take the value, or None if it
+        can't be computed"""
+        return None
+
+    def __len__(self) -> int:
+        return self.nb
+
+    def __getitem__(self, cle: Union[int, slice, np.ndarray]) -> Union[float, np.ndarray]:
+        if isinstance(cle, slice):
+            return self.valeurs(np.arange(*cle.indices(self.nb), dtype=np.int64))
+        if isinstance(cle, (int, np.integer)):
+            if cle < 0:
+                cle += self.nb
+            if not 0 <= cle < self.nb:
+                raise IndexError("Index {} out of the counter (0 to {})".format(cle, self.nb - 1))
+            return self.valeurs(np.array([cle], dtype=np.int64))[0].item()
+
+        indices = np.asarray(cle, dtype=np.int64)
+        if indices.size > 0 and (indices.min() < 0 or indices.max() >= self.nb):
+            raise IndexError("Index out of the counter (0 to {})".format(self.nb - 1))
+        return self.valeurs(indices)
+
+    def __iter__(self):
+        for i in range(self.nb):
+            yield self[i]
+
+    def indice(self, valeur: Number, caster=float) -> int:
+        """Finds an index at which the counter takes the value, once casted
+
+        Params:
+            valeur: the value
+            caster: (optionnal) the function casting the values of the counter before they
+                    are compared to valeur (eg lambda v: csc_uint8(v).value)
+
+        Returns:
+            int: the index, or None if the value isn't taken by the counter
+        """
+
+        approche = self.indice_approche(valeur)
+        if approche is None or not math.isfinite(approche):
+            return None
+        # the casting (eg to an integer or to a float32) moves the values a bit: the value can
+        # be taken by the neighbors of the closest index
+        centre = int(round(approche))
+        for i in (centre, centre - 1, centre + 1):
+            if 0 <= i < self.nb and caster(self[i]) == valeur:
+                return i
+        return None
+
     def incremente(self) -> Tuple[Number, bool]:
         """The incremente function reads the counter current value and increments it
 
@@ -28,73 +113,61 @@ class Compteur():
                 bool:   True if there are remaining values to be read, False if not
         """
 
-        return None, True
-
-    def setup(self):
-        """Setups the counter"""
-        pass
-
-
-class CompteurError(Exception):
-    """Counter error"""
-    pass
+        if self.i >= self.nb:
+            return self.fin, False
+        res = self[self.i]
+        self.i += 1
+        return res, self.i < self.nb
 
 
 class CompteurRange(Compteur):
-    """A simple counter that iterates linearly"""
+    """A simple counter that iterates linearly, taking the same values as numpy.linspace"""
 
     def setup(self):
         """See the Compteur class"""
-        self.i = self.debut     # value read by the counter
-
-        if self.debut == self.fin:  # special case: if the start of the suquence is the same
-            self.mode_repet = True  # value as the end, we shall return nb times the same value
-            self.nb_repet = 0
-        else:       # computing the step
-            self.mode_repet = False
-            if self.nb is not None and self.nb != 0:
-                self.pas = (self.fin - self.debut) / self.nb
-            else:
-                raise CompteurError
+        # if the start of the sequence is the same value as the end, we shall return nb times
+        # the same value
+        self.pas = (self.fin - self.debut) / (self.nb - 1) if self.nb > 1 else 0.
 
-    def incremente(self) -> Tuple[Number, bool]:
+    def valeurs(self, indices: np.ndarray) -> np.ndarray:
+        """See the Compteur class"""
+        res = indices * self.pas + self.debut
+        # like numpy.linspace, the last value is exactly the end of the range
+        if self.nb > 1:
+            res = np.where(indices == self.nb - 1, float(self.fin), res)
+        return np.asarray(res, dtype=np.float64)
+
+    def indice_approche(self, valeur: Number) -> float:
         """See the Compteur class"""
-        if self.mode_repet:
-            self.nb_repet += 1
-            return self.debut, self.nb_repet < self.nb
-        else:
-            if self.i <= self.fin:
-                res = self.i
-                self.i += self.pas
-                return res, True
-            else:
-                return self.fin, False
+        if self.pas == 0:
+            return 0.
+        return (valeur - self.debut) / self.pas
 
 
 class CompteurLogRange(Compteur):
-    """A counter that iterates following a geometric progression"""
+    """A counter that iterates following a geometric progression, taking the same values as
+    numpy.geomspace"""
 
     def setup(self):
-        self.i = math.log(self.debut)     # value read by the counter
-        self.borne_sup = math.log(self.fin)
-        if self.debut == self.fin:  # special case when the step is null; see CompteurRange
-            self.mode_repet = True
-            self.nb_repet = 0
-        else:     # compute the common ratio
-            self.mode_repet = False
-            if self.nb is not None and self.nb != 0:
-                self.pas = (math.log(self.fin) - math.log(self.debut)) / self.nb
-            else:
-                raise CompteurError
+        """See the Compteur class"""
+        if self.debut <= 0 or self.fin <= 0:
+            raise CompteurError
+        self.log_debut = math.log(self.debut)
+        self.pas = (math.log(self.fin) - self.log_debut) / (self.nb - 1) if self.nb > 1 else 0.
 
-    def incremente(self) -> Tuple[Number, bool]:
-        if self.mode_repet:
-            self.nb_repet += 1
-            return self.debut, self.nb_repet < self.nb
-        else:
-            if self.i <= self.borne_sup:
-                res = self.i
-                self.i += self.pas
-                return min(self.fin, math.exp(res)), True  # deal with rounding errors
-            else:
-                return self.fin, False
+    def valeurs(self, indices: np.ndarray) -> np.ndarray:
+        """See the Compteur class"""
+        res = np.exp(indices * self.pas + self.log_debut)
+        # deal with rounding errors: the bounds are exact
+        res = np.where(indices == 0, float(self.debut), res)
+        if self.nb > 1:
+            res = np.where(indices == self.nb - 1, float(self.fin), res)
+        return np.asarray(res, dtype=np.float64)
+
+    def indice_approche(self, valeur: Number) -> float:
+        """See the Compteur class"""
+        if self.pas == 0:
+            return 0.
+        if valeur <= 0:
+            return None
+        return (math.log(valeur) - self.log_debut) / self.pas
@@ -0,0 +1,158 @@
+"""Defines the pools of connections to the SQL server used by the database controller"""
+
+from contextlib import contextmanager
+from typing import Dict
+
+import queue
+import threading
+import logging
+
+import mysql.connector
+
+
+# the errors meaning that the connection is broken (server restarted, network issue...)
+ERREURS_CONNEXION = (mysql.connector.errors.OperationalError,
+                     mysql.connector.errors.InterfaceError)
+
+
+class PoolConnexions():
+    """A pool of connections to the SQL server, sharing the same role (eg reads or writes).
+
+    A connection is checked out by a thread for the duration of a call, and reused if the
+    same thread asks for one again in the meantime. The connections found broken are
+    reconnected (or replaced) before being handed out, and the ones that failed are dropped."""
+
+    def __init__(self, creds: Dict, role: str, taille_max: int = 8, autocommit: bool = False):
+        """Initializes the pool (the connections are opened when first needed)
+
+        Params:
+            creds: the login info, as read from db_cred.json
+            role: the name of the pool, used in the logs
+            taille_max: the maximum number of connections opened at the same time; beyond,
+                        the threads wait for a connection to be given back
+            autocommit: whether each statement is committed (and each read sees the latest
+                        data) without calling commit()
+        """
+
+        self.creds = creds
+        self.role = role
+        self.autocommit = autocommit
+        self.libres = queue.LifoQueue()
+        self.places = threading.BoundedSemaphore(taille_max)
+        self.local = threading.local()
+        # the prepared statements of each connection, {connection: {statement: cursor}}; a
+        # connection is only used by one thread at a time
+        self.prepares = {}
+
+    @contextmanager
+    def connexion(self):
+        """Checks out a connection for the current thread
+
+        Raises:
+            the errors of the connector if the server can't be reached
+        """
+
+        cnx = getattr(self.local, "cnx", None)
+        if cnx is not None:
+            # nested call in the same thread
+            yield cnx
+            return
+
+        self.places.acquire()
+        try:
+            cnx = self._prendre()
+            self.local.cnx = cnx
+            try:
+                yield cnx
+            except ERREURS_CONNEXION:
+                self._jeter(cnx)
+                cnx = None
+                raise
+            finally:
+                self.local.cnx = None
+                if cnx is not None:
+                    self.libres.put(cnx)
+        finally:
+            self.places.release()
+
+    @contextmanager
+    def connexion_dediee(self):
+        """Opens a connection outside of the pool, for a long task (eg streaming a table) that
+        shouldn't hold one of its connections, and which may be run by several threads in turn;
+        the connection is closed afterwards"""
+
+        cnx = self._ouvrir()
+        try:
+            yield cnx
+        finally:
+            try:
+                cnx.close()
+            except Exception:
+                # eg the rows of an interrupted read were not all fetched
+                pass
+
+    def _prendre(self):
+        """Returns a working connection, from the idle ones if possible"""
+
+        while True:
+            try:
+                cnx = self.libres.get_nowait()
+            except queue.Empty:
+                return self._ouvrir()
+            try:
+                if cnx.is_connected():
+                    return cnx
+                # the statements prepared on the lost session are gone
+                self.prepares.pop(cnx, None)
+                cnx.reconnect(attempts=2, delay=0.5)
+                return cnx
+            except ERREURS_CONNEXION:
+                self._jeter(cnx)
+
+    def curseur_prepare(self, cnx, sql: str):
+        """Returns the prepared cursor of the connection for the statement sql: the statement
+        is parsed by the server the first time, then only its parameters are sent (using the
+        binary protocol)
+
+        Params:
+            cnx: a connection checked out from this pool
+            sql: the statement, with %s placeholders
+        """
+
+        curseurs = self.prepares.setdefault(cnx, {})
+        cursor = curseurs.get(sql)
+        if cursor is None:
+            cursor = cnx.cursor(prepared=True)
+            curseurs[sql] = cursor
+        return cursor
+
+    def _ouvrir(self):
+        logging.info("Opening a new {} connection to the database".format(self.role))
+        return mysql.connector.connect(
+            host=self.creds["host"],
+            port=self.creds["port"],
+            user=self.creds["user"],
+            password=self.creds["pass"],
+            database=self.creds["db"],
+            autocommit=self.autocommit
+        )
+
+    def _jeter(self, cnx) -> None:
+        logging.warning("Dropping a broken {} connection to the database".format(self.role))
+        self.prepares.pop(cnx, None)
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def fermer(self) -> None:
+        """Closes the idle connections"""
+        while True:
+            try:
+                cnx = self.libres.get_nowait()
+                self.prepares.pop(cnx, None)
+                cnx.close()
+            except queue.Empty:
+                break
+            except Exception:
+                pass
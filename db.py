@@ -4,35 +4,59 @@ import mysql.connector
 
 import json
 import logging
-import math
+import threading
+from functools import wraps
 from numbers import Number
-from typing import Dict, Type, Tuple
+from typing import Dict, Iterator, List, Type, Tuple
 
 import vartypes
+from connexions import PoolConnexions, ERREURS_CONNEXION
+from stockage import (Stockage, apres_ecritures, avec_verrou, NOM_INDEX_UNIQUE,  # noqa: F401
+                      BDDException, BDDExceptionTableNonValidee, BDDExceptionVariableNonValide,
+                      BDDExceptionResultatsIngerable, BDDExceptionIndexImpossible)
+
+
+def avec_connexion(role: str, reessayer: bool = True):
+    """Checks out a connection of the pool role ("lecture" or "ecriture") for the current
+    thread while the decorated method runs; the method uses it through self.cnx.
+
+    Params:
+        role: the pool to use
+        reessayer: whether the method is run again (once, on a new connection) if the connection
+                   turns out to be broken; only for methods that can safely be run twice
+    """
+
+    def decorateur(methode):
+        @wraps(methode)
+        def methode_connectee(self, *args, **kwargs):
+            precedente = getattr(self.local, "cnx", None)
+            essais = 2 if reessayer and precedente is None else 1
+            for essai in range(essais):
+                try:
+                    with self.pools[role].connexion() as cnx:
+                        self.local.cnx = cnx
+                        try:
+                            return methode(self, *args, **kwargs)
+                        finally:
+                            self.local.cnx = precedente
+                except ERREURS_CONNEXION:
+                    if essai == essais - 1:
+                        raise
+                    logging.warning("Lost the connection to the database, trying again")
+
+        return methode_connectee
+
+    return decorateur
+
+
+class controlleurBDD(Stockage):
+    """The MySQL/MariaDB storage backend"""
 
-
-class BDDException(Exception):
-    pass
-
-
-class BDDExceptionTableNonValidee(BDDException):
-    """The supplied name for the project matches an existing table that is not compatible with
-    the supplied scheme for the project"""
-
-
-class BDDExceptionVariableNonValide(BDDException):
-    """At least one of the names choosed for the variables has been rejected by the
-    database server.
-    Please choose another one"""
-
-
-class BDDExceptionResultatsIngerable(BDDException):
-    """Query result could not be interpreted by the program"""
-
-
-class controlleurBDD():
     def __init__(self, nom_projet: str,
-                 schema: Dict[str, Type[vartypes.csc_var]], fichier_login: str):
+                 schema: Dict[str, Type[vartypes.csc_var]], fichier_login: str,
+                 schema_entree: Dict[str, Type[vartypes.csc_var]] = None,
+                 taille_lot_ecriture: int = 500, delai_max_ecriture: float = 0.5,
+                 taille_pool_lecture: int = 8, fichier_journal: str = None):
         """Initializes the database driver
 
         Params:
@@ -45,13 +69,22 @@ class controlleurBDD():
                                 - E: float
                             the scheme is {"K": csc_float, "n": csc_uint32, "E": csc_float}
             fichier_login: the name of the file used to connect to the database server
+            schema_entree: (optionnal) the part of the scheme generated by the server (in the
+                           example above, {"K": csc_float, "n": csc_uint32}); a record is
+                           unique for these variables and the densification level.
+                           Defaults to the whole scheme
+            taille_lot_ecriture: (optionnal) the number of results written in a single
+                                 transaction
+            delai_max_ecriture: (optionnal) the maximum number of seconds a result waits before
+                                being written
+            taille_pool_lecture: (optionnal) the maximum number of connections used to read
+                                 at the same time
+            fichier_journal: (optionnal) the path of the write-ahead log the results are
+                             appended to before being written (see EcrivainJournal); by
+                             default, they are only kept in memory until written
         """
 
-        self.nom_projet = nom_projet
-        self.schema = schema
-
-        if "id" in schema or "niv_densification" in schema:
-            raise BDDExceptionVariableNonValide
+        Stockage.__init__(self, nom_projet, schema, schema_entree)
 
         with open(fichier_login, "r") as f:
             self.creds = json.load(f)
@@ -59,58 +92,64 @@ class controlleurBDD():
         logging.info("Connexion à la BDD \"{}\" avec l'utilisateur {}@{}".format(
             self.creds["db"], self.creds["user"], self.creds["host"]))
 
-        self.cnx = mysql.connector.connect(
-            host=self.creds["host"],
-            port=self.creds["port"],
-            user=self.creds["user"],
-            password=self.creds["pass"],
-            database=self.creds["db"]
-        )
-
-        self.seuil_densification = None
-        self.variable_densification = None
-        self.offset_cour_densification = 0
-        self.limite_select = None
-
-        self.densifie = False
-
-        self.a_afficher_erreur_plus_echantillon = False
-
-        # the densification depth
-        # we have no choice but to save it in the table; if we don't, each time we'll reach a
-        # new densification level, we run the risk of "drowning" the best candidates of the
-        # old level with new records
-        self.niveau_densification = 1
+        # each thread checks out its own connection (see avec_connexion): the reads always see
+        # the latest data, the writes are committed explicitly, by batches
+        self.local = threading.local()
+        self.pools = {
+            "lecture": PoolConnexions(self.creds, "read", taille_max=taille_pool_lecture,
+                                      autocommit=True),
+            "ecriture": PoolConnexions(self.creds, "write", taille_max=2)
+        }
+
+        # The statements run for each result are built once: the insert (rewritten by the
+        # connector into a multi-row insert for each batch) and the lookup of the points
+        # generated by the server (prepared on each connection, see existe())
+        self.sql_inserer = """INSERT INTO {} ({}) VALUES ({})
+                              ON DUPLICATE KEY UPDATE id = id""".format(
+            nom_projet, ", ".join(self.colonnes), ", ".join([r'%s' for c in self.colonnes]))
+        self.sql_existe = {}    # by tuple of variables
+        self._sql_existe(tuple(self.colonnes_uniques[:-1]))
+
+        self._preparer_table()
+        self._demarrer_ecrivain(taille_lot_ecriture, delai_max_ecriture, fichier_journal)
+
+    @avec_connexion("ecriture")
+    def _preparer_table(self) -> None:
+        """Creates the table of the project, or checks that the existing one is compatible"""
 
         cursor = self.cnx.cursor()
 
         # First off, we check whether a table with the same project name exists
-        r = cursor.execute("""SELECT COUNT(*)
+        cursor.execute("""SELECT COUNT(*)
                                 FROM information_schema.tables
                                 WHERE table_name = %s AND table_schema = %s
-                                LIMIT 1""", (nom_projet, self.creds["db"]))
+                                LIMIT 1""", (self.nom_projet, self.creds["db"]))
 
         nb_tables = cursor.fetchone()[0]
 
-        schema_sql = [nom + " " + str(vartype.to_SQL_type()) for nom, vartype in schema.items()]
+        schema_sql = [nom + " " + str(vartype.to_SQL_type())
+                      for nom, vartype in self.schema.items()]
         schema_sql.append("niv_densification INT UNSIGNED ")
         schema_sql.append("id INT NOT NULL AUTO_INCREMENT, PRIMARY KEY (id)")
+        schema_sql.append("UNIQUE KEY {} ({})".format(NOM_INDEX_UNIQUE,
+                                                      ", ".join(self.colonnes_uniques)))
 
         if nb_tables != 0:
-            logging.info("Table {} already exists !".format(nom_projet))
+            logging.info("Table {} already exists !".format(self.nom_projet))
 
             # Check that the table is compatible
-            cursor.execute("DESCRIBE {};".format(nom_projet))
+            cursor.execute("DESCRIBE {};".format(self.nom_projet))
             for r in cursor:
                 # Name...
-                if r[0] in schema:
+                if r[0] in self.schema:
                     # Type...
-                    if str(r[1]).casefold() != str(schema[r[0]].to_SQL_type()).casefold():
+                    if str(r[1]).casefold() != str(self.schema[r[0]].to_SQL_type()).casefold():
                         raise BDDExceptionTableNonValidee
                 elif r[0] == "niv_densification":
                     if str(r[1]).casefold() != str(vartypes.csc_uint32.to_SQL_type()).casefold():
                         raise BDDExceptionTableNonValidee
 
+            self._valider_index(cursor)
             logging.info("Table validated")
         else:       # simpler case: table doesn't exist
             # Sadly, we have no choice but to use string substitution.
@@ -118,44 +157,58 @@ class controlleurBDD():
             # extracting data from the running Python code.
             # I guess that if a third-party is able to hijack Python code running on the server, we
             # have a much bigger issue that a "simple" SQLi
-            cursor.execute("CREATE TABLE {} ({});".format(nom_projet, ", ".join(schema_sql)))
-            logging.info("La table {} n'existait pas, on vient de la créer !".format(nom_projet))
+            cursor.execute("CREATE TABLE {} ({});".format(self.nom_projet, ", ".join(schema_sql)))
+            logging.info("La table {} n'existait pas, on vient de la créer !".format(
+                self.nom_projet))
         cursor.close()
 
-    def enregistrer(self, resultat: Dict[str, vartypes.csc_var]):
-        """Saves the result of a computation in the database
-
-        Params:
-            resultat: the result of the computation, with the following shape:
-                                {"variable name": variable_value}
-                        variable_value being an instance of the cascada type matching the
-                        type assigned to said variable in the scheme provided during the
-                        initialization
-
-                        Example:
-                            {"K": csc_float(7.4), "n": csc_uint32(14638), "E": csc_float(15.9)}
-
-        Returns:
-            None
-        """
+    def _valider_index(self, cursor) -> None:
+        """Checks that the existing table has the unique index, and adds it if it hasn't"""
+
+        cursor.execute("SHOW INDEX FROM {};".format(self.nom_projet))
+        index = {}
+        for r in cursor:
+            # Table, Non_unique, Key_name, Seq_in_index, Column_name...
+            if int(r[1]) == 0:
+                index.setdefault(r[2], set()).add(r[4])
+
+        if set(self.colonnes_uniques) in index.values():
+            return
+
+        logging.info("Adding the unique index to the table {}".format(self.nom_projet))
+        try:
+            cursor.execute("ALTER TABLE {} ADD UNIQUE KEY {} ({});".format(
+                self.nom_projet, NOM_INDEX_UNIQUE, ", ".join(self.colonnes_uniques)))
+        except mysql.connector.Error as e:
+            logging.error("Could not add the unique index: {}".format(e))
+            raise BDDExceptionIndexImpossible
+
+    @property
+    def cnx(self):
+        """The connection checked out by the current thread, see avec_connexion"""
+        return self.local.cnx
+
+    def fermer(self) -> None:
+        """Writes the pending results, stops the buffered writer and closes the connections"""
+        Stockage.fermer(self)
+        for pool in self.pools.values():
+            pool.fermer()
+
+    @avec_connexion("ecriture")
+    def _ecrire_lot(self, lignes: List[Dict[str, vartypes.csc_var]]):
+        """Writes a batch of results (as returned by _caster_resultat()) using a single
+        multi-row insert and a single commit; called by the buffered writer"""
 
         cursor = self.cnx.cursor()
-        # Recasting
-        r2 = {}
-        for nom, type_var in self.schema.items():
-            r2[nom] = type_var(resultat[nom])
-        resultat = r2
-        resultat["niv_densification"] = vartypes.csc_int32(self.niveau_densification)
-        cursor.execute("""INSERT INTO {} ({}) VALUES ({})""".format(self.nom_projet,
-                                                                    ", ".join(resultat.keys()),
-                                                                    ", ".join(
-                                                                        [r'%s' for x
-                                                                         in resultat.keys()])),
-                       tuple([str(x) for x in resultat.values()]))
+        # the connector rewrites executemany() on an INSERT ... VALUES into a multi-row insert;
+        # the results that were already saved (eg cannibalized tasks) are ignored
+        cursor.executemany(self.sql_inserer,
+                           [tuple([ligne[c].value for c in self.colonnes]) for ligne in lignes])
 
         self.cnx.commit()
         cursor.close()
 
+    @avec_connexion("lecture")
     def existe(self, valeurs: Dict[str, vartypes.csc_var]) -> bool:
         """Checks if a record containing valeurs exists
 
@@ -167,21 +220,54 @@ class controlleurBDD():
             bool: True if the record exists, False otherwise
         """
 
+        # served by the unique index; stops at the first matching record
+        sql = self._sql_existe(tuple(valeurs.keys()))
+        cursor = self.pools["lecture"].curseur_prepare(self.cnx, sql)
+        # the cursor only prepares the statement again if it's given another one
+        cursor.execute(sql, tuple([v.value for v in valeurs.values()]))
+        res = cursor.fetchall()[0][0]
+        return res != 0
+
+    def _sql_existe(self, noms: Tuple[str, ...]) -> str:
+        """Returns the statement used by existe() for the variables noms"""
+
+        sql = self.sql_existe.get(noms)
+        if sql is None:
+            sql = "SELECT EXISTS(SELECT 1 FROM {} WHERE {})".format(
+                self.nom_projet, " AND ".join(["{} = %s".format(n) for n in noms]))
+            self.sql_existe[noms] = sql
+        return sql
+
+    @apres_ecritures
+    @avec_connexion("lecture")
+    def enregistrements_dans(self,
+                             bornes: Dict[str, Tuple[Number, Number]]) -> List[Dict[str, Number]]:
+        """Fetches the records which variables are within the supplied limits; used to know
+        which points of a grid were already computed with a single query
+
+        Params:
+            bornes: the limits, {'<var name>': (min, max)}
+
+        Returns:
+            list: the records, as dictionnaries only holding the variables of bornes
+        """
+
+        if len(bornes) == 0:
+            return []
+
         cursor = self.cnx.cursor(dictionary=True)
-        cursor.execute("""SELECT COUNT(*) AS C FROM {} WHERE {}""".format(self.nom_projet,
-                                                                          " AND ".join(
-                                                                              ["{} = {}".format(
-                                                                                  var,
-                                                                                  str(val)
-                                                                              ) for var, val in
-                                                                                  valeurs.items()]
-                                                                          )
-                                                                          )
-                       )
-        res = cursor.fetchone()["C"]
+        cursor.execute("""SELECT {} FROM {} WHERE {}""".format(
+            ", ".join(bornes.keys()),
+            self.nom_projet,
+            " AND ".join(["{} BETWEEN %s AND %s".format(var) for var in bornes])),
+            tuple([v for b in bornes.values() for v in b]))
+        res = cursor.fetchall()
         cursor.close()
-        return res != 0
+        return res
 
+    @apres_ecritures
+    @avec_verrou
+    @avec_connexion("lecture")
     def densifier(self, seuil: float, variable: str, offset: int = 0):
         """Sets up the DB for densification, ie finding the records MAXIMIZING the value of the
         variable named variable.
@@ -216,190 +302,77 @@ class controlleurBDD():
         count = int(cursor.fetchone()["C"])
         cursor.close()
 
-        logging.info(
-            "Densification procedure on {} initialized. Current densifcation level is {}; "
-            "this level has generated {} records".format(
-                self.variable_densification,
-                self.niveau_densification,
-                count))
-
-        # Computing the number of records we're keeping
-        if self.niveau_densification == 1:
-            limite = int(math.ceil(seuil * count))
-        else:
-
-            # We know that last time we drew limite_select configurations,
-            # therefore each configuration would have had count/limite_select iterations.
-            # Using a max to avoid division by zero errors
-            limite = int(math.ceil(seuil * count / max(self.limite_select, 1)))
-
-        if limite == 0 and not self.a_afficher_erreur_plus_echantillon:
-            logging.warning(
-                "No record found. "
-                "Likely cause: records for this step have all been previously computed. "
-                "Fix: adjust the numerical paramters for the densification. "
-                "The issue we keep happening for the other densifications but this warning will "
-                "only show up once."
-            )
-            self.a_afficher_erreur_plus_echantillon = True
-
+        limite = self._calculer_limite(seuil, count)
         self.limite_select = limite
 
-        logging.info("\tFor this densification step, {} schemes will be drawn".format(limite))
+        self._lire_niveau(self.niveau_densification, limite, offset)
 
         self.niveau_densification += 1
 
-    def schema_suivant(self,
-                       schema_entree: Dict[str,
-                                           Type[vartypes.csc_var]]) -> Dict[str,
-                                                                            Tuple[Number,
-                                                                                  Number,
-                                                                                  Number]]:
-        """Does most of the densification work.
-        This consists in finding the best/most promising values
-        for the parameters sent to the client and "zooming" on them
-        and increasing the resolution (ie the step size between
-        each sample point) near these points.
-
-        Params:
-            schema_entree: a scheme with the same shape as the scheme used to
-                        initialize the database controller, but it should only
-                        cointain the so-called outgoing variables that will be
-                        sent to the slave servers, as these are the ones the
-                        master have full control over
-
-        Returns:
-            dict: a dictionnary which keys are the keys of schema_entree and the values
-                being 3-value tuples (<center value>, <immediately inferior neighbor>,
-                <immediately superior neighbor>). The center value is the value that was
-                previously computed by the client and determined to be "promising". Each
-                of the neighbors coordinates (say there are N of them) are computed by
-                iteratively setting the other coordinates (N-1 variables) to their respective
-                value in the center vector, and then looking up the closet neighbors for the
-                remaining "free" coordinate amongst the records of the DB having the other,
-                N-1 variables set to their value.
-                Some neighbors might be missing, for instance if the selected record is the one
-                having the maximum values for the coordinates (is that case, their is no upper
-                neighbor), then they are replaced by <center value>.
-                If there are no new promising configurations to fetch (because the maximum number
-                of candidates as computed in densifier() has been reached), the function returns
-                None; in that case, one should call densifier() again.
-        """
-
-        if not self.densifie:
-            return None
+    @avec_connexion("lecture")
+    def _lire_niveau(self, niveau: int, limite: int, offset: int) -> None:
+        """Fetches the candidates of the level niveau (ranked offset to limite) and the input
+        coordinates of its records"""
 
+        # The candidates of the level are fetched once, in a single ordered read, and then
+        # handed out by schema_suivant()
         cursor = self.cnx.cursor(dictionary=True)
-
-        # On commence par extraire l'enregistrement avec les coordonnées bonnes
         cursor.execute(
             """SELECT *
             FROM {}
-            WHERE niv_densification = {}-1
+            WHERE niv_densification = %s
             ORDER BY {}
-            DESC LIMIT 1
-            OFFSET {}""".format(
+            DESC LIMIT %s
+            OFFSET %s""".format(
                 self.nom_projet,
-                self.niveau_densification,
-                self.variable_densification,
-                self.offset_cour_densification))
-
-        sch = cursor.fetchone()
-        if sch is None:
-            self.densifie = False
-            return None
-
-        self.offset_cour_densification += 1
-
+                self.variable_densification),
+            (niveau, max(limite - offset, 0), offset))
+        candidats = cursor.fetchall()
+
+        # and so are the input coordinates of the level, in which their neighbors are found
+        cursor.execute("""SELECT {} FROM {} WHERE niv_densification = %s""".format(
+            ", ".join(self.colonnes_uniques[:-1]), self.nom_projet),
+            (niveau,))
+        self._charger_candidats(candidats, offset, cursor.fetchall())
         cursor.close()
 
-        cursor = self.cnx.cursor()
-        sch_vrai = {}
-
-        # Recasting (CRITICAL for floats, because of the precision:
-        # MySQL only displays the significant part of floats but expects a "long"
-        # value for them, that we get by recasting)
-        for n in schema_entree:
-            sch_vrai[n] = schema_entree[n](sch[n])
-
-        # on reprend le niveau de densification précédent
-        # starting from the previous densification scheme
-        sch_vrai["niv_densification"] = vartypes.csc_int32(self.niveau_densification - 1)
-
-        # Then we find the closest neighbors for each coordinate
-        xs = {xn: "{} = {}".format(xn, xv) for xn, xv in sch_vrai.items()}
-
-        bornes = {}
-
-        for n, v in sch_vrai.items():
-            # We don't take the densification variable into account but it's what we're
-            # trying to maximize
-            if n != self.variable_densification and n != "niv_densification":
-                val_python = sch[n]
-                s = " AND ".join(
-                    filter(
-                        None, [
-                            xs[xn] if xn != n and xn != self.variable_densification
-                            else None
-                            for xn in sch_vrai
-                        ]
-                    )
-                )
-
-                # cf https://ask.sqlservercentral.com/questions/103011/retrieve-closest-upper-and-lower-values.html # noqa
-                # fetch the closest neighbors
-
-                cursor.execute("""SELECT
-                                        CASE SIGN({}-{})
-                                            WHEN 1 THEN MIN({})
-                                            ELSE        MAX({})
-                                        END
-                                AS  {}
-                                FROM {} AS xV
-                                WHERE {}
-                                GROUP BY SIGN({}-{})
-                                HAVING SIGN({}-{}) != 0
-                                """.format(n, v, n, n, n, self.nom_projet,
-                                           s, n, v, n, v))
-
-                res = cursor.fetchall()
-
-                # Issue: the connector returns the data as a tuple
-                r = []
-                for x in res:
-                    if isinstance(x, tuple):
-                        r.append(*x)
-                    else:
-                        r.append(x)
-                res = sorted(r)
-
-                if len(res) == 2:
-                    bornes[n] = tuple([val_python, *res])
-                elif len(res) == 1:
-                    if res[0] < val_python:
-                        bornes[n] = (val_python, res[0], val_python)
-                    else:
-                        bornes[n] = (val_python, val_python, res[0])
-                elif len(res) == 0:
-                    bornes[n] = (val_python, val_python, val_python)
-                else:
-                    raise BDDExceptionResultatsIngerable
-
-        if self.offset_cour_densification >= self.limite_select:
-            self.densifie = False
-
-        # offset_cour_densification-1 because we just incremented it
-        logging.info(
-            "\tNew scheme drawn: {}, offset {}".format(
-                bornes, self.offset_cour_densification - 1))
-
-        return bornes
-
-    def densification_en_cours(self) -> bool:
-        """Checks whether a densification procedure is running
+    def exporter(self, ordre: str, niveau: int = None,
+                 taille_bloc: int = 1000) -> Iterator[List[Tuple]]:
+        """Streams the records of the project, the best ones first
+
+        Params:
+            ordre: the variable used to sort the records, by decreasing value
+            niveau: (optionnal) only exports the records of this densification level
+            taille_bloc: (optionnal) the number of rows fetched from the server at once
 
         Returns:
-            True if a densification procedure is running; False if not
+            iterator: blocks of rows, each row being a tuple of the values of self.colonnes
+
+        Note:
+            The rows are read by an unbuffered cursor on a dedicated connection: they are
+            fetched from the server as the blocks are consumed, so that the memory used
+            doesn't depend on the size of the table. The iterator may be consumed by several
+            threads in turn (but not at the same time).
         """
 
-        return self.densifie
+        if ordre not in self.schema:
+            raise KeyError
+
+        sql = "SELECT {} FROM {}{} ORDER BY {} DESC".format(
+            ", ".join(self.colonnes), self.nom_projet,
+            "" if niveau is None else " WHERE niv_densification = %s", ordre)
+        return self._lire_par_blocs(sql, () if niveau is None else (niveau,), taille_bloc)
+
+    def _lire_par_blocs(self, sql: str, params: Tuple, taille_bloc: int) -> Iterator[List[Tuple]]:
+        """Runs the query on a dedicated connection and yields its rows by blocks"""
+
+        self.vider()
+        with self.pools["lecture"].connexion_dediee() as cnx:
+            cursor = cnx.cursor(buffered=False)
+            cursor.execute(sql, params)
+            while True:
+                bloc = cursor.fetchmany(taille_bloc)
+                if len(bloc) == 0:
+                    break
+                yield bloc
+            cursor.close()
@@ -0,0 +1,265 @@
+"""Defines the embedded storage backend, which keeps the results in a SQLite file: no database
+server is needed, which suits small and medium campaigns (and benchmarks)"""
+
+import logging
+import sqlite3
+import threading
+from numbers import Number
+from typing import Dict, Iterator, List, Type, Tuple
+
+import vartypes
+from stockage import (Stockage, apres_ecritures, avec_verrou, NOM_INDEX_UNIQUE,
+                      BDDExceptionTableNonValidee, BDDExceptionIndexImpossible)
+
+
+def type_sqlite(vartype: Type[vartypes.csc_var]) -> str:
+    """Returns the SQLite type (ie the storage class) matching the cascada type"""
+    if issubclass(vartype, (vartypes.csc_float, vartypes.csc_double)):
+        return "REAL"
+    return "INTEGER"
+
+
+class controlleurSQLite(Stockage):
+    """The SQLite storage backend.
+
+    Each thread uses its own connection to the file, which is in WAL mode: the readers (eg the
+    densification queries) never block the writer, and the other way around. The statements
+    are built once, with placeholders, so that SQLite can reuse their compiled form."""
+
+    def __init__(self, nom_projet: str, schema: Dict[str, Type[vartypes.csc_var]],
+                 schema_entree: Dict[str, Type[vartypes.csc_var]] = None,
+                 fichier: str = None, taille_lot_ecriture: int = 500,
+                 delai_max_ecriture: float = 0.5, fichier_journal: str = None):
+        """Opens (or creates) the database file
+
+        Params:
+            nom_projet: the name given to the project, used to create/open a table
+            schema: the complete data scheme (see controlleurBDD)
+            schema_entree: (optionnal) the part of the scheme generated by the server; a record
+                           is unique for these variables and the densification level.
+                           Defaults to the whole scheme
+            fichier: (optionnal) the path of the database file; defaults to <nom_projet>.sqlite3
+            taille_lot_ecriture: (optionnal) the number of results written in a single
+                                 transaction
+            delai_max_ecriture: (optionnal) the maximum number of seconds a result waits before
+                                being written
+            fichier_journal: (optionnal) the path of the write-ahead log the results are
+                             appended to before being written (see EcrivainJournal); by
+                             default, they are only kept in memory until written
+        """
+
+        Stockage.__init__(self, nom_projet, schema, schema_entree)
+
+        self.fichier = fichier if fichier is not None else nom_projet + ".sqlite3"
+        self.local = threading.local()
+        # every connection opened by a thread, so that they can all be closed by fermer()
+        self.connexions = []
+        self.verrou_connexions = threading.Lock()
+        logging.info("Opening the SQLite database {}".format(self.fichier))
+
+        self.sql_inserer = "INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+            nom_projet, ", ".join(self.colonnes), ", ".join(["?" for c in self.colonnes]))
+        self.sql_compter = "SELECT COUNT(*) FROM {} WHERE niv_densification = ?".format(
+            nom_projet)
+        self.sql_existe = {}    # by tuple of variables, built when first needed
+
+        self._preparer_table()
+        self._demarrer_ecrivain(taille_lot_ecriture, delai_max_ecriture, fichier_journal)
+
+    @property
+    def cnx(self) -> sqlite3.Connection:
+        """The connection of the current thread, opened when first needed"""
+
+        cnx = getattr(self.local, "cnx", None)
+        if cnx is None:
+            # the transactions are managed explicitly (see _ecrire_lot); the connection is only
+            # used by this thread, but it is closed by the one calling fermer()
+            cnx = sqlite3.connect(self.fichier, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+            cnx.row_factory = sqlite3.Row
+            cnx.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode, a commit is durable once the WAL is checkpointed; a crash of the OS
+            # can only lose the last transactions, never corrupt the file
+            cnx.execute("PRAGMA synchronous=NORMAL")
+            self.local.cnx = cnx
+            with self.verrou_connexions:
+                self.connexions.append(cnx)
+        return cnx
+
+    def _preparer_table(self) -> None:
+        """Creates the table of the project, or checks that the existing one is compatible"""
+
+        colonnes = {r["name"]: r["type"] for r in
+                    self.cnx.execute("PRAGMA table_info({})".format(self.nom_projet))}
+
+        if len(colonnes) > 0:
+            logging.info("Table {} already exists !".format(self.nom_projet))
+            for nom, vartype in self.schema.items():
+                if colonnes.get(nom, "").casefold() != type_sqlite(vartype).casefold():
+                    raise BDDExceptionTableNonValidee
+            if colonnes.get("niv_densification", "").casefold() != "integer":
+                raise BDDExceptionTableNonValidee
+        else:
+            schema_sql = [nom + " " + type_sqlite(vartype) for nom, vartype in self.schema.items()]
+            schema_sql.append("niv_densification INTEGER")
+            schema_sql.append("id INTEGER PRIMARY KEY AUTOINCREMENT")
+            self.cnx.execute("CREATE TABLE {} ({})".format(self.nom_projet, ", ".join(schema_sql)))
+            logging.info("Table {} created".format(self.nom_projet))
+
+        try:
+            self.cnx.execute("CREATE UNIQUE INDEX IF NOT EXISTS {}_{} ON {} ({})".format(
+                self.nom_projet, NOM_INDEX_UNIQUE, self.nom_projet,
+                ", ".join(self.colonnes_uniques)))
+        except sqlite3.IntegrityError as e:
+            logging.error("Could not add the unique index: {}".format(e))
+            raise BDDExceptionIndexImpossible
+
+    def fermer(self) -> None:
+        """Writes the pending results, stops the buffered writer and closes the connections of
+        every thread"""
+        Stockage.fermer(self)
+        with self.verrou_connexions:
+            for cnx in self.connexions:
+                cnx.close()
+            self.connexions = []
+        self.local.cnx = None
+
+    def _ecrire_lot(self, lignes: List[Dict[str, vartypes.csc_var]]):
+        """Writes a batch of results (as returned by _caster_resultat()) in a single
+        transaction; the results that were already saved (eg cannibalized tasks) are ignored"""
+
+        cnx = self.cnx
+        cnx.execute("BEGIN IMMEDIATE")
+        try:
+            cnx.executemany(self.sql_inserer,
+                            [tuple([ligne[c].value for c in self.colonnes]) for ligne in lignes])
+        except BaseException:
+            cnx.execute("ROLLBACK")
+            raise
+        cnx.execute("COMMIT")
+
+    def existe(self, valeurs: Dict[str, vartypes.csc_var]) -> bool:
+        """Checks if a record containing valeurs exists
+
+        Params:
+            valeurs: the name of the variables and their value
+
+        Returns:
+            bool: True if the record exists, False otherwise
+        """
+
+        noms = tuple(valeurs.keys())
+        sql = self.sql_existe.get(noms)
+        if sql is None:
+            sql = "SELECT EXISTS(SELECT 1 FROM {} WHERE {})".format(
+                self.nom_projet, " AND ".join(["{} = ?".format(n) for n in noms]))
+            self.sql_existe[noms] = sql
+        res = self.cnx.execute(sql, tuple([v.value for v in valeurs.values()])).fetchone()
+        return res[0] != 0
+
+    @apres_ecritures
+    def enregistrements_dans(self,
+                             bornes: Dict[str, Tuple[Number, Number]]) -> List[Dict[str, Number]]:
+        """Fetches the records which variables are within the supplied limits
+
+        Params:
+            bornes: the limits, {'<var name>': (min, max)}
+
+        Returns:
+            list: the records, as dictionnaries only holding the variables of bornes
+        """
+
+        if len(bornes) == 0:
+            return []
+
+        curseur = self.cnx.execute("SELECT {} FROM {} WHERE {}".format(
+            ", ".join(bornes.keys()),
+            self.nom_projet,
+            " AND ".join(["{} BETWEEN ? AND ?".format(var) for var in bornes])),
+            tuple([v for b in bornes.values() for v in b]))
+        return [dict(r) for r in curseur]
+
+    @apres_ecritures
+    @avec_verrou
+    def densifier(self, seuil: float, variable: str, offset: int = 0):
+        """Sets up the densification of the next level, ie finding the records MAXIMIZING the
+        value of the variable named variable (see controlleurBDD.densifier())
+
+        Params:
+            seuil: the ratio of records that should be kept
+            variable: the name of the variable that should be used to find the best records
+            offset: the offset used when selecting best candidates. Defaults to 0.
+        """
+
+        if not 0 < seuil <= 1:
+            raise ValueError
+
+        if variable not in self.schema:
+            raise KeyError
+
+        self.densifie = True
+        self.seuil_densification = seuil
+        self.offset_cour_densification = offset
+        self.variable_densification = variable
+
+        count = int(self.cnx.execute(self.sql_compter, (self.niveau_densification,)).fetchone()[0])
+        self.limite_select = self._calculer_limite(seuil, count)
+
+        self._lire_niveau(self.niveau_densification, self.limite_select, offset)
+
+        self.niveau_densification += 1
+
+    def _lire_niveau(self, niveau: int, limite: int, offset: int) -> None:
+        """Fetches the candidates of the level niveau (ranked offset to limite) and the input
+        coordinates of its records"""
+
+        # the candidates of the level are fetched once, in a single ordered read
+        curseur = self.cnx.execute("SELECT * FROM {} WHERE niv_densification = ? "
+                                   "ORDER BY {} DESC LIMIT ? OFFSET ?".format(
+                                       self.nom_projet, self.variable_densification),
+                                   (niveau, max(limite - offset, 0), offset))
+        candidats = [dict(r) for r in curseur]
+
+        # and so are the input coordinates of the level, in which their neighbors are found
+        curseur = self.cnx.execute("SELECT {} FROM {} WHERE niv_densification = ?".format(
+            ", ".join(self.colonnes_uniques[:-1]), self.nom_projet), (niveau,))
+        self._charger_candidats(candidats, offset, [dict(r) for r in curseur])
+
+    def exporter(self, ordre: str, niveau: int = None,
+                 taille_bloc: int = 1000) -> Iterator[List[Tuple]]:
+        """Streams the records of the project, the best ones first (see
+        controlleurBDD.exporter())
+
+        Params:
+            ordre: the variable used to sort the records, by decreasing value
+            niveau: (optionnal) only exports the records of this densification level
+            taille_bloc: (optionnal) the number of rows read at once
+
+        Returns:
+            iterator: blocks of rows, each row being a tuple of the values of self.colonnes
+        """
+
+        if ordre not in self.schema:
+            raise KeyError
+
+        sql = "SELECT {} FROM {}{} ORDER BY {} DESC".format(
+            ", ".join(self.colonnes), self.nom_projet,
+            "" if niveau is None else " WHERE niv_densification = ?", ordre)
+        return self._lire_par_blocs(sql, () if niveau is None else (niveau,), taille_bloc)
+
+    def _lire_par_blocs(self, sql: str, params: Tuple, taille_bloc: int) -> Iterator[List[Tuple]]:
+        """Runs the query on a dedicated connection and yields its rows by blocks"""
+
+        self.vider()
+        # SQLite steps through the query as the rows are fetched; the connection may be used
+        # by several threads in turn, as the blocks are consumed
+        cnx = sqlite3.connect(self.fichier, timeout=30, check_same_thread=False)
+        try:
+            curseur = cnx.execute(sql, params)
+            while True:
+                bloc = curseur.fetchmany(taille_bloc)
+                if len(bloc) == 0:
+                    break
+                yield bloc
+        finally:
+            cnx.close()
@@ -0,0 +1,127 @@
+"""Defines the buffered writer, which saves the results in the database by batches"""
+
+from typing import Any, Callable, List
+
+import queue
+import threading
+import logging
+import time
+
+
+class EcrivainGroupe(threading.Thread):
+    """A thread that gathers the rows to insert and writes them in batches, each batch being
+    a single transaction (group commit): the cost of a commit is paid once per batch instead
+    of once per result.
+
+    A batch is written once it holds taille_lot rows, or once its oldest row has been waiting
+    for delai_max seconds. At most taille_max rows are kept in memory: beyond, ajouter() waits
+    for the thread to catch up."""
+
+    def __init__(self, ecrire: Callable[[List[Any]], None], taille_lot: int = 500,
+                 delai_max: float = 0.5, taille_max: int = 20000):
+        """Initializes the writer
+
+        Params:
+            ecrire: the function writing (and committing) a batch of rows
+            taille_lot: the number of rows that triggers a write
+            delai_max: the maximum number of seconds a row waits before being written
+            taille_max: the maximum number of rows waiting to be written
+        """
+
+        threading.Thread.__init__(self, name="cascada-ecrivain", daemon=True)
+
+        self.ecrire = ecrire
+        self.taille_lot = taille_lot
+        self.delai_max = delai_max
+        self.file = queue.Queue(maxsize=taille_max)
+
+        # nb_deposes and nb_ecrits are used by vider() to know when its rows were written
+        self.condition = threading.Condition()
+        self.nb_deposes = 0
+        self.nb_ecrits = 0
+
+        self.presse = threading.Event()     # set to write the pending rows right away
+        self.arret = threading.Event()
+
+    def ajouter(self, ligne) -> None:
+        """Queues a row to be written, waiting if too many rows are already waiting"""
+        self.file.put(ligne)
+        with self.condition:
+            self.nb_deposes += 1
+
+    def ajouter_lot(self, lignes: List[Any]) -> None:
+        """Queues several rows to be written"""
+        for ligne in lignes:
+            self.ajouter(ligne)
+
+    def vider(self) -> None:
+        """Waits until every row queued before the call is written (eg before reading the
+        results to densify)"""
+
+        with self.condition:
+            cible = self.nb_deposes
+            if self.nb_ecrits >= cible:
+                return
+            self.presse.set()
+            while self.nb_ecrits < cible and self.is_alive():
+                self.condition.wait(timeout=0.5)
+
+    def arreter(self) -> None:
+        """Writes the pending rows and stops the thread"""
+        self.arret.set()
+        self.presse.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self) -> None:
+        """Main loop of the writer"""
+
+        while not (self.arret.is_set() and self.file.empty()):
+            lot = self._rassembler()
+            if len(lot) == 0:
+                continue
+
+            # the rows are never dropped: if the database is unavailable, we try again
+            # (and the clients wait once the queue is full)
+            while True:
+                try:
+                    self.ecrire(lot)
+                    break
+                except Exception:
+                    logging.exception("Buffered writer: could not write {} rows".format(len(lot)))
+                    if self.arret.is_set():
+                        logging.error("Buffered writer: {} rows lost".format(len(lot)))
+                        break
+                    self.arret.wait(1)
+
+            with self.condition:
+                self.nb_ecrits += len(lot)
+                self.condition.notify_all()
+
+    def _rassembler(self) -> List[Any]:
+        """Waits for a batch of rows to be ready to be written"""
+
+        try:
+            lot = [self.file.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        limite = time.monotonic() + self.delai_max
+        while len(lot) < self.taille_lot:
+            # the rows already there are taken without waiting
+            try:
+                lot.append(self.file.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            attente = limite - time.monotonic()
+            if attente <= 0 or self.presse.is_set():
+                break
+            try:
+                lot.append(self.file.get(timeout=min(attente, 0.05)))
+            except queue.Empty:
+                pass
+
+        if self.file.empty():
+            self.presse.clear()
+        return lot
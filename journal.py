@@ -0,0 +1,255 @@
+"""Defines the journaled writer, which logs the results in a local file before they are
+acknowledged, then writes them in the database in the background"""
+
+from typing import Any, Callable, List
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class EcrivainJournal(threading.Thread):
+    """A thread writing the rows to the database by batches (like EcrivainGroupe), the rows
+    being first appended to a local write-ahead log.
+
+    ajouter() only returns once the rows are on disk (the file is synced once for all the rows
+    appended in the meantime, by any thread): a result acknowledged to a slave server survives
+    a crash of the master server, and a stall of the database doesn't slow the submissions
+    down, the log growing in the meantime.
+
+    The thread reads the log from the offset of the first row not yet written, which is saved
+    in <fichier>.offset after each batch: after a restart, it resumes from there. The rows of a
+    batch interrupted by a crash are written again; the unique index makes that harmless.
+    Once every row is written, a log bigger than taille_compactage is emptied."""
+
+    def __init__(self, ecrire: Callable[[List[Any]], None], fichier: str,
+                 encoder: Callable[[Any], List], decoder: Callable[[List], Any],
+                 taille_lot: int = 500, delai_max: float = 0.5,
+                 taille_compactage: int = 64 * 2**20):
+        """Opens (or creates) the log
+
+        Params:
+            ecrire: the function writing (and committing) a batch of rows
+            fichier: the path of the log
+            encoder: turns a row into a list of JSON-serializable values
+            decoder: turns such a list back into a row
+            taille_lot: the maximum number of rows in a batch
+            delai_max: the maximum number of seconds a row waits before being written
+            taille_compactage: the size (in bytes) above which the log is emptied once every
+                               row is written
+        """
+
+        threading.Thread.__init__(self, name="cascada-journal", daemon=True)
+
+        self.ecrire = ecrire
+        self.fichier = fichier
+        self.fichier_offset = fichier + ".offset"
+        self.encoder = encoder
+        self.decoder = decoder
+        self.taille_lot = taille_lot
+        self.delai_max = delai_max
+        self.taille_compactage = taille_compactage
+
+        # lock order: verrou_sync, then verrou, then condition
+        self.verrou = threading.Lock()          # appends to the log
+        self.verrou_sync = threading.Lock()     # syncs of the log
+        self.condition = threading.Condition()  # new rows on disk, rows written
+
+        fin = self._reparer()
+        self.flux = open(fichier, "ab")
+        self.lecteur = open(fichier, "rb")
+
+        # offsets in the log: end of the rows appended, of the rows on disk, of the rows
+        # written in the database; base is the size of the log emptied so far (see vider())
+        self.fin = fin
+        self.fin_sync = fin
+        self.applique = self._lire_offset(fin)
+        self.base = 0
+        if self.applique < fin:
+            logging.info("Write-ahead log {}: {} bytes of results to write again".format(
+                fichier, fin - self.applique))
+
+        self.presse = threading.Event()     # set to write the pending rows right away
+        self.arret = threading.Event()
+
+    def _reparer(self) -> int:
+        """Drops the last, incomplete row of the log (written during a crash)
+
+        Returns:
+            int: the size of the log
+        """
+
+        if not os.path.exists(self.fichier):
+            return 0
+
+        with open(self.fichier, "rb+") as f:
+            taille = f.seek(0, os.SEEK_END)
+            # the log is read backwards, by blocks, up to the last end of line (a row can be
+            # longer than a block)
+            fin = 0
+            debut = taille
+            while debut > 0:
+                debut = max(debut - 2**16, 0)
+                f.seek(debut)
+                position = f.read(min(2**16, taille - debut)).rfind(b"\n")
+                if position >= 0:
+                    fin = debut + position + 1
+                    break
+            if fin != taille:
+                logging.warning("Write-ahead log {}: dropping an incomplete row".format(
+                    self.fichier))
+                f.truncate(fin)
+            return fin
+
+    def _lire_offset(self, fin: int) -> int:
+        try:
+            with open(self.fichier_offset, "r") as f:
+                offset = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+        if offset > fin:
+            logging.warning("Write-ahead log {}: offset past the end, starting over".format(
+                self.fichier))
+            return 0
+        return offset
+
+    def _ecrire_offset(self, offset: int) -> None:
+        # the file is replaced at once, so that it always holds a valid offset
+        with open(self.fichier_offset + ".tmp", "w") as f:
+            f.write(str(offset))
+        os.replace(self.fichier_offset + ".tmp", self.fichier_offset)
+
+    def ajouter(self, ligne) -> None:
+        """Logs a row, returning once it is on disk"""
+        self.ajouter_lot([ligne])
+
+    def ajouter_lot(self, lignes: List[Any]) -> None:
+        """Logs several rows, returning once they are on disk"""
+
+        donnees = b"".join([json.dumps(self.encoder(ligne)).encode("utf-8") + b"\n"
+                            for ligne in lignes])
+        with self.verrou:
+            self.flux.write(donnees)
+            self.flux.flush()
+            self.fin += len(donnees)
+            fin = self.fin
+
+        # group commit: the thread getting the lock first syncs the rows of the others as well
+        with self.verrou_sync:
+            if self.fin_sync < fin:
+                with self.verrou:
+                    cible = self.fin
+                os.fsync(self.flux.fileno())
+                with self.condition:
+                    self.fin_sync = cible
+                    self.condition.notify_all()
+
+    def vider(self) -> None:
+        """Waits until every row logged before the call is written in the database"""
+
+        with self.condition:
+            cible = self.base + self.fin_sync
+            if self.base + self.applique >= cible:
+                return
+            self.presse.set()
+            self.condition.notify_all()
+            while self.base + self.applique < cible and self.is_alive():
+                self.condition.wait(timeout=0.5)
+
+    def arreter(self) -> None:
+        """Writes the pending rows and stops the thread"""
+        self.arret.set()
+        self.presse.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+        self.flux.close()
+        self.lecteur.close()
+
+    def run(self) -> None:
+        """Main loop of the writer"""
+
+        while True:
+            with self.condition:
+                while self.applique >= self.fin_sync and not self.arret.is_set():
+                    self.condition.wait(timeout=0.5)
+                if self.applique >= self.fin_sync:
+                    break
+            self._attendre_lot()
+
+            lot, fin = self._lire_lot()
+
+            # the rows are never dropped: if the database is unavailable, we try again (the
+            # log keeps them in the meantime)
+            while True:
+                try:
+                    self.ecrire(lot)
+                    break
+                except Exception:
+                    logging.exception("Journaled writer: could not write {} rows".format(len(lot)))
+                    if self.arret.is_set():
+                        logging.error("Journaled writer: {} rows left in the log".format(
+                            len(lot)))
+                        return
+                    self.arret.wait(1)
+
+            self._ecrire_offset(fin)
+            with self.condition:
+                self.applique = fin
+                self.condition.notify_all()
+
+            self._compacter()
+
+    def _attendre_lot(self) -> None:
+        """Waits (at most delai_max seconds) for a full batch of rows to be on disk"""
+
+        limite = time.monotonic() + self.delai_max
+        with self.condition:
+            while not (self.presse.is_set() or self.arret.is_set()):
+                # a row is 10 bytes at the very least: counting the bytes is enough to not
+                # wait once a batch is obviously full
+                if self.fin_sync - self.applique >= 10 * self.taille_lot:
+                    break
+                attente = limite - time.monotonic()
+                if attente <= 0:
+                    break
+                self.condition.wait(timeout=min(attente, 0.05))
+
+    def _lire_lot(self):
+        """Reads the next batch of rows on disk
+
+        Returns:
+            list: the rows
+            int: the offset of the end of the batch in the log
+        """
+
+        with self.condition:
+            fin_sync = self.fin_sync
+        self.lecteur.seek(self.applique)
+        lot = []
+        while len(lot) < self.taille_lot and self.lecteur.tell() < fin_sync:
+            lot.append(self.decoder(json.loads(self.lecteur.readline())))
+        if self.lecteur.tell() >= fin_sync:
+            self.presse.clear()
+        return lot, self.lecteur.tell()
+
+    def _compacter(self) -> None:
+        """Empties the log if it is big and every row was written"""
+
+        if self.applique < self.taille_compactage:
+            return
+        with self.verrou_sync:
+            with self.verrou:
+                if self.applique != self.fin:
+                    return
+                # a crash in between makes the log be written again, but never skipped
+                self._ecrire_offset(0)
+                self.flux.truncate(0)
+                os.fsync(self.flux.fileno())
+                with self.condition:
+                    self.base += self.fin
+                    self.fin = self.fin_sync = self.applique = 0
+        logging.info("Write-ahead log {} emptied".format(self.fichier))
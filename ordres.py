@@ -0,0 +1,283 @@
+"""Defines the traversal orders of the sequencer, ie the order in which the points of the grid
+are generated.
+
+An order is a permutation of the positions [0, N) of the sequence into the indexes of the grid
+(the mixed-radix index of the sequencer, the first variable being the fastest one). It is
+computed arithmetically, position by position: the grid is never materialized. With an order
+spreading the points over the whole grid, the first results are representative of the whole
+space, and not of a thin slice of it."""
+
+from typing import List, Tuple
+
+import numpy as np
+
+
+def facteurs_premiers(n: int) -> List[int]:
+    """Returns the prime factors of n, in ascending order (with repetitions)"""
+
+    facteurs = []
+    f = 2
+    while f * f <= n:
+        while n % f == 0:
+            facteurs.append(f)
+            n //= f
+        f += 1
+    if n > 1:
+        facteurs.append(n)
+    return facteurs
+
+
+class Ordre():
+    """A traversal order of the grid of the sequencer; the base class is the sequential order
+    (the odometer order of Sequenceur.suivant())
+
+    An order has to implement two functions
+            -> preparer: sets the permutation up for a grid
+            -> permuter: maps positions of the sequence to indexes in the grid
+    """
+
+    # whether the consecutive positions are consecutive indexes of the grid (which the
+    # sub-grids of Sequenceur.suivant_grille() rely on)
+    contigu = True
+
+    def preparer(self, tailles: List[int]) -> None:
+        """Sets the permutation up for a grid; called each time the sequencer is (re)loaded
+
+        Params:
+            tailles: the number of values of each variable, the first one being the fastest
+        """
+
+        self.nb_points = 1
+        for t in tailles:
+            self.nb_points *= t
+
+    def permuter(self, positions: np.ndarray) -> np.ndarray:
+        """Maps positions of the sequence to indexes in the grid
+
+        Params:
+            positions: an array of positions, all in [0, nb_points)
+
+        Returns:
+            numpy.ndarray: the indexes in the grid, as int64
+        """
+
+        return positions
+
+
+class OrdreChiffres(Ordre):
+    """An order permuting the digits of the positions: the position is decomposed in a
+    mixed radix, and each digit is moved to the place of a digit of the same radix in the index
+    of the grid. Such a permutation is a bijection of [0, N) whatever N.
+
+    An order permuting the digits has to implement one function
+            -> _chiffres: tells where each digit of the position is moved to
+    """
+
+    contigu = False
+
+    def preparer(self, tailles: List[int]) -> None:
+        """See the Ordre class"""
+        Ordre.preparer(self, tailles)
+        # for each digit of the position (the least significant first): its radix and the
+        # weight of the place it is moved to in the index of the grid
+        self.chiffres = self._chiffres(tailles)
+
+    def _chiffres(self, tailles: List[int]) -> List[Tuple[int, int]]:
+        """Tells where each digit of the position is moved to in the index of the grid
+
+        Params:
+            tailles: the number of values of each variable, the first one being the fastest
+
+        Returns:
+            List[Tuple[int, int]]: for each digit of the position, the least significant first,
+                                   its radix and the weight of the place it is moved to
+        """
+
+        raise NotImplementedError
+
+    def permuter(self, positions: np.ndarray) -> np.ndarray:
+        """See the Ordre class"""
+
+        reste = np.array(positions, dtype=np.int64)
+        indices = np.zeros(reste.shape, dtype=np.int64)
+        for base, poids in self.chiffres:
+            indices += (reste % base) * poids
+            reste //= base
+        return indices
+
+
+class OrdreInverse(OrdreChiffres):
+    """The strided bit-reversal order: the index of the grid is the position with its digits
+    in reverse order (exactly a bit-reversal if the grid has 2^n points). The consecutive
+    positions are spread over the whole grid, the slowest variables being swept first."""
+
+    def _chiffres(self, tailles: List[int]) -> List[Tuple[int, int]]:
+        # the digits of the index of the grid, the least significant first
+        chiffres = []
+        poids = 1
+        for t in tailles:
+            for f in facteurs_premiers(t):
+                chiffres.append((f, poids))
+                poids *= f
+        return chiffres[::-1]
+
+
+class OrdreHalton(OrdreChiffres):
+    """The low-discrepancy order: each variable is swept by its own van der Corput sequence
+    (the radical inverse of its index, in the radices given by the prime factors of its
+    number of values), the digits of the position being dealt to the variables in turn. It is
+    to the grid what the Halton sequence is to the continuous space: the first points cover
+    each variable coarsely, the next ones refine them, and each point is generated once.
+
+    The variables which number of values has small prime factors (eg powers of 2) are spread
+    best; a prime number of values is swept in order."""
+
+    def _chiffres(self, tailles: List[int]) -> List[Tuple[int, int]]:
+        # for each variable, its digits from the most significant one (the first one to vary)
+        par_variable = []
+        poids_variable = 1
+        for t in tailles:
+            chiffres = []
+            poids = poids_variable
+            for f in facteurs_premiers(t):
+                chiffres.append((f, poids))
+                poids *= f
+            par_variable.append(chiffres[::-1])
+            poids_variable *= t
+
+        chiffres = []
+        for rang in range(max([len(c) for c in par_variable], default=0)):
+            for c in par_variable:
+                if rang < len(c):
+                    chiffres.append(c[rang])
+        return chiffres
+
+
+class OrdreAleatoire(Ordre):
+    """A seeded random order: a pseudo-random permutation of the grid, computed by a Feistel
+    network on [0, 2^n) restricted to [0, N) by cycle walking (the network is applied again
+    until the result is in the grid). The same seed gives the same order."""
+
+    contigu = False
+    NB_TOURS = 4
+
+    def __init__(self, graine: int = 0):
+        """Initializes the order
+
+        Params:
+            graine: the seed
+        """
+
+        self.graine = graine
+
+    def preparer(self, tailles: List[int]) -> None:
+        """See the Ordre class"""
+        Ordre.preparer(self, tailles)
+        # the network works on halves of an even number of bits
+        nb_bits = max(2, int(self.nb_points - 1).bit_length())
+        nb_bits += nb_bits % 2
+        self.demi = np.uint64(nb_bits // 2)
+        self.masque = np.uint64((1 << (nb_bits // 2)) - 1)
+        alea = np.random.default_rng(self.graine)
+        self.cles = alea.integers(0, 2**63, size=self.NB_TOURS, dtype=np.uint64)
+
+    def _melanger(self, x: np.ndarray, cle: np.uint64) -> np.ndarray:
+        """The round function of the network (a splitmix64 hash of x keyed by cle)"""
+        z = (x + cle) * np.uint64(0x9E3779B97F4A7C15)
+        z ^= z >> np.uint64(30)
+        z *= np.uint64(0xBF58476D1CE4E5B9)
+        z ^= z >> np.uint64(27)
+        return z & self.masque
+
+    def _feistel(self, x: np.ndarray) -> np.ndarray:
+        gauche = x >> self.demi
+        droite = x & self.masque
+        for cle in self.cles:
+            gauche, droite = droite, gauche ^ self._melanger(droite, cle)
+        return (gauche << self.demi) | droite
+
+    def permuter(self, positions: np.ndarray) -> np.ndarray:
+        """See the Ordre class"""
+
+        indices = self._feistel(np.array(positions, dtype=np.uint64))
+        hors = indices >= np.uint64(self.nb_points)
+        while hors.any():
+            indices[hors] = self._feistel(indices[hors])
+            hors = indices >= np.uint64(self.nb_points)
+        return indices.astype(np.int64)
+
+
+class OrdreProgressif(Ordre):
+    """The coarse-to-fine order: the grid is visited in passes, each one halving the step along
+    each variable. The first pass is the first point of the grid, the next one adds every
+    2^(k-1)-th point of each variable (k being such that the variable has at most 2^k+1
+    values: the ends of its range), the next one the points in between, and so on until the
+    last pass, which adds the remaining points of the grid. A pass only visits the points it
+    adds: each point is generated once.
+
+    Even a truncated run thus yields a sample spread over the whole grid, which gets
+    uniformly finer; fins_passes tells where each pass ends in the sequence."""
+
+    contigu = False
+
+    def preparer(self, tailles: List[int]) -> None:
+        """See the Ordre class"""
+
+        Ordre.preparer(self, tailles)
+        self.tailles = tailles
+        # the number of passes needed by each variable to reach a step of 1
+        niveaux = [max(t - 1, 0).bit_length() for t in tailles]
+        self.nb_passes = max(niveaux, default=0) + 1
+
+        # for each pass (rows) and each variable (columns): the step along the variable, the
+        # number of values it takes, and amongst them the ones that were taken by the previous
+        # pass (even ones, in units of the step) and the new ones (odd ones)
+        passes = np.arange(self.nb_passes)[:, np.newaxis]
+        niveaux = np.array(niveaux, dtype=np.int64)[np.newaxis, :]
+        tailles = np.array(tailles, dtype=np.int64)[np.newaxis, :]
+        self.pas = 2 ** np.maximum(niveaux - passes, 0)
+        self.nombres = (tailles - 1) // self.pas + 1
+        # (the variables which step is already 1 only take former values)
+        self.affine = (passes >= 1) & (passes <= niveaux)
+        self.anciens = np.where(self.affine, (self.nombres + 1) // 2, self.nombres)
+        self.nouveaux = np.where(self.affine, self.nombres // 2, 0)
+
+        # the points of a pass are split in classes by their first variable taking a new
+        # value: the variables before it take former values, the ones after it any value
+        nb_variables = len(self.tailles)
+        classes = np.zeros((self.nb_passes, nb_variables), dtype=np.int64)
+        for j in range(nb_variables):
+            classes[:, j] = np.prod(self.anciens[:, :j], axis=1) * self.nouveaux[:, j] * \
+                np.prod(self.nombres[:, j + 1:], axis=1)
+        self.debuts_classes = np.concatenate(
+            [np.zeros((self.nb_passes, 1), dtype=np.int64), np.cumsum(classes, axis=1)], axis=1)
+
+        # the position at which each pass ends (the first pass being the first point)
+        self.fins_passes = np.cumsum([1] + [int(c) for c in classes[1:].sum(axis=1)])
+        self.poids = np.cumprod([1] + [int(t) for t in self.tailles[:-1]])
+
+    def permuter(self, positions: np.ndarray) -> np.ndarray:
+        """See the Ordre class"""
+
+        positions = np.array(positions, dtype=np.int64)
+        passes = np.searchsorted(self.fins_passes, positions, side="right")
+        reste = positions - np.where(passes > 0, self.fins_passes[np.maximum(passes - 1, 0)], 0)
+        classes = (reste[:, np.newaxis] >= self.debuts_classes[passes, 1:]).sum(axis=1)
+        reste -= self.debuts_classes[passes, classes]
+
+        indices = np.zeros(positions.shape, dtype=np.int64)
+        for j in range(len(self.tailles)):
+            # the coordinate along the variable, in units of the step of the pass
+            base = np.where(j < classes, self.anciens[passes, j],
+                            np.where(j == classes, self.nouveaux[passes, j],
+                                     self.nombres[passes, j]))
+            base = np.maximum(base, 1)
+            chiffre = reste % base
+            reste //= base
+            anciens = np.where(self.affine[passes, j], 2 * chiffre, chiffre)
+            coordonnee = np.where(j < classes, anciens,
+                                  np.where(j == classes, 2 * chiffre + 1, chiffre))
+            # the first pass is the first point of the grid
+            coordonnee = np.where(passes == 0, 0, coordonnee)
+            indices += coordonnee * self.pas[passes, j] * self.poids[j]
+        return indices
@@ -0,0 +1,306 @@
+"""Defines the background producer that generates the tasks ahead of the slave servers' demand"""
+
+from typing import Any, Callable, Dict, List, Tuple
+
+import queue
+import threading
+import logging
+import time
+
+import numpy as np
+
+from projet import ProjetCascada
+from seq import deplier_grille
+from completion import CarteCompletion
+from vartypes import csc_var
+
+
+# queued once the sequence is exhausted, so that the consumers waiting for a task wake up
+FIN_SEQUENCE = object()
+
+
+class ProducteurTaches(threading.Thread):
+    """A thread that keeps a bounded queue of ready tasks filled, so that the request handlers
+    don't have to wait for the sequencer, the validator or the database.
+
+    The producer is the only one allowed to call sequenceur.suivant_bloc() (or
+    sequenceur.suivant_grille(), when the tasks are sub-grids). Once the sequence is
+    exhausted, it notifies the dispatcher and parks itself until relancer() is called
+    (typically after the sequencer was reloaded for a new densification scheme)."""
+
+    def __init__(self, projet: ProjetCascada, bdd,
+                 fabrique_tache: Callable[[Dict[str, csc_var]], Any],
+                 taille_max: int = 1024, verrou_sequenceur=None,
+                 signaler_epuisement: Callable[[], None] = None, taille_bloc: int = 64,
+                 taille_grille: int = None):
+        """Initializes the producer
+
+        Params:
+            projet: the cascada project, which sequencer and validator are used to generate the
+                    tasks
+            bdd: the database controller, used to skip the configurations that were already
+                 computed
+            fabrique_tache: a function turning a configuration into a task (eg tacheCalcul),
+                            or a sub-grid (see _generer_grille()) if taille_grille is set
+            taille_max: the maximum number of ready tasks kept in the queue
+            verrou_sequenceur: (optionnal) the lock protecting the sequencer, held while
+                               calling suivant_bloc()
+            signaler_epuisement: (optionnal) called by the producer thread once the sequence
+                                 is exhausted
+            taille_bloc: (optionnal) the number of configurations taken from the sequencer at
+                         once
+            taille_grille: (optionnal) if set, the tasks are sub-grids of at most taille_grille
+                           points instead of single configurations
+        """
+
+        threading.Thread.__init__(self, name="cascada-producteur", daemon=True)
+
+        self.projet = projet
+        self.bdd = bdd
+        self.fabrique_tache = fabrique_tache
+        self.file = queue.Queue(maxsize=taille_max)
+        self.verrou_sequenceur = threading.RLock() if verrou_sequenceur is None \
+            else verrou_sequenceur
+        self.signaler_epuisement = signaler_epuisement
+        self.taille_bloc = taille_bloc
+        self.taille_grille = taille_grille
+        # the configurations taken from the sequencer and not examined yet, and the ones being
+        # examined (both protected by verrou_sequenceur, see en_attente())
+        self.bloc = []
+        self.en_main = None
+        # makes "the sequence is exhausted" and the presence of FIN_SEQUENCE in the queue
+        # change together
+        self.verrou_fin = threading.Lock()
+
+        # the points of the current grid already computed, rebuilt after each reload
+        self.carte = CarteCompletion()
+        self.carte_perimee = True
+        # the points handed out since the start of the densification level, when the boxes
+        # of the level may overlap (None otherwise, see Repartiteur._avancer())
+        self.emis_niveau = None
+
+        self.epuise = threading.Event()     # set once the sequence is exhausted
+        self.relance = threading.Event()    # set to wake up the producer after a reload
+        self.arret = threading.Event()
+
+    def run(self) -> None:
+        """Main loop of the producer"""
+
+        while not self.arret.is_set():
+            if self.epuise.is_set():
+                self.relance.wait(timeout=0.5)
+                self.relance.clear()
+                continue
+
+            try:
+                travail = self._generer()
+            except Exception:
+                # the database might be temporarily unavailable: the consumers just wait
+                logging.exception("Task producer: error while generating a task")
+                self.arret.wait(1)
+                continue
+
+            if travail is None:
+                logging.info("Task producer: sequence exhausted")
+                with self.verrou_fin:
+                    self.epuise.set()
+                    self._deposer(FIN_SEQUENCE)
+                if self.signaler_epuisement is not None:
+                    self.signaler_epuisement()
+            else:
+                self._deposer(self.fabrique_tache(travail))
+                with self.verrou_sequenceur:
+                    self.en_main = None
+
+    def _deposer(self, element) -> None:
+        """Puts element in the queue, waiting for some room if necessary"""
+        while not self.arret.is_set():
+            try:
+                self.file.put(element, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _generer(self) -> Dict[str, csc_var]:
+        """Generates the next valid configuration that is not in the database yet
+
+        Returns:
+            dict: the configuration (a sub-grid if taille_grille is set, see
+                  _generer_grille()), or None if the sequence is exhausted
+        """
+
+        if self.carte_perimee:
+            self._recharger_carte()
+        if self.taille_grille is not None:
+            return self._generer_grille()
+
+        travail = self._suivant()
+        # invalid configurations (for instance, a sqrt that would be computed to be negative)
+        # and configurations that were already computed are skipped
+        while travail is not None and not self._a_calculer(travail):
+            travail = self._suivant()
+        return travail
+
+    def _a_calculer(self, travail: Dict[str, csc_var]) -> bool:
+        """Tells whether a configuration is valid, and neither computed nor handed out yet"""
+        return self.projet.valider(travail) and not self.deja_calcule(travail) and \
+            not self._deja_emis(travail)
+
+    def _suivant(self) -> Dict[str, csc_var]:
+        """Returns the next configuration of the sequence, taking them from the sequencer by
+        blocks
+
+        Returns:
+            dict: the configuration, or None if the sequence is exhausted
+        """
+
+        with self.verrou_sequenceur:
+            if len(self.bloc) == 0:
+                bloc = self.projet.sequenceur.suivant_bloc(self.taille_bloc)
+                if bloc is None:
+                    self.en_main = None
+                    return None
+                types = self.projet.sequenceur.schema
+                # reversed, so that the next configuration is popped from the end
+                self.bloc = [{nom: types[nom](ligne[nom].item()) for nom in bloc.dtype.names}
+                             for ligne in bloc[::-1]]
+            travail = self.bloc.pop()
+            self.en_main = [travail]
+            return travail
+
+    def _generer_grille(self) -> Tuple[int, Dict[str, np.ndarray], Dict[str, type], List[int]]:
+        """Generates the next sub-grid having points that are valid and not in the database yet
+
+        Returns:
+            int: the position of the sub-grid in the sequence
+            dict: the values taken by each variable on the sub-grid
+            dict: the types of the variables
+            list: the indexes of the points to compute
+            or None if the sequence is exhausted
+        """
+
+        while True:
+            with self.verrou_sequenceur:
+                grille = self.projet.sequenceur.suivant_grille(self.taille_grille)
+                if grille is None:
+                    self.en_main = None
+                    return None
+                debut, axes = grille
+                types = self.projet.sequenceur.schema
+                points = [{nom: types[nom](point[nom].item()) for nom in axes}
+                          for point in deplier_grille(axes)]
+                self.en_main = points
+
+            # the sub-grid is handed out as a whole, but the points that are invalid or were
+            # already computed are skipped by the node
+            a_calculer = [i for i, travail in enumerate(points) if self._a_calculer(travail)]
+            if len(a_calculer) > 0:
+                return debut, axes, types, a_calculer
+
+    def _recharger_carte(self) -> None:
+        """Rebuilds the completion bitmap for the grid of the sequencer, from the records
+        already in the database (a single query instead of one per point)"""
+
+        with self.verrou_sequenceur:
+            bornes = self.carte.charger(self.projet.sequenceur)
+        if bornes is not None:
+            self.carte.marquer_tous(self.bdd.enregistrements_dans(bornes))
+            logging.info("Task producer: {} out of {} points already computed".format(
+                self.carte.nb_marques, self.carte.nb_points))
+        self.carte_perimee = False
+
+    def deja_calcule(self, valeurs: Dict[str, csc_var]) -> bool:
+        """Checks whether the configuration was already computed: the database is only asked
+        if the configuration isn't part of the current grid"""
+
+        deja = self.carte.contient(valeurs)
+        if deja is None:
+            return self.bdd.existe(valeurs)
+        return deja
+
+    def _deja_emis(self, valeurs: Dict[str, csc_var]) -> bool:
+        """Checks whether the configuration was already handed out at this level (by a
+        previous box, its result might not be saved yet), and records it if it wasn't"""
+
+        if self.emis_niveau is None:
+            return False
+        clef = tuple([v.value for v in valeurs.values()])
+        if clef in self.emis_niveau:
+            return True
+        self.emis_niveau.add(clef)
+        return False
+
+    def prendre(self, delai: float = None):
+        """Pops a ready task, waiting for the producer if the queue is momentarily empty
+
+        Params:
+            delai: (optionnal) the maximum number of seconds to wait for, forever if None
+
+        Returns:
+            the task, or None if the sequence is exhausted and every task was handed out
+
+        Raises:
+            queue.Empty: if no task was produced within delai seconds
+        """
+
+        limite = None if delai is None else time.monotonic() + delai
+        while True:
+            attente = 0.5 if limite is None else min(0.5, limite - time.monotonic())
+            if attente <= 0:
+                raise queue.Empty
+            try:
+                tache = self.file.get(timeout=attente)
+            except queue.Empty:
+                continue
+            if tache is FIN_SEQUENCE:
+                with self.verrou_fin:
+                    if not self.epuise.is_set():
+                        # the producer was restarted in the meantime: this one is stale
+                        continue
+                    # left for the other consumers (there is room: the producer is parked)
+                    self.file.put(FIN_SEQUENCE)
+                return None
+            return tache
+
+    def relancer(self) -> None:
+        """Wakes up the producer once the sequencer has been reloaded"""
+        with self.verrou_fin:
+            # the tasks of the previous scheme might not all be handed out yet: only
+            # FIN_SEQUENCE is removed (the producer is parked, nobody else adds to the queue)
+            restantes = []
+            while True:
+                try:
+                    tache = self.file.get_nowait()
+                except queue.Empty:
+                    break
+                if tache is not FIN_SEQUENCE:
+                    restantes.append(tache)
+            for tache in restantes:
+                self.file.put_nowait(tache)
+            self.epuise.clear()
+            self.carte_perimee = True
+        self.relance.set()
+
+    def arreter(self) -> None:
+        """Stops the producer"""
+        self.arret.set()
+        self.relance.set()
+
+    def en_attente(self) -> List[Dict[str, csc_var]]:
+        """Returns the configurations taken from the sequencer that weren't handed out yet
+        (queued, or still being examined); the same configuration may be listed twice
+
+        Note:
+            To be called with verrou_sequenceur held
+        """
+
+        with self.file.mutex:
+            taches = [t for t in self.file.queue if t is not FIN_SEQUENCE]
+        configurations = [c for t in taches for c in t.configurations()] + list(self.bloc)
+        if self.en_main is not None:
+            configurations.extend(self.en_main)
+        return configurations
+
+    def taille(self) -> int:
+        """Returns the number of ready tasks in the queue"""
+        return max(0, self.file.qsize() - (1 if self.epuise.is_set() else 0))
@@ -15,7 +15,8 @@ class ProjetCascada():
                  facteur_selection: float, facteur_amplification: float,
                  password: str,
                  alogrithm: str = "UNKNOWN",
-                 validateur_entree: Callable[[Dict[str, csc_var]], bool] = lambda x: True):
+                 validateur_entree: Callable[[Dict[str, csc_var]], bool] = lambda x: True,
+                 moteur_bdd: str = "mysql"):
         """Initializes the cascada project
 
             Params:
@@ -38,6 +39,9 @@ class ProjetCascada():
                 validateur_entree: (optionnal) a function that is going to be called to check
                                     the validity of the result returned by the client if applicable;
                                     defaults to a function that accepts anything
+                moteur_bdd: (optionnal) where the results are stored: "mysql" (the server
+                                    described in db_cred.json) or "sqlite" (the embedded
+                                    database <nom_projet>.sqlite3); defaults to "mysql"
         """
 
         self.sequenceur = sequenceur
@@ -57,6 +61,7 @@ class ProjetCascada():
         self.password = password
         self.algo = alogrithm
         self.valider = validateur_entree
+        self.moteur_bdd = moteur_bdd
 
     def __str__(self):
         return self.nom
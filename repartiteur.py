@@ -0,0 +1,816 @@
+"""Defines the dispatcher, which holds the state of the server (sessions, tasks, sequencer) and
+hands out the tasks to the nodes.
+
+Its state is protected by several locks, so that the request handlers can run in parallel
+threads:
+    -> verrou_sessions: the sessions (sessions_maitres and compteur_utilisation_noms)
+    -> clientMaitre.verrou: the nodes of a slave server and their status
+    -> verrou_sequenceur: the sequencer and the densification state
+    -> verrou_baux: the lease table, the tasks to hand out again and the tasks' holders
+    -> the database controller has its own lock
+When several of them are needed, they must be taken in that order.
+
+The changes of densification scheme and of densification level are never made by the
+request handlers: they are driven by a background thread (see etatRepartition), and
+the requests made in the meantime are told to come back later (A_REESSAYER)."""
+
+from typing import Dict, List, Tuple, Type
+from enum import Enum
+import copy
+import queue
+import random
+import time
+import logging
+import threading
+
+import numpy as np
+
+from projet import ProjetCascada
+from producteur import ProducteurTaches
+from baux import TableBaux
+from seq import deplier_grille, type_numpy
+from vartypes import csc_var
+
+
+def bornes_sequenceur(sequenceur) -> Dict[str, Tuple[float, float, int]]:
+    """Returns the (start, end, number of iterations) of each variable of the sequencer, as
+    given to Sequenceur.recharger_bornes_pas()"""
+    return {n: tuple([v.item() if hasattr(v, "item") else v for v in c[:3]])
+            for n, c in sequenceur.schema_compteurs.items()}
+
+
+class statutClient(Enum):
+    NON_CONNECTE = 0
+    CONNECTE = 1
+    TIMEOUT = 2
+
+
+class statutNoeud(Enum):
+    INACTIF = 0
+    MORT = 2
+    PAUSE = 3
+    ACTIF = 4
+
+
+class etatRepartition(Enum):
+    """The states of the dispatcher, which go:
+        PRODUCTION -> CHANGEMENT_SCHEMA -> PRODUCTION (next candidate box of the same level)
+                                        -> ATTENTE_FIN_NIVEAU -> DENSIFICATION -> PRODUCTION
+                                        -> TERMINE
+    """
+    PRODUCTION = 0          # the producer generates the tasks of the current scheme
+    CHANGEMENT_SCHEMA = 1   # the sequencer is being reloaded with the next candidate box
+    ATTENTE_FIN_NIVEAU = 2  # every box of the level was handed out, waiting for the results
+    DENSIFICATION = 3       # the candidate boxes of the next level are being selected
+    TERMINE = 4             # there is no more work to allocate
+
+
+# returned by Repartiteur.obtenir_tache() when no task is ready yet
+A_REESSAYER = object()
+
+
+class tacheCalcul():
+    """A computation task, assigned to a node"""
+
+    def __init__(self, valeurs: Dict[str, csc_var] = {}):
+        """Initializes the task
+
+        Params:
+            valeurs: dictionnary with keys being the variables' name and value their value
+        """
+
+        # The variables used to make the computation, generatd by the code and sent to the node
+        self.valeurs = valeurs
+        self.demandeur = ""
+        self.date_creation = int(time.time())
+        self.date_derniere_allocation = self.date_creation
+        self.norealloc = False   # used to cannibalize (ie protect from deadlocks)
+        # if A -> task T1
+        #    B -> task T2
+        #    C -> task T1
+        # A ends and is given T2
+        # B ends and is given T1
+        # C ends and is given T2
+        #  ->> Deadlock
+        self.nb_detenteurs = 0   # number of nodes the task is allocated to
+        self.bail_actif = False  # used by the lease table (see TableBaux)
+        self.version_bail = 0
+
+    def versdict(self) -> Dict[str, csc_var]:
+        """Returns a dictionary which structure is akin to the one from the dictionnary supplied in init
+
+        Returns:
+            dict: dictionnary with keys being the variables' name and value their value
+        """
+        return self.valeurs
+
+    def configurations(self) -> List[Dict[str, csc_var]]:
+        """Returns the configurations computed by the task (a single one)"""
+        return [self.valeurs]
+
+    def __str__(self):
+        return ", ".join(["{} = {}".format(var, val) for var, val in self.valeurs.items()])
+
+    def realloc(self) -> None:
+        """Updates the last allocation date of the task"""
+        self.date_derniere_allocation = int(time.time())
+
+
+class tacheGrille(tacheCalcul):
+    """A computation task covering a whole sub-grid of the sequence (see
+    Sequenceur.suivant_grille()), computed as a single unit by the node: it is leased,
+    cannibalized and handed out again as a whole"""
+
+    def __init__(self, debut: int, axes: Dict[str, np.ndarray],
+                 types: Dict[str, Type[csc_var]], a_calculer: List[int]):
+        """Initializes the task
+
+        Params:
+            debut: the position of the first point of the sub-grid in the sequence, None if
+                   the sub-grid doesn't come from the sequencer (eg a task restored from a
+                   checkpoint)
+            axes: the values taken by each variable on the sub-grid, the first variable being
+                  the fastest one
+            types: the types of the variables
+            a_calculer: the indexes (in the expanded sub-grid) of the points to compute; the
+                        other ones are invalid, or already computed
+        """
+
+        tacheCalcul.__init__(self, {})
+        self.debut = debut
+        self.axes = axes
+        self.types = types
+        self.a_calculer = a_calculer
+        self.nb_points = 1
+        for valeurs in axes.values():
+            self.nb_points *= len(valeurs)
+
+    def versdict(self) -> Dict:
+        """Returns the description of the sub-grid sent to the node
+
+        Returns:
+            dict: {"grid": {"variables": the variables, the first one being the fastest,
+                            "values": {'<var name>': the values it takes},
+                            "first": the position of the first point in the sequence,
+                            "count": the number of points,
+                            "skip": the indexes of the points that must not be computed}}
+        """
+
+        calcules = set(self.a_calculer)
+        return {"grid": {
+            "variables": list(self.axes.keys()),
+            "values": {nom: valeurs.tolist() for nom, valeurs in self.axes.items()},
+            "first": self.debut,
+            "count": self.nb_points,
+            "skip": [i for i in range(self.nb_points) if i not in calcules]}}
+
+    def configurations(self) -> List[Dict[str, csc_var]]:
+        """Returns the configurations computed by the task, in the order of the sub-grid"""
+        points = deplier_grille(self.axes)[self.a_calculer]
+        return [{nom: self.types[nom](point[nom].item()) for nom in self.axes}
+                for point in points]
+
+    def __str__(self):
+        return "{} points, ".format(len(self.a_calculer)) + ", ".join(
+            ["{} in [{}, {}]".format(nom, valeurs[0], valeurs[-1]) if len(valeurs) > 1
+             else "{} = {}".format(nom, valeurs[0]) for nom, valeurs in self.axes.items()])
+
+
+class NoeudCalcul():
+    """A computation unit running on the slave server (ie master client)
+
+    Its status is protected by the lock of the slave server it belongs to."""
+
+    def __init__(self, repartiteur, nom="unnamed-node"):
+        self.repartiteur = repartiteur
+        self.statut = statutNoeud.INACTIF
+        self.nom = nom
+        self.tache_calcul = None
+
+    def __str__(self):
+        return str(
+            self.statut.value) + " [{}]".format(
+            self.tache_calcul) if self.statut != statutNoeud.INACTIF else str(
+            self.statut.value)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def abandonner_tache(self) -> None:
+        if self.statut == statutNoeud.ACTIF:
+            self.statut = statutNoeud.INACTIF
+            # normally it shouldn't happen to have a None task as a status
+            # buuut we never know
+            if self.tache_calcul is not None:
+                self.repartiteur.rendre_tache(self.tache_calcul)
+                self.tache_calcul = None
+
+    def charger_tache(self, tache) -> None:
+        self.tache_calcul = tache
+        self.statut = statutNoeud.ACTIF
+        self.repartiteur.louer_tache(tache)
+
+    def terminer_tache(self) -> None:
+        """Marks the task of the node as done: it will never be reallocated"""
+        self.statut = statutNoeud.INACTIF
+        if self.tache_calcul is not None:
+            self.repartiteur.cloturer_tache(self.tache_calcul)
+            self.tache_calcul = None
+
+
+class clientMaitre():
+    """A slave server that manages several computation units"""
+
+    def __init__(self, repartiteur, nom: str, token: str, keepalive: int = 0,
+                 statut: statutClient = statutClient.NON_CONNECTE):
+        """Initializes a slave server
+
+        Params:
+            repartiteur: the dispatcher the slave server is connected to
+            nom: the name of the server
+            token: an authentification token for the slave server
+            keepalive: the last epoch an action related to the slave server was performed
+            statut: the status of the slave server
+        """
+
+        self.repartiteur = repartiteur
+        self.nom = nom
+        self.nom_base = nom  # the name the client asked for, see compteur_utilisation_noms
+        self.token = token
+        self.statut = statut
+        self.dernier_keepalive = keepalive
+        self.noeuds = {}
+        self.nb_noeuds_ajoutes = 0
+        self.verrou = threading.RLock()
+
+    def deconnecter(self) -> None:
+        """Disconnects the slave server (ie closes its session)"""
+        self.repartiteur.fermer_session(self)
+
+    def ajouter_noeud(self) -> None:
+        """Allocates a new computation node on the slave server"""
+        with self.verrou:
+            nom_noeud = self.nom + "#" + str(self.nb_noeuds_ajoutes + 1)
+            self.noeuds[nom_noeud] = NoeudCalcul(self.repartiteur, nom=nom_noeud)
+            self.nb_noeuds_ajoutes += 1
+        return nom_noeud
+
+    def liste_noeuds(self) -> List[Tuple[str, NoeudCalcul]]:
+        """Lists the avaible nodes for the slave slave"""
+        with self.verrou:
+            return [(num, noeud) for num, noeud in self.noeuds.items()]
+
+    def recuperer_noeud(self, idnoeud: str) -> NoeudCalcul:
+        """Returns the computation node matching the id idnoeud
+
+        Params:
+            idnoeud: the id of the node
+        """
+
+        try:
+            return self.noeuds[idnoeud]
+        except Exception as e:
+            raise e
+
+
+class Repartiteur():
+    """The dispatcher: keeps track of the slave servers and of the tasks"""
+
+    def __init__(self, projet: ProjetCascada, bdd, taille_file_taches: int = 1024,
+                 delai_attente_tache: float = 0.2, taille_grille: int = None):
+        """Initializes the dispatcher
+
+        Params:
+            projet: the cascada project
+            bdd: the database controller
+            taille_file_taches: the number of tasks generated ahead of the slave servers' demand
+            delai_attente_tache: the maximum number of seconds a request waits for the producer
+                                 before being told to come back later
+            taille_grille: (optionnal) if set, each task is a sub-grid of at most that many
+                           points (see tacheGrille) instead of a single point; the number of
+                           points generated ahead stays about taille_file_taches
+        """
+
+        self.projet = projet
+        self.bdd = bdd
+
+        self.verrou_sessions = threading.RLock()
+        self.verrou_baux = threading.RLock()
+        self.verrou_sequenceur = threading.RLock()
+
+        self.sessions_maitres = {}
+        self.compteur_utilisation_noms = {}
+
+        # Sometimes it might be possible that we decide the taks has to bo accomplished again,
+        # so we keep track of them in the following stack
+        self.taches_a_redistribuer = []
+
+        # The tasks currently allocated to the nodes, used to find the task to cannibalize
+        self.baux = TableBaux()
+        self.nb_cannibalisations = 0
+        self.nb_taches_en_transit = 0   # handed out by obtenir_tache(), not loaded yet
+        # notified when a task is no longer in transit; while gel_transit is set (during a
+        # checkpoint), no task can get in transit
+        self.condition_transit = threading.Condition(self.verrou_baux)
+        self.gel_transit = False
+
+        self.delai_attente_tache = delai_attente_tache
+        self.taille_grille = taille_grille
+        ordre = projet.sequenceur.ordre
+        if taille_grille is not None and ordre is not None and not ordre.contigu:
+            raise ValueError("The sub-grids require the sequential order")
+        if taille_grille is None:
+            fabrique_tache = tacheCalcul
+        else:
+            def fabrique_tache(grille):
+                return tacheGrille(*grille)
+            taille_file_taches = max(1, taille_file_taches // taille_grille)
+        self.producteur = ProducteurTaches(projet, bdd, fabrique_tache, taille_file_taches,
+                                           verrou_sequenceur=self.verrou_sequenceur,
+                                           signaler_epuisement=self.signaler_transition,
+                                           taille_grille=taille_grille)
+
+        # The scheme and level changes are made by this thread, see _avancer()
+        self.etat = etatRepartition.PRODUCTION
+        self.schema_prepare = None  # the next candidate box of the level
+        self.schema_pret = False    # whether schema_prepare was computed
+        self.evenement_transition = threading.Event()
+        self.arret = threading.Event()
+        self.transitions = threading.Thread(target=self._boucle_transitions,
+                                            name="cascada-transitions", daemon=True)
+
+    def demarrer(self) -> None:
+        """Starts the producer and transition threads"""
+        self.producteur.start()
+        self.transitions.start()
+
+    def arreter(self) -> None:
+        """Stops the producer and transition threads"""
+        self.arret.set()
+        self.evenement_transition.set()
+        self.producteur.arreter()
+
+    # Checkpoints
+
+    def etat_reprise(self) -> Dict:
+        """Captures the state needed to resume the execution after a restart (see
+        restaurer()): the position of the sequencer and the scheme it enumerates, the
+        densification state, and the configurations handed out but not computed yet (leased,
+        to hand out again, or generated ahead by the producer)
+
+        Returns:
+            dict: the state, which can be serialized in JSON
+        """
+
+        projet = self.projet
+        with self.verrou_sequenceur:
+            with self.condition_transit:
+                # the tasks in transit are about to be leased (or handed out again): we wait
+                # for them, no other task can get in transit in the meantime
+                self.gel_transit = True
+                try:
+                    self.condition_transit.wait_for(lambda: self.nb_taches_en_transit == 0)
+                    configurations = [c for t in self.baux.taches() + self.taches_a_redistribuer
+                                      for c in t.configurations()]
+                finally:
+                    self.gel_transit = False
+                    self.condition_transit.notify_all()
+            # the producer can't take new configurations from the sequencer in the meantime
+            configurations += self.producteur.en_attente()
+
+            sequenceur = projet.sequenceur
+            return {
+                "sequenceur": {"bornes": bornes_sequenceur(sequenceur),
+                               "position": sequenceur.nb_iters_realisees},
+                "ancien_sequenceur": None if projet.ancien_sequenceur is None
+                else bornes_sequenceur(projet.ancien_sequenceur),
+                "nb_densifications_effectuees": projet.nb_densifications_effectuees,
+                "execution_terminee": projet.execution_terminee,
+                "bdd": self.bdd.etat_densification(),
+                "schema_prepare": self.schema_prepare if self.schema_pret else None,
+                "niveau_chevauchant": self.producteur.emis_niveau is not None,
+                "taches": [{n: v.value for n, v in c.items()} for c in configurations]
+            }
+
+    def restaurer(self, etat: Dict) -> None:
+        """Restores the state captured by etat_reprise(); to be called before demarrer(),
+        once the database controller is opened
+
+        Params:
+            etat: the state
+        """
+
+        projet = self.projet
+        projet.nb_densifications_effectuees = etat["nb_densifications_effectuees"]
+        projet.execution_terminee = etat["execution_terminee"]
+
+        # the sequencer jumps right to where it was, instead of enumerating the scheme again
+        projet.sequenceur.recharger_bornes_pas(etat["sequenceur"]["bornes"])
+        projet.sequenceur.aller_a(etat["sequenceur"]["position"])
+        if etat["ancien_sequenceur"] is not None:
+            projet.ancien_sequenceur = copy.deepcopy(projet.sequenceur)
+            projet.ancien_sequenceur.recharger_bornes_pas(etat["ancien_sequenceur"])
+
+        self.bdd.restaurer_densification(etat["bdd"])
+        if etat["schema_prepare"] is not None:
+            self.schema_prepare = {n: tuple(v) for n, v in etat["schema_prepare"].items()}
+            self.schema_pret = True
+        if etat["niveau_chevauchant"]:
+            self.producteur.emis_niveau = set()
+        if projet.execution_terminee:
+            self.etat = etatRepartition.TERMINE
+
+        # the configurations that were handed out are handed out again, unless their results
+        # arrived in the meantime
+        types = projet.sequenceur.schema
+        vues = set()
+        for valeurs in etat["taches"]:
+            clef = tuple(sorted(valeurs.items()))
+            if clef in vues:
+                continue
+            vues.add(clef)
+            configuration = {n: types[n](v) for n, v in valeurs.items()}
+            if projet.valider(configuration) and not self.bdd.existe(configuration):
+                self.taches_a_redistribuer.append(self._tache_isolee(configuration))
+        logging.info("Dispatcher restored: {} tasks to hand out again, sequencer at {}/{}".format(
+            len(self.taches_a_redistribuer), projet.sequenceur.nb_iters_realisees,
+            projet.sequenceur.nb_iters_total))
+
+    def _tache_isolee(self, configuration: Dict[str, csc_var]) -> tacheCalcul:
+        """Builds the task computing a single configuration, as a sub-grid of one point if the
+        tasks are sub-grids"""
+
+        if self.taille_grille is None:
+            return tacheCalcul(configuration)
+        types = self.projet.sequenceur.schema
+        axes = {nom: np.array([v.value], dtype=type_numpy(types[nom]))
+                for nom, v in configuration.items()}
+        return tacheGrille(None, axes, types, [0])
+
+    # Sessions
+
+    def ouvrir_session(self, nom: str) -> clientMaitre:
+        """Registers a new slave server
+
+        Params:
+            nom: the name suggested by the slave server; a suffix is added if it is already used
+
+        Returns:
+            clientMaitre: the new slave server, with its authentification token
+        """
+
+        with self.verrou_sessions:
+            # we create a master auth token for the client
+            token_session = str(random.randint(0, 2**255 - 1))
+            while token_session in self.sessions_maitres:
+                token_session = str(random.randint(0, 2**255 - 1))
+
+            # guarantees the name's unicity
+            nom_base = nom
+            if nom not in self.compteur_utilisation_noms:
+                self.compteur_utilisation_noms[nom] = 0
+            else:
+                self.compteur_utilisation_noms[nom] += 1
+                nom = nom + "-" + str(self.compteur_utilisation_noms[nom])
+
+            client = clientMaitre(self, nom, token_session, keepalive=int(time.time()),
+                                  statut=statutClient.CONNECTE)
+            client.nom_base = nom_base
+            self.sessions_maitres[token_session] = client
+        return client
+
+    def recuperer_client(self, token: str) -> clientMaitre:
+        """Returns the slave server matching the token, or None"""
+        with self.verrou_sessions:
+            return self.sessions_maitres.get(token)
+
+    def liste_clients(self) -> List[clientMaitre]:
+        """Returns the slave servers currently connected"""
+        with self.verrou_sessions:
+            return list(self.sessions_maitres.values())
+
+    def fermer_session(self, client: clientMaitre) -> None:
+        """Closes the session of the slave server; the tasks of its nodes are handed out again
+
+        Params:
+            client: the slave server
+        """
+
+        with self.verrou_sessions:
+            self.sessions_maitres.pop(client.token, None)
+
+            # the name can be reused once no other session derives from it
+            if not any(c.nom_base == client.nom_base for c in self.sessions_maitres.values()):
+                self.compteur_utilisation_noms.pop(client.nom_base, None)
+
+        with client.verrou:
+            # no task can be loaded on its nodes any more (see charger_tache())
+            if client.statut == statutClient.CONNECTE:
+                client.statut = statutClient.NON_CONNECTE
+            for noeud in client.noeuds.values():
+                noeud.abandonner_tache()
+
+    def expirer_sessions(self, temps_max_keepalive: int) -> int:
+        """Closes the sessions of the slave servers that haven't been heard of for more than
+        temps_max_keepalive seconds; the tasks of their nodes are handed out again
+
+        Params:
+            temps_max_keepalive: the timeout, in seconds
+
+        Returns:
+            int: the number of sessions that were closed
+        """
+
+        limite = int(time.time()) - temps_max_keepalive
+        with self.verrou_sessions:
+            expires = [c for c in self.sessions_maitres.values() if c.dernier_keepalive < limite]
+            for client in expires:
+                client.statut = statutClient.TIMEOUT
+                self.fermer_session(client)
+                logging.info("Slave server {} timed out".format(client.nom))
+        return len(expires)
+
+    # Tasks
+
+    def louer_tache(self, tache: tacheCalcul) -> None:
+        """Records that the task was loaded by one more node"""
+        with self.verrou_baux:
+            tache.nb_detenteurs += 1
+            self.baux.ajouter(tache)
+
+    def rendre_tache(self, tache: tacheCalcul) -> None:
+        """Records that a node gave up on the task, which will be handed out again unless
+        another node is still working on it or already computed it (it was cannibalized)"""
+        with self.verrou_baux:
+            tache.nb_detenteurs -= 1
+            if tache.nb_detenteurs <= 0:
+                self.baux.retirer(tache)
+                if not tache.norealloc:
+                    self.taches_a_redistribuer.append(tache)
+                elif len(self.baux) == 0:
+                    self.signaler_transition()
+
+    def cloturer_tache(self, tache: tacheCalcul) -> None:
+        """Records that the task was computed: it will never be reallocated"""
+        with self.verrou_baux:
+            tache.norealloc = True
+            tache.nb_detenteurs -= 1
+            self.baux.retirer(tache)
+            for valeurs in tache.configurations():
+                self.producteur.carte.marquer(valeurs)
+            if len(self.baux) == 0:
+                # the level might be over
+                self.signaler_transition()
+
+    def charger_tache(self, client: clientMaitre, noeud: NoeudCalcul,
+                      tache: tacheCalcul) -> bool:
+        """Loads the task on the node if it is still idle; if it isn't (another request
+        got to it first), or if the session of the slave server was closed in the meantime
+        (eg it timed out), the task is handed out again
+
+        Returns:
+            bool: True if the task was loaded
+        """
+
+        with client.verrou:
+            if client.statut == statutClient.CONNECTE and noeud.statut == statutNoeud.INACTIF:
+                noeud.charger_tache(tache)
+                with self.verrou_baux:
+                    self._fin_transit()
+                return True
+
+        with self.verrou_baux:
+            self._fin_transit()
+            if tache.nb_detenteurs <= 0 and not tache.norealloc:
+                self.taches_a_redistribuer.append(tache)
+            elif len(self.baux) == 0:
+                self.signaler_transition()
+        return False
+
+    def _fin_transit(self) -> None:
+        """Records that a task is no longer in transit; to be called with verrou_baux held"""
+        self.nb_taches_en_transit -= 1
+        self.condition_transit.notify_all()
+
+    def obtenir_tache(self):
+        """Very important function, that finds the next task to allocate
+        The code might seem long, but it's heavily commented
+
+        Returns:
+            tacheCalcul: the task to allocate, None if there is no more work to allocate or
+                         A_REESSAYER if no task is ready yet (the next scheme is being loaded,
+                         or the level is over and the results are awaited)
+
+        Note:
+            The task returned must then be given to charger_tache()
+        """
+
+        # Until it is loaded on a node, the task is counted as "in transit", so that the level
+        # doesn't change in the meantime. It is counted before being popped: the transition
+        # thread never sees a task that is neither queued, in transit nor leased
+        with self.condition_transit:
+            while self.gel_transit:
+                self.condition_transit.wait()
+            self.nb_taches_en_transit += 1
+        work = self._obtenir_tache()
+        if work is None or work is A_REESSAYER:
+            with self.verrou_baux:
+                self._fin_transit()
+                if len(self.baux) == 0:
+                    self.signaler_transition()
+        return work
+
+    def _obtenir_tache(self):
+
+        # First off, we have to check whether we have rejected tasks that could be allocated
+        # If that's not the case, we take the next task generated from the sequencer
+        # The tasks coming from the sequencer are generated, validated and checked against the
+        # database ahead of time by the producer thread: we only have to pop one
+        with self.verrou_baux:
+            if len(self.taches_a_redistribuer) > 0:
+                work = self.taches_a_redistribuer.pop()
+                print("Work {} fetched from rejections stack".format(work))
+                return work
+
+        try:
+            work = self.producteur.prendre(self.delai_attente_tache)
+        except queue.Empty:
+            # the producer is lagging behind, or a new scheme is being loaded: we don't
+            # keep the request waiting
+            return A_REESSAYER
+        if work is not None:
+            # the task might have waited in the queue for a while
+            work.realloc()
+            return work
+
+        # The sequence is exhausted, which is only a short pause if the next candidate
+        # box of the level is being loaded
+        etat = self.etat
+        if etat not in (etatRepartition.ATTENTE_FIN_NIVEAU, etatRepartition.TERMINE):
+            return A_REESSAYER
+
+        # There's no rejected task to distribute and every box of the level was handed out :/
+        # We start "cannibalizing" the task by reallocated the oldest task
+        # (which client might have stalled) to work-hungry newcomers
+        # The lease table keeps the allocated tasks ordered by their last allocation date
+        with self.verrou_baux:
+            tache_ancienne = self.baux.plus_ancienne()
+
+            if tache_ancienne is not None:
+                # Met à jour la date de dernière allocation
+                # the lease is moved right away, so that concurrent requests pick other tasks
+                print("Cannibalizing {}".format(tache_ancienne))
+                tache_ancienne.realloc()
+                self.baux.ajouter(tache_ancienne)
+                self.nb_cannibalisations += 1
+                return tache_ancienne
+
+        # Everybody's done: either the next level is about to be prepared, or there is
+        # no more work at all
+        if etat == etatRepartition.TERMINE:
+            return None
+        return A_REESSAYER
+
+    # Scheme and level changes
+
+    def signaler_transition(self) -> None:
+        """Wakes up the transition thread, for instance when the sequence is exhausted or
+        when the last lease was released"""
+        self.evenement_transition.set()
+
+    def _boucle_transitions(self) -> None:
+        """Main loop of the transition thread"""
+
+        while not self.arret.is_set():
+            # the timeout is only a safety net, the thread is normally woken up
+            self.evenement_transition.wait(timeout=1)
+            self.evenement_transition.clear()
+            if self.arret.is_set():
+                break
+            try:
+                self._avancer()
+            except Exception:
+                # the database might be temporarily unavailable: we try again later
+                logging.exception("Dispatcher: error while changing of scheme")
+                self.arret.wait(1)
+                self.signaler_transition()
+
+    def _avancer(self) -> None:
+        """Makes the dispatcher's state machine progress as far as it can.
+        Called by the transition thread only, never by a request handler."""
+
+        projet = self.projet
+        bdd = self.bdd
+        with self.verrou_sequenceur:
+            # each iteration either reloads a scheme, or waits for an event, or densifies
+            while self.producteur.epuise.is_set() and self.etat != etatRepartition.TERMINE:
+                if bdd.densification_en_cours():
+                    # the next candidate box of the level, if there is one (it is normally
+                    # prepared while the previous one is being computed)
+                    self.etat = etatRepartition.CHANGEMENT_SCHEMA
+                    if self.schema_pret:
+                        boite = self.schema_prepare
+                    else:
+                        boite = bdd.schema_suivant(projet.schema_densification)
+                    self.schema_pret = False
+                    self.schema_prepare = None
+                    if self._recharger_schema(boite):
+                        self.etat = etatRepartition.PRODUCTION
+                        break
+
+                if projet.nb_densifications_effectuees >= projet.nb_densifications:
+                    # what if the densification doesn't happen (because of an error for
+                    # instance) ? in that special case, the execution ends as well
+                    self.etat = etatRepartition.TERMINE
+                    logging.warning("Done, no more tasks to allocate !")
+                    projet.execution_terminee = True
+                    return
+
+                # The results of the whole level are needed to select the boxes of the next
+                # one: we wait for the tasks still allocated (they get cannibalized)
+                self.etat = etatRepartition.ATTENTE_FIN_NIVEAU
+                with self.verrou_baux:
+                    if len(self.baux) > 0 or len(self.taches_a_redistribuer) > 0 or \
+                            self.nb_taches_en_transit > 0 or self.producteur.taille() > 0:
+                        return
+
+                self.etat = etatRepartition.DENSIFICATION
+                bdd.densifier(projet.facteur_selection, projet.var_densification)
+                # We keep the old sequencer as we will need it to know the number of
+                # iterations for each variable (the sequencer is reloaded after each
+                # scheme change, if we have 2 level 2 schemes, the 2nd scheme whould use
+                # the data from the first level 2 scheme if we did not save the father
+                # (here, it's the level 1 scheme))
+                projet.ancien_sequenceur = copy.deepcopy(projet.sequenceur)
+                projet.nb_densifications_effectuees += 1
+                # the boxes of the new level may overlap, and the next one is produced before
+                # the results of the previous one are in
+                self.producteur.emis_niveau = set()
+            else:
+                return
+
+            # The producer is running again: we select the next candidate box in the
+            # meantime (the candidates are bounded in memory, see Stockage.schema_suivant(),
+            # so the producer isn't blocked for long)
+            self.schema_prepare = bdd.schema_suivant(projet.schema_densification)
+            self.schema_pret = True
+
+    def _recharger_schema(self, resultat_dens: Dict) -> bool:
+        """Reloads the sequencer with the next densification scheme
+
+        Params:
+            resultat_dens: the candidate box, as returned by bdd.schema_suivant()
+
+        Returns:
+            bool: True if the sequencer was reloaded, False if the level has no more scheme
+
+        Note:
+            To be called with verrou_sequenceur held
+        """
+
+        projet = self.projet
+
+        # if we've already started a densification sequence, we reload the new scheme
+        # the DB returns a dictionnary which shape is:
+        # {'<var name>': (central value, start, end), ...}
+        # we don't really need the central value, but we do need the number of iterations
+        # (which is not supplied)
+        # we get it by looking throught the scheme
+        nouv_sch = {}
+        if resultat_dens:  # Watch out for the None case !
+            nombre_valeurs_differentes = 0
+
+            # We start by counting the number of variables having differents limits
+            # This number can be interpreted as the number of dimensions in the
+            # densification space
+            # Then, knowing the volume of the densification hyperrectangle
+            # (it is multiplied by projet.facteur_amplification) we can guess
+            # the length of the edges (ie the number of iterations)
+            for xn, xv in resultat_dens.items():
+                if xv[1] != xv[2]:
+                    nombre_valeurs_differentes += 1
+
+            # If nombre_valeurs_differentes is 0, we have an issue for the computation
+            nombre_valeurs_differentes = max(1, nombre_valeurs_differentes)
+            for xn, xv in resultat_dens.items():
+                if xv[1] != xv[2]:
+                    nouv_sch[xn] = (
+                        xv[1], xv[2], int(
+                            projet.facteur_amplification**(
+                                1 / nombre_valeurs_differentes)
+                            * projet.ancien_sequenceur.nb_iters_pour_variable(xn)))
+                else:
+                    # If <start> = <end>, there is no use in iterating
+                    # Note: we reload only the values specified in the densification scheme,
+                    # so if there are variables that were made not to be densified
+                    # (for instance dummy variables made to repeat the same computation
+                    # several times), an easy solution is not to include them in the
+                    # densification scheme
+                    nouv_sch[xn] = (xv[1], xv[2], 1)
+            logging.info("\tReloading a new scheme {}".format(nouv_sch))
+            # the producer is parked since the sequence is exhausted: we can safely
+            # reload the sequencer before waking it up
+            projet.sequenceur.recharger_bornes_pas(nouv_sch)
+            self.producteur.relancer()
+            return True
+        return False
@@ -0,0 +1,48 @@
+"""Defines the checkpoint file, where the state of the dispatcher is saved periodically so that
+the server can resume its execution after a restart (see Repartiteur.etat_reprise())"""
+
+from typing import Dict
+
+import json
+import logging
+import os
+
+
+def ecrire_point_reprise(fichier: str, etat: Dict) -> None:
+    """Saves the state in the checkpoint file
+
+    The file is replaced at once: after a crash, it holds either the previous checkpoint or
+    the new one, never a mix of both
+
+    Params:
+        fichier: the path of the checkpoint file
+        etat: the state, as returned by Repartiteur.etat_reprise()
+    """
+
+    temporaire = fichier + ".tmp"
+    with open(temporaire, "w") as f:
+        # the values may be NumPy scalars
+        json.dump(etat, f, default=lambda x: x.item())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporaire, fichier)
+
+
+def lire_point_reprise(fichier: str) -> Dict:
+    """Reads the checkpoint file
+
+    Params:
+        fichier: the path of the checkpoint file
+
+    Returns:
+        dict: the state, or None if there is no checkpoint
+    """
+
+    try:
+        with open(fichier, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.error("The checkpoint {} is unreadable, starting over".format(fichier))
+        return None
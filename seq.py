@@ -5,9 +5,52 @@ from typing import Type, Dict, Tuple, Callable, Iterable
 
 import numpy as np
 
+from compteur import Compteur
+from ordres import Ordre
 from vartypes import csc_var, csc_float, csc_uint8
 
 
+def type_numpy(vartype: Type[csc_var]) -> np.dtype:
+    """Returns the NumPy type matching the cascada type (ie its ctypes type)"""
+    return np.dtype(vartype._type_)
+
+
+def typer_plage(vartype: Type[csc_var], plage: Iterable[float]) -> np.ndarray:
+    """Casts the values of a range as the cascada type would do it, in a single NumPy array"""
+
+    dtype = type_numpy(vartype)
+    plage = np.asarray(plage)
+    if dtype.kind == 'f':
+        return plage.astype(dtype)
+    # int() truncates, and ctypes wraps around: so does going through int64
+    return plage.astype(np.int64).astype(dtype)
+
+
+def deplier_grille(axes: Dict[str, np.ndarray]) -> np.ndarray:
+    """Expands a sub-grid into its points
+
+    Params:
+        axes: the values taken by each variable on the sub-grid, as returned by
+              Sequenceur.suivant_grille()
+
+    Returns:
+        numpy.ndarray: a structured array (one field per variable) holding the points of the
+            sub-grid, the first variable being the fastest one (as in the sequence)
+    """
+
+    nb_points = 1
+    for valeurs in axes.values():
+        nb_points *= len(valeurs)
+
+    indices = np.arange(nb_points, dtype=np.int64)
+    points = np.empty(nb_points, dtype=[(nom, valeurs.dtype) for nom, valeurs in axes.items()])
+    poids = 1
+    for nom, valeurs in axes.items():
+        points[nom] = valeurs[(indices // poids) % len(valeurs)]
+        poids *= len(valeurs)
+    return points
+
+
 class Sequenceur():
     def __init__(self, schema: Dict[str, Type[csc_var]] = {},
                  schema_compteurs: Dict[str,
@@ -15,7 +58,8 @@ class Sequenceur():
                                               float,
                                               int,
                                               Callable[[float, float, int],
-                                                       Iterable[float]]]] = {}):
+                                                       Iterable[float]]]] = {},
+                 ordre: Ordre = None):
         """Initializes the sequencer
             Params:
                 schema: a dictionnary, which keys are the name of the variables, the values being
@@ -28,12 +72,18 @@ class Sequenceur():
                                         - fct
                                     Where fct is a function that takes (start, end, number of
                                     iterations) and returns the corresponding
-                                    range (eg numpy.linspace)
+                                    range (eg numpy.linspace), or a counter class computing
+                                    its values lazily (eg compteur.CompteurRange), for the
+                                    axes too long to be held in memory
+                ordre: (optionnal) the order in which the points of the grid are generated
+                       (see ordres.py); defaults to the sequential order, the first variable
+                       being the fastest one
         """
 
         self.nb_iters_realisees = 0
         self.schema = schema
         self.schema_compteurs = schema_compteurs
+        self.ordre = ordre
         self.a_deborde = False
 
         self.nb_iters_total = 0
@@ -72,6 +122,22 @@ class Sequenceur():
             # initializes the variable as instance of its type
             self.espace_variables[i].append(self.espace_variables[i][1](deb))
 
+        # used by suivant_bloc(): the ranges as arrays of the types of the variables (None for
+        # the counters, which values are computed when needed), and the weight of each variable
+        # in the index of a configuration (the first variable being the fastest one)
+        self.dtype_bloc = np.dtype([(v[0], type_numpy(v[1])) for v in self.espace_variables])
+        self.plages_typees = [None if isinstance(v[3], Compteur) else typer_plage(v[1], v[3])
+                              for v in self.espace_variables]
+        self.poids = []
+        poids = 1
+        for v in self.espace_variables:
+            self.poids.append(poids)
+            poids *= v[2][2]
+
+        # the positions in the sequence are mapped to indexes in the grid by the order
+        if self.ordre is not None:
+            self.ordre.preparer([v[2][2] for v in self.espace_variables])
+
     def suivant(self) -> Dict[str, csc_var]:
         """Generates the next number in the sequence
 
@@ -84,6 +150,17 @@ class Sequenceur():
         if len(self.indices_courants) == 0 or self.a_deborde:
             return None
 
+        if self.ordre is not None:
+            # the counter holds the position in the sequence, not the index in the grid
+            position = self._position()
+            if position >= self.nb_iters_total:
+                self.a_deborde = True
+                return None
+            sch_sortie = self.configuration_a(position)
+            self._placer(position + 1)
+            self.nb_iters_realisees += 1
+            return sch_sortie
+
         # propagates the carry
         i = 0
         while i < len(
@@ -122,9 +199,175 @@ class Sequenceur():
 
         return sch_sortie
 
+    def suivant_bloc(self, n: int) -> np.ndarray:
+        """Generates the next n configurations of the sequence at once
+
+            Params:
+                n: the number of configurations
+
+            Returns:
+                numpy.ndarray: a structured array (one field per variable, with the NumPy
+                    type matching its cascada type) holding at most n configurations, in the
+                    order suivant() would have generated them; None if the sequence is over
+
+            Note:
+                suivant() and suivant_bloc() can be used in turns
+        """
+
+        if len(self.indices_courants) == 0 or self.a_deborde:
+            return None
+
+        debut = self._position()
+        fin = min(debut + n, self.nb_iters_total)
+        if debut >= fin:
+            self.a_deborde = True
+            return None
+
+        # mixed-radix decoding of the indexes of the configurations
+        indices = self._indices_grille(np.arange(debut, fin, dtype=np.int64))
+        bloc = np.empty(fin - debut, dtype=self.dtype_bloc)
+        for j, (v, poids) in enumerate(zip(self.espace_variables, self.poids)):
+            bloc[v[0]] = self._valeurs_typees(j, (indices // poids) % v[2][2])
+
+        self._placer(fin)
+        self.nb_iters_realisees += fin - debut
+        return bloc
+
+    def suivant_grille(self, n: int) -> Tuple[int, Dict[str, np.ndarray]]:
+        """Generates the next sub-grid of the sequence, ie the largest hyperrectangle of at
+        most n configurations starting at the current position: the fastest variables span
+        their whole range, the next one a slice of it, and the slower ones a single value.
+        Such a sub-grid is also a contiguous range of positions of the sequence
+
+            Params:
+                n: the maximum number of configurations of the sub-grid
+
+            Returns:
+                int: the position of the first configuration of the sub-grid
+                dict: for each variable (the first one being the fastest), the values it
+                    takes on the sub-grid, as an array of the NumPy type matching its cascada
+                    type (see deplier_grille()); None if the sequence is over
+
+            Note:
+                suivant(), suivant_bloc() and suivant_grille() can be used in turns; the
+                sub-grids require the sequential order
+        """
+
+        if self.ordre is not None and not self.ordre.contigu:
+            raise ValueError("The sub-grids require the sequential order")
+
+        if len(self.indices_courants) == 0 or self.a_deborde:
+            return None
+
+        debut = self._position()
+        if debut >= self.nb_iters_total:
+            self.a_deborde = True
+            return None
+
+        axes = {}
+        nb = 1
+        ouvert = True   # whether the variable can span more than one value
+        reste = debut
+        for j, v in enumerate(self.espace_variables):
+            indice = reste % v[2][2]
+            reste //= v[2][2]
+            if ouvert and indice == 0 and nb * v[2][2] <= n:
+                compte = v[2][2]
+            elif ouvert:
+                compte = min(v[2][2] - indice, max(n // nb, 1))
+                ouvert = False
+            else:
+                compte = 1
+            axes[v[0]] = self._valeurs_typees(j, slice(indice, indice + compte))
+            nb *= compte
+
+        self._placer(debut + nb)
+        self.nb_iters_realisees += nb
+        return debut, axes
+
+    def _valeurs_typees(self, j: int, indices) -> np.ndarray:
+        """Returns the values of the range of the j-th variable at indices (an array of indexes
+        or a slice), as an array of the type of the variable"""
+
+        plage = self.plages_typees[j]
+        if plage is None:
+            v = self.espace_variables[j]
+            return typer_plage(v[1], v[3][indices])
+        return plage[indices]
+
+    def configuration_a(self, index: int) -> Dict[str, csc_var]:
+        """Returns the configuration of the sequence at position index, without moving the
+        counter
+
+            Params:
+                index: the position of the configuration, from 0 to nb_iters_total-1
+
+            Returns:
+                dict: the configuration, as suivant() would return it
+        """
+
+        if not 0 <= index < self.nb_iters_total:
+            raise IndexError("Configuration {} out of the sequence (0 to {})".format(
+                index, self.nb_iters_total - 1))
+
+        index = int(self._indices_grille(np.array([index], dtype=np.int64))[0])
+        sch_sortie = {}
+        for v, poids in zip(self.espace_variables, self.poids):
+            sch_sortie[v[0]] = v[1](v[3][(index // poids) % v[2][2]])
+        return sch_sortie
+
+    def _indices_grille(self, positions: np.ndarray) -> np.ndarray:
+        """Maps positions of the sequence to indexes in the grid, following the order"""
+        if self.ordre is None:
+            return positions
+        return self.ordre.permuter(positions)
+
+    def aller_a(self, index: int) -> None:
+        """Moves the counter so that the next configuration generated is the one at position
+        index; the configurations before it are counted as generated
+
+            Params:
+                index: the position, from 0 to nb_iters_total (the end of the sequence)
+        """
+
+        if not 0 <= index <= self.nb_iters_total:
+            raise IndexError("Position {} out of the sequence (0 to {})".format(
+                index, self.nb_iters_total))
+
+        self._placer(index)
+        self.a_deborde = False
+        self.nb_iters_realisees = index
+
+    def _position(self) -> int:
+        """Returns the index of the next configuration in the sequence"""
+
+        # the carry is propagated lazily by suivant(): a "full" index still gives the right
+        # position
+        position = 0
+        for i, poids in zip(self.indices_courants, self.poids):
+            position += i * poids
+        return min(position, self.nb_iters_total)
+
+    def _placer(self, position: int) -> None:
+        """Puts the counter in the state suivant() would have left it in after generating the
+        configuration of index position-1"""
+
+        if position == 0:
+            self.indices_courants = [0 for v in self.espace_variables]
+            for v in self.espace_variables:
+                v[4] = v[1](v[2][0])
+            return
+
+        reste = position - 1
+        for j, v in enumerate(self.espace_variables):
+            self.indices_courants[j] = reste % v[2][2]
+            reste //= v[2][2]
+            v[4] = v[1](v[3][self.indices_courants[j]])
+        self.indices_courants[0] += 1
+
     def reset(self) -> None:
         """Resets the counter"""
-        self.__init__(self.schema, self.schema_compteurs)
+        self.__init__(self.schema, self.schema_compteurs, self.ordre)
 
     def recharger_bornes_pas(self, bornes_pas: Dict[str, Tuple[float, float, int]]) -> None:
         """Reloads the limits and steps parameters for the variables specified in bornes_pas;
@@ -1,51 +1,46 @@
 """Defines the main logic of the server"""
 
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 from enum import Enum
-import copy
-import random
+import csv
+import io
 import json
 import time
 import logging
+import threading
 
-from bottle import route, run, response, request, post, static_file
+from bottle import route, run, response, request, post, static_file, default_app
 
-import db
+import stockage
+import serveur_async
+import reprise
 from projet import ProjetCascada
+from repartiteur import (Repartiteur, clientMaitre, NoeudCalcul,  # noqa: F401
+                         tacheCalcul, tacheGrille, statutClient, statutNoeud, A_REESSAYER)
 from vartypes import schema_vers_sch_typecode, csc_var
 
 
 sessions_esclaves = {}
-sessions_maitres = {}
-compteur_utilisation_noms = {}
-
-
-# Sometimes it might be possible that we decide the taks has to bo accomplished again,
-# so we keep track of them in the following stack
-taches_a_redistribuer = []
 
 version = {"version": 1, "vendor": "coffeeXL"}
 clef_secrete = "ABRACADABRA"
-temps_max_keepalive = 1200  # 20 minutes; TODO: Implement support for keepalive
+temps_max_keepalive = 1200  # 20 minutes
+periode_faucheuse = 60  # how often (in seconds) the sessions are checked for timeouts
+periode_reprise = 30  # how often (in seconds) the state of the dispatcher is checkpointed
 nom_projet = "EMPTY"
 
 
 mon_projet = None
 maBDD = None
-sequenceur = None
-
-
-class statutClient(Enum):
-    NON_CONNECTE = 0
-    CONNECTE = 1
-    TIMEOUT = 2
-
-
-class statutNoeud(Enum):
-    INACTIF = 0
-    MORT = 2
-    PAUSE = 3
-    ACTIF = 4
+# holds the sessions, the tasks and the sequencer, see repartiteur.py
+repartiteur = None
+arret_faucheuse = None
+arret_reprise = None
+fichier_reprise = None
+taille_file_taches = 1024  # number of tasks generated ahead of the slave servers' demand
+taille_grille = None  # if set, each task is a sub-grid of (at most) that many points
+delai_reessai = 1  # seconds a slave server should wait when no task is ready yet
+taille_bloc_export = 1000  # number of rows read from the database at once by /api/v1/results
 
 
 class erreursClient(Enum):
@@ -61,126 +56,7 @@ class erreursClient(Enum):
     ECHEC_VALIDATION = 9
     NOEUD_INEXISTANT = 10
     ECHEC_VERIFICATION = 11
-
-
-class tacheCalcul():
-    """A computation task, assigned to a node"""
-
-    def __init__(self, valeurs: Dict[str, csc_var] = {}):
-        """Initializes the task
-
-        Params:
-            valeurs: dictionnary with keys being the variables' name and value their value
-        """
-
-        # The variables used to make the computation, generatd by the code and sent to the node
-        self.valeurs = valeurs
-        self.demandeur = ""
-        self.date_creation = int(time.time())
-        self.date_derniere_allocation = self.date_creation
-        self.norealloc = False   # used to cannibalize (ie protect from deadlocks)
-        # if A -> task T1
-        #    B -> task T2
-        #    C -> task T1
-        # A ends and is given T2
-        # B ends and is given T1
-        # C ends and is given T2
-        #  ->> Deadlock
-
-    def versdict(self) -> Dict[str, csc_var]:
-        """Returns a dictionary which structure is akin to the one from the dictionnary supplied in init
-
-        Returns:
-            dict: dictionnary with keys being the variables' name and value their value
-        """
-        return self.valeurs
-
-    def __str__(self):
-        return ", ".join(["{} = {}".format(var, val) for var, val in self.valeurs.items()])
-
-    def realloc(self) -> None:
-        """Updates the last allocation date of the task"""
-        self.date_derniere_allocation = int(time.time())
-
-
-class NoeudCalcul():
-    """A computation unit running on the slave server (ie master client)"""
-
-    def __init__(self, nom="unnamed-node"):
-        self.statut = statutNoeud.INACTIF
-        self.nom = nom
-        self.tache_calcul = None
-
-    def __str__(self):
-        return str(
-            self.statut.value) + " [{}]".format(
-            self.tache_calcul) if self.statut != statutNoeud.INACTIF else str(
-            self.statut.value)
-
-    def __repr__(self):
-        return self.__str__()
-
-    def abandonner_tache(self) -> None:
-        if self.statut == statutNoeud.ACTIF:
-            self.statut = statutNoeud.INACTIF
-            # normally it shouldn't happen to have a None task as a status
-            # buuut we never know
-            if self.tache_calcul is not None:
-                taches_a_redistribuer.append(self.tache_calcul)
-                self.tache_calcul = None
-
-    def charger_tache(self, tache) -> None:
-        self.tache_calcul = tache
-        self.statut = statutNoeud.ACTIF
-
-
-class clientMaitre():
-    """A slave server that manages several computation units"""
-
-    def __init__(self, nom: str, token: str, keepalive: int = 0,
-                 statut: statutClient = statutClient.NON_CONNECTE):
-        """Initializes a slave server
-
-        Params:
-            nom: the name of the server
-            token: an authentification token for the slave server
-            keepalive: the last epoch an action related to the slave server was performed
-            statut: the status of the slave server
-        """
-
-        self.nom = nom
-        self.token = token
-        self.statut = statut
-        self.dernier_keepalive = keepalive
-        self.noeuds = {}
-        self.nb_noeuds_ajoutes = 0
-
-    def deconnecter(self) -> None:
-        """Disconnects the slave server (ie closes its session)"""
-        del sessions_maitres[self.token]
-
-    def ajouter_noeud(self) -> None:
-        """Allocates a new computation node on the slave server"""
-        nom_noeud = self.nom + "#" + str(self.nb_noeuds_ajoutes + 1)
-        self.noeuds[nom_noeud] = NoeudCalcul(nom=nom_noeud)
-        self.nb_noeuds_ajoutes += 1
-        return nom_noeud
-
-    def liste_noeuds(self) -> List[Tuple[str, NoeudCalcul]]:
-        """Lists the avaible nodes for the slave slave"""
-        return [(num, noeud) for num, noeud in self.noeuds.items()]
-
-    def recuperer_noeud(self, idnoeud: str) -> NoeudCalcul:
-        """Returns the computation node matching the id idnoeud
-
-        Params:
-            idnoeud: the id of the node
-        """
-
-        try:
-            return self.noeuds[idnoeud]
-        except Exception as e:
-            raise e
+    REESSAYER_PLUS_TARD = 12
 
 
 def sanitize(no_timeout: bool = False) -> Dict[str, str]:
@@ -194,6 +70,7 @@ def sanitize(no_timeout: bool = False) -> Dict[str, str]:
         dict: if the client was not authentificated, returns a dict containing the message that
             should be transmitted to the client. If the client was authentificated, returns
             the POST data the client sent.
+        clientMaitre: the slave server if it was authentificated, None otherwise
     """
 
     try:
@@ -204,19 +81,47 @@ def sanitize(no_timeout: bool = False) -> Dict[str, str]:
     if data is None:
         raise ValueError
 
-    if data["mastertoken"] not in sessions_maitres.keys():
+    client = repartiteur.recuperer_client(data["mastertoken"])
+    if client is None:
         return False, {"status": "error",
                        "code": erreursClient.CLEF_MANQUANTE_DANS_TROUSSEAU.value,
-                       "msg": "No matching masterkey found in keyring"}
+                       "msg": "No matching masterkey found in keyring"}, None
 
-    client = sessions_maitres[data["mastertoken"]]
-    if no_timeout:
+    if not no_timeout:
         if client.dernier_keepalive + temps_max_keepalive < int(time.time()):   # timeout
             return False, {"status": "error", "code": erreursClient.TIMEOUT_RELOGIN.value,
-                           "msg": "Timed out. Please relogin"}
+                           "msg": "Timed out. Please relogin"}, None
 
     client.dernier_keepalive = int(time.time())  # updates the last contact date
-    return True, data
+    return True, data, client
+
+
+def boucle_faucheuse(arret: threading.Event) -> None:
+    """Main loop of the reaper thread, that periodically closes the timed out sessions
+
+    Params:
+        arret: the event used to stop the thread
+    """
+
+    while not arret.wait(periode_faucheuse):
+        try:
+            repartiteur.expirer_sessions(temps_max_keepalive)
+        except Exception:
+            logging.exception("Error while reaping the timed out sessions")
+
+
+def boucle_reprise(arret: threading.Event) -> None:
+    """Main loop of the checkpoint thread, that periodically saves the state of the dispatcher
+
+    Params:
+        arret: the event used to stop the thread
+    """
+
+    while not arret.wait(periode_reprise):
+        try:
+            reprise.ecrire_point_reprise(fichier_reprise, repartiteur.etat_reprise())
+        except Exception:
+            logging.exception("Error while saving the checkpoint")
 
 
 @route('/hello')
@@ -254,21 +159,11 @@ def register_maitre():   # we start be registering the slave server
             "msg": "Authentification failed",
             "code": erreursClient.ECHEC_AUTH.value}
     else:
-        # we create a master auth token for the client
-        token_session = str(random.randint(0, 2**255 - 1))
-        while token_session in sessions_maitres:
-            token_session = str(random.randint(0, 2**255 - 1))
-
-        # guarantees the name's unicity
-        if nom not in compteur_utilisation_noms:
-            compteur_utilisation_noms[nom] = 0
-        else:
-            compteur_utilisation_noms[nom] += 1
-            nom = nom + "-" + str(compteur_utilisation_noms[nom])
-
-        sessions_maitres[token_session] = clientMaitre(
-            nom, token_session, keepalive=int(
-                time.time()), statut=statutClient.CONNECTE)
+        # the dispatcher creates a master auth token for the client and guarantees the
+        # name's unicity
+        client = repartiteur.ouvrir_session(nom)
+        token_session = client.token
+        nom = client.nom
         logging.info("The slave server {} [{}] has connected".format(
             nom, request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')))
         return {
@@ -286,6 +181,18 @@ def register_maitre():   # we start be registering the slave server
                     mon_projet.schema_sortie)}}
 
 
+@post('/api/v1/keepalive')
+def keepalive():
+    """Used by the slave server to signal it is still alive when it has nothing else to say
+    (sanitize() updates the date of the last contact)"""
+
+    s = sanitize()
+    if not s[0]:
+        return s[1]
+
+    return {"status": "ok", "msg": "Alive", "code": erreursClient.PAS_ERREUR.value}
+
+
 @post('/api/v1/register-nodes')
 def register_nodes():
     """Once that the slave server is connected, we can allocate nodes for it"""
@@ -300,7 +207,7 @@ def register_nodes():
                            "msg": "Missing field \'nodenumber\'",
                            "code": erreursClient.MANQUE_CHAMP_REQUETE.value})
 
-    client = sessions_maitres[data["mastertoken"]]
+    client = s[2]
     nb_noeuds = int(data["nodenumber"])
     noms_noeuds = []
     for i in range(nb_noeuds):
@@ -319,8 +226,7 @@ def disp_nodes():
     if not s[0]:
         return s[1]
 
-    data = dict(s[1])
-    client = sessions_maitres[data["mastertoken"]]
+    client = s[2]
     liste_noeuds = client.liste_noeuds()
     out = []
     for z in liste_noeuds:
@@ -328,17 +234,65 @@ def disp_nodes():
     return json.dumps(out, default=str)
 
 
+def erreur_pas_de_travail(work) -> Dict:
+    """Builds the answer to a request for which no task could be allocated
+
+    Params:
+        work: what repartiteur.obtenir_tache() returned (None or A_REESSAYER)
+    """
+
+    if work is A_REESSAYER:
+        # the next scheme is being prepared: the slave server should come back shortly
+        response.headers['Retry-After'] = str(delai_reessai)
+        return {
+            "status": "error",
+            "msg": "No task ready yet, retry later",
+            "code": erreursClient.REESSAYER_PLUS_TARD.value,
+            "retry-after": delai_reessai}
+    return {
+        "status": "error",
+        "msg": "No mork work to allocate",
+        "code": erreursClient.PLUS_DE_TRAVAIL.value}
+
+
+def recuperer_noeud_inactif(client: clientMaitre, nodeid: str) -> Tuple[NoeudCalcul, Dict]:
+    """Looks up an idle node of the slave server client
+
+    Params:
+        client: the slave server owning the node
+        nodeid: the id of the node
+
+    Returns:
+        NoeudCalcul: the node, or None if it could not be used
+        dict: if the node could not be used, the error message that should be transmitted
+            to the client; None otherwise
+    """
+
+    try:
+        mon_noeud = client.recuperer_noeud(nodeid)
+    except Exception:  # as e:
+        return None, {
+            "status": "error",
+            "msg": "Invalid value for parameter \'nodeid\'",
+            "code": erreursClient.VALEUR_INVALIDE.value}
+
+    if mon_noeud.statut != statutNoeud.INACTIF:
+        return None, {"status": "error", "msg": "Node is not idle ! (status {})".format(
+            mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
+
+    return mon_noeud, None
+
+
 @post('/api/v1/fetch-work-for-node')
 def work4node():
-    """Very important function, that allocates work to a node
-    The code might seem long, but it's heavily commented"""
+    """Allocates work to a node"""
 
     s = sanitize()
     if not s[0]:
         return s[1]
 
     data = dict(s[1])
-    client = sessions_maitres[data["mastertoken"]]
+    client = s[2]
 
     if "nodeid" not in data:
         return {"status": "error", "msg": "Missing field \'nodeid\'",
@@ -348,194 +302,181 @@ def work4node():
     # return {"status": "error", "msg": "Innvalid value for parameter
     # \'nodeid\'", "code": erreursClient.VALEUR_INVALIDE.value}
 
-    nodeid = data["nodeid"]
-    try:
-        mon_noeud = client.recuperer_noeud(nodeid)
-    except Exception:  # as e:
-        return {
-            "status": "error",
-            "msg": "Invalid value for parameter \'nodeid\'",
-            "code": erreursClient.VALEUR_INVALIDE.value}
+    mon_noeud, erreur = recuperer_noeud_inactif(client, data["nodeid"])
+    if erreur is not None:
+        return erreur
 
-    if mon_noeud.statut != statutNoeud.INACTIF:
+    work = repartiteur.obtenir_tache()
+    if work is None or work is A_REESSAYER:
+        return erreur_pas_de_travail(work)
+
+    # the node might have been given a task by a concurrent request in the meantime
+    if not repartiteur.charger_tache(client, mon_noeud, work):
         return {"status": "error", "msg": "Node is not idle ! (status {})".format(
             mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
 
-    # First off, we have to check whether we have rejected tasks that could be allocated
-    # If that's not the case, we have to generate it: if it is already in the databse, we skip it
-    # The "while True" is not a real infinite loop, because taches_a_redistribuer is necessarily
-    # smaller than the finite set of generated values by the sequencer, we do iterate
-    # through said sequencer's values and when we're done we break the loop
-    while True:
-        if len(taches_a_redistribuer) > 0:
-            work = taches_a_redistribuer.pop()
-            print("Work {} fetched from rejections stack".format(work))
-            break
-        else:
-            # {"k": csc_float(3), "Tdebut": csc_float(10), "Tfin": csc_float(0.002)}
-            work = sequenceur.suivant()
-            while work and not mon_projet.valider(work):
-                # if the submitted work is deemed invalid
-                # (for instance, a sqrt that was computed to be
-                # negative), it could mean there was a transimission
-                # issue or a bug in the client (and not necessarily that
-                # the algorithm itself is flawed): the task is rejected
-                # to be reallocated later
-                work = sequenceur.suivant()
-
-            if not work or not maBDD.existe(work):
-                if work is not None:
-                    work = tacheCalcul(work)
-                break
-            else:
-                pass
-
-    if work:
-        mon_noeud.charger_tache(work)
-
-        # Not very elegant, be we HAVE to do this to be able the specify the default serializer
-        response.headers['Content-Type'] = 'application/json'
-        return json.dumps({"status": "ok",
-                           "msg": "Successfully allocated work",
-                           "code": erreursClient.PAS_ERREUR.value,
-                           "task-payload": work.versdict()},
-                          default=lambda x: x.value)
-    else:
-        # There's no rejected task to distribute and the sequence is exhausted :/
-        # We start "cannibalizing" the task by reallocated the oldest task
-        # (which client might have stalled) to work-hungry newcomers
-
-        tache_ancienne = None
-        for client in sessions_maitres.values():
-            for noeud in client.liste_noeuds():
-                if noeud[1].tache_calcul and not noeud[1].tache_calcul.norealloc:
-                    if tache_ancienne is None:
-                        tache_ancienne = noeud[1].tache_calcul
-
-                    elif noeud[1].tache_calcul is not None \
-                        and noeud[1].tache_calcul.date_derniere_allocation \
-                            < tache_ancienne.date_derniere_allocation:
-
-                        tache_ancienne = noeud[1].tache_calcul
-
-        if tache_ancienne is None:
-            # Everybody's done, it's getting complicated to allocate new tasks
-            # We try to densify if it is possible
-            if not maBDD.densification_en_cours():
-                if mon_projet.nb_densifications_effectuees < mon_projet.nb_densifications:
-                    maBDD.densifier(mon_projet.facteur_selection, mon_projet.var_densification)
-                    # We keep the old sequencer as we will need it to know the number of iterations
-                    # for each variable (the sequencer is reloaded after each scheme change, if we
-                    # have 2 level 2 schemes, the 2nd scheme whould use the data from the first
-                    # level 2 scheme if we did not save the father (here, it's the level 1 scheme))
-                    mon_projet.ancien_sequenceur = copy.deepcopy(mon_projet.sequenceur)
-                    mon_projet.nb_densifications_effectuees += 1
-
-            # what if the densification doesn't happen (because of an error for instance) ?
-            # in that special case, an error mesage is returned.
-            # else...
-            if maBDD.densification_en_cours():
-
-                # if we've already started a densification sequence, we reload the new scheme
-                # the DB returns a dictionnary which shape is:
-                # {'<var name>': (central value, start, end), ...}
-                # we don't really need the central value, but we do need the number of iterations
-                # (which is not supplied)
-                # we get it by looking throught the scheme
-                nouv_sch = {}
-                resultat_dens = maBDD.schema_suivant(mon_projet.schema_densification)
-                if resultat_dens:  # Watch out for the None case !
-                    nombre_valeurs_differentes = 0
-
-                    # We start by counting the number of variables having differents limits
-                    # This number can be interpreted as the number of dimensions in the
-                    # densification space
-                    # Then, knowing the volume of the densification hyperrectangle
-                    # (it is multiplied by mon_projet.facteur_amplification) we can guess
-                    # the length of the edges (ie the number of iterations)
-                    for xn, xv in resultat_dens.items():
-                        if xv[1] != xv[2]:
-                            nombre_valeurs_differentes += 1
-
-                    # If nombre_valeurs_differentes is 0, we have an issue for the computation
-                    nombre_valeurs_differentes = max(1, nombre_valeurs_differentes)
-                    for xn, xv in resultat_dens.items():
-                        if xv[1] != xv[2]:
-                            nouv_sch[xn] = (
-                                xv[1], xv[2], int(
-                                    mon_projet.facteur_amplification**(
-                                        1 / nombre_valeurs_differentes)
-                                    * mon_projet.ancien_sequenceur.nb_iters_pour_variable(xn)))
-                        else:
-                            # If <start> = <end>, there is no use in iterating
-                            # Note: we reload only the values specified in the densification scheme,
-                            # so if there are variables that were made not to be densified
-                            # (for instance dummy variables made to repeat the same computation
-                            # several times), an easy solution is not to include them in the
-                            # densification scheme
-                            nouv_sch[xn] = (xv[1], xv[2], 1)
-                    logging.info("\tReloading a new scheme {}".format(nouv_sch))
-                    mon_projet.sequenceur.recharger_bornes_pas(nouv_sch)
-
-                # We've reloaded everything that we had to
-                # -> we re-run the request
-                return work4node()
-
-            if not mon_projet.execution_terminee:
-                logging.warning("Done, no more tasks to allocate !")
-                mon_projet.execution_terminee = True
-
-            return {
-                "status": "error",
-                "msg": "No mork work to allocate",
-                "code": erreursClient.PLUS_DE_TRAVAIL.value}
-        else:
-            # Met à jour la date de dernière allocation
-            print("Cannibalizing {}".format(tache_ancienne))
-            tache_ancienne.realloc()
-            mon_noeud.charger_tache(tache_ancienne)
+    # Not very elegant, be we HAVE to do this to be able the specify the default serializer
+    response.headers['Content-Type'] = 'application/json'
+    return json.dumps({"status": "ok",
+                       "msg": "Successfully allocated work",
+                       "code": erreursClient.PAS_ERREUR.value,
+                       "task-payload": work.versdict()},
+                      default=lambda x: x.value)
 
-            response.headers['Content-Type'] = 'application/json'
-            return json.dumps({"status": "ok",
-                               "msg": "Successfully allocated work",
-                               "code": erreursClient.PAS_ERREUR.value,
-                               "task-payload": tache_ancienne.versdict()},
-                              default=lambda x: x.value)
 
+@post('/api/v1/fetch-work-batch')
+def work4nodes():
+    """Allocates work to several nodes of the same slave server in a single request, so that
+    the authentification, parsing and serialization costs are paid once per batch instead of
+    once per task.
 
-@post('/api/v1/submit-results')
-def submit_results():
-    """Used by the slave server to submit its computation results"""
+    The client either supplies a list of node ids in the field 'nodeids', or a number of tasks
+    in the field 'count', in which case work is allocated to (at most) that many of its idle nodes.
+
+    Per-node failures do not fail the whole batch: they are reported in the 'errors' field, keyed
+    by node id.
+    """
 
     s = sanitize()
     if not s[0]:
         return s[1]
 
     data = dict(s[1])
-    client = sessions_maitres[data["mastertoken"]]
-
-    if "nodeid" not in data:
-        return {"status": "error", "msg": "Missing field \'nodeid\'",
-                "code": erreursClient.MANQUE_CHAMP_REQUETE.value}
-    if "payload" not in data:
-        return {"status": "error", "msg": "Missing field \'payload\'",
+    client = s[2]
+
+    if "nodeids" in data:
+        nodeids = data["nodeids"]
+        if not isinstance(nodeids, list):
+            return {"status": "error", "msg": "Invalid value for parameter \'nodeids\'",
+                    "code": erreursClient.VALEUR_INVALIDE.value}
+    elif "count" in data:
+        try:
+            nombre = int(data["count"])
+        except (TypeError, ValueError):
+            return {"status": "error", "msg": "Invalid value for parameter \'count\'",
+                    "code": erreursClient.VALEUR_INVALIDE.value}
+        nodeids = [idnoeud for idnoeud, noeud in client.liste_noeuds()
+                   if noeud.statut == statutNoeud.INACTIF][:max(nombre, 0)]
+    else:
+        return {"status": "error", "msg": "Missing field \'nodeids\' or \'count\'",
                 "code": erreursClient.MANQUE_CHAMP_REQUETE.value}
 
-    nodeid = data["nodeid"]
+    taches = {}
+    erreurs = {}
+    pas_de_travail = None  # set to the error once no task could be allocated
+    for nodeid in nodeids:
+        mon_noeud, erreur = recuperer_noeud_inactif(client, nodeid)
+        if erreur is not None:
+            erreurs[nodeid] = erreur
+            continue
+
+        # once we know no task is ready, there is no use in asking again
+        if pas_de_travail is None:
+            work = repartiteur.obtenir_tache()
+            if work is None or work is A_REESSAYER:
+                pas_de_travail = erreur_pas_de_travail(work)
+        if pas_de_travail is not None:
+            erreurs[nodeid] = pas_de_travail
+            continue
+
+        if not repartiteur.charger_tache(client, mon_noeud, work):
+            erreurs[nodeid] = {"status": "error", "msg": "Node is not idle ! (status {})".format(
+                mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
+            continue
+        taches[nodeid] = work.versdict()
+
+    if len(taches) == 0 and pas_de_travail is not None:
+        return dict(pas_de_travail, errors=erreurs)
+
+    response.headers['Content-Type'] = 'application/json'
+    return json.dumps({"status": "ok",
+                       "msg": "Successfully allocated work for {} nodes".format(len(taches)),
+                       "code": erreursClient.PAS_ERREUR.value,
+                       "tasks": taches,
+                       "errors": erreurs},
+                      default=lambda x: x.value)
+
+
+def traiter_resultats(client: clientMaitre, soumissions: List[Tuple[str, Dict]],
+                      schema_complet: Dict[str, csc_var]) -> List[Dict]:
+    """Checks the results submitted for nodes of a slave server, saves the accepted ones and
+    takes their task away from the nodes
+
+    Params:
+        client: the slave server owning the nodes
+        soumissions: the submissions, as (<node id>, <payload sent by the client>) tuples
+        schema_complet: the complete scheme of the project (see ProjetCascada.schema_total)
+
+    Returns:
+        list: for each submission, in the same order, None if the results were accepted, or
+            the error message that should be transmitted to the client
+
+    Note:
+        The tasks are only closed once their results are saved (and, if the results are
+        logged, on disk): the densification level can't change in between, and a crash can't
+        lose a task that was closed. The results are saved without the lock of the slave
+        server, so that its other nodes aren't held up by the disk
+    """
+
+    erreurs = []
+    a_enregistrer = []
+    taches = []
+    acceptes = []   # the ids of the nodes which results were accepted
+    with client.verrou:
+        for nodeid, resultats in soumissions:
+            # the tasks are only closed below: a node submitted twice in the batch is still
+            # active the second time
+            if nodeid in acceptes:
+                erreurs.append({"status": "error",
+                                "msg": "Node is not active ! (results already submitted)",
+                                "code": erreursClient.MAUVAIS_STATUT_NOEUD.value})
+                continue
+            resultats, erreur, mon_noeud = _traiter_resultats(client, nodeid, resultats,
+                                                              schema_complet)
+            erreurs.append(erreur)
+            if erreur is None:
+                acceptes.append(nodeid)
+                a_enregistrer.extend(resultats)
+                taches.append((mon_noeud, mon_noeud.tache_calcul))
+
+    if len(a_enregistrer) > 0:
+        maBDD.enregistrer_lot(a_enregistrer)
+
+    with client.verrou:
+        for mon_noeud, tache in taches:
+            # the node may have lost its task in between (eg it expired, or the same results
+            # were submitted twice): the task was then closed or given back already
+            if mon_noeud.tache_calcul is tache:
+                mon_noeud.terminer_tache()
+
+    return erreurs
+
+
+def _traiter_resultats(client: clientMaitre, nodeid: str, resultats: Dict,
+                       schema_complet: Dict[str, csc_var]) -> Tuple[List[Dict[str, csc_var]],
+                                                                    Dict, NoeudCalcul]:
+    """Checks the results submitted for the node nodeid; to be called with the lock of the
+    slave server held
+
+    Returns:
+        list: the records that should be saved in the database (several ones if the task is
+            a sub-grid), or None if the results were rejected
+        dict: if the results were rejected, the error message that should be transmitted
+            to the client; None otherwise
+        NoeudCalcul: the node, which task should be closed once the records are saved
+    """
 
     try:
         mon_noeud = client.recuperer_noeud(nodeid)
     except Exception:
-        return {
+        return None, {
             "status": "error",
             "msg": "No matching node found",
-            "code": erreursClient.NOEUD_INEXISTANT.value}
+            "code": erreursClient.NOEUD_INEXISTANT.value}, None
 
     if mon_noeud.statut != statutNoeud.ACTIF:
-        return {"status": "error", "msg": "Node is not active ! (status {})".format(
-            mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
-
-    resultats = data["payload"]
+        return None, {"status": "error", "msg": "Node is not active ! (status {})".format(
+            mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}, None
 
     # Whatever happens, the task is taken away from the node:
     #   -> if everything is OK: great !
@@ -543,32 +484,114 @@ def submit_results():
     # Note: TODO: maybe we should make it so that the same node isn't
     # reallocated the same task it failed to compute...
 
-    resultats_purifies = {}
-    schema_complet = mon_projet.schema_total()
-    for l in schema_complet:
-        # Part of the answer is missing -> we reject it
-        if l not in resultats:
-            mon_noeud.abandonner_tache()
-            return {"status": "error", "msg": "Missing variable '{}' in payload".format(
-                l), "code": erreursClient.MANQUE_VARIABLE_RESULTATS.value}
-        else:
-            resultats_purifies[l] = schema_complet[l](resultats[l])
+    if isinstance(mon_noeud.tache_calcul, tacheGrille):
+        return _traiter_resultats_grille(mon_noeud, resultats)
+
+    resultats_purifies, erreur = _purifier_resultat(resultats, schema_complet)
+    if erreur is not None:
+        mon_noeud.abandonner_tache()
+        return None, erreur, None
 
     # Task was rejected
     if not mon_projet.valider(resultats_purifies):
         mon_noeud.abandonner_tache()
-        return {
+        return None, {
             "status": "error",
             "msg": "Submition validation failed",
-            "code": erreursClient.ECHEC_VALIDATION.value}
+            "code": erreursClient.ECHEC_VALIDATION.value}, None
 
     resultats = {**mon_noeud.tache_calcul.valeurs, **resultats_purifies}
 
-    mon_noeud.statut = statutNoeud.INACTIF
-    mon_noeud.tache_calcul.norealloc = True
-    mon_noeud.tache_calcul = None
+    return [resultats], None, mon_noeud
+
+
+def _traiter_resultats_grille(mon_noeud: NoeudCalcul, resultats: Dict) -> Tuple[
+        List[Dict[str, csc_var]], Dict, NoeudCalcul]:
+    """Checks the results submitted for a sub-grid (see _traiter_resultats()): the payload
+    holds a 'results' list, the results of each point of the sub-grid (in the order of the
+    sub-grid) being made of the variables of the outgoing scheme. The results of the skipped
+    points are ignored. The sub-grid is a single unit: if a point is rejected, so is the whole
+    sub-grid"""
+
+    tache = mon_noeud.tache_calcul
+    liste = resultats.get("results") if isinstance(resultats, dict) else None
+    if not isinstance(liste, list) or len(liste) != tache.nb_points:
+        mon_noeud.abandonner_tache()
+        return None, {"status": "error", "msg": "Invalid value for parameter \'results\'",
+                      "code": erreursClient.VALEUR_INVALIDE.value}, None
+
+    enregistrements = []
+    for i, valeurs in zip(tache.a_calculer, tache.configurations()):
+        resultats_purifies, erreur = _purifier_resultat(liste[i], mon_projet.schema_sortie)
+        if erreur is None:
+            resultats_purifies = {**valeurs, **resultats_purifies}
+            if not mon_projet.valider(resultats_purifies):
+                erreur = {"status": "error", "msg": "Submition validation failed",
+                          "code": erreursClient.ECHEC_VALIDATION.value}
+        if erreur is not None:
+            mon_noeud.abandonner_tache()
+            return None, dict(erreur, msg="{} (point {})".format(erreur["msg"], i)), None
+        enregistrements.append(resultats_purifies)
 
-    maBDD.enregistrer(resultats)
+    return enregistrements, None, mon_noeud
+
+
+def _purifier_resultat(resultats: Dict,
+                       schema: Dict[str, csc_var]) -> Tuple[Dict[str, csc_var], Dict]:
+    """Casts the results of a single configuration to the types of the scheme
+
+    Params:
+        resultats: the results sent by the client
+        schema: the variables the results must hold
+
+    Returns:
+        dict: the results, casted to the types of the scheme, or None if they were rejected
+        dict: if the results were rejected, the error message that should be transmitted
+            to the client; None otherwise
+    """
+
+    if not isinstance(resultats, dict):
+        return None, {"status": "error", "msg": "Invalid value for parameter \'payload\'",
+                      "code": erreursClient.VALEUR_INVALIDE.value}
+
+    resultats_purifies = {}
+    for l in schema:
+        # Part of the answer is missing -> we reject it
+        if l not in resultats:
+            return None, {"status": "error", "msg": "Missing variable '{}' in payload".format(
+                l), "code": erreursClient.MANQUE_VARIABLE_RESULTATS.value}
+        else:
+            try:
+                resultats_purifies[l] = schema[l](resultats[l])
+            except (TypeError, ValueError):
+                return None, {"status": "error", "msg": "Invalid value for variable '{}'".format(
+                    l), "code": erreursClient.VALEUR_INVALIDE.value}
+
+    return resultats_purifies, None
+
+
+@post('/api/v1/submit-results')
+def submit_results():
+    """Used by the slave server to submit its computation results"""
+
+    s = sanitize()
+    if not s[0]:
+        return s[1]
+
+    data = dict(s[1])
+    client = s[2]
+
+    if "nodeid" not in data:
+        return {"status": "error", "msg": "Missing field \'nodeid\'",
+                "code": erreursClient.MANQUE_CHAMP_REQUETE.value}
+    if "payload" not in data:
+        return {"status": "error", "msg": "Missing field \'payload\'",
+                "code": erreursClient.MANQUE_CHAMP_REQUETE.value}
+
+    erreur = traiter_resultats(client, [(data["nodeid"], data["payload"])],
+                               mon_projet.schema_total())[0]
+    if erreur is not None:
+        return erreur
 
     return {
         "status": "ok",
@@ -576,6 +599,61 @@ def submit_results():
         "code": erreursClient.PAS_ERREUR.value}
 
 
+@post('/api/v1/submit-results-batch')
+def submit_results_batch():
+    """Used by the slave server to submit the results of several nodes in a single request.
+
+    The field 'results' is a list of {"nodeid": ..., "payload": ...} objects. Each item is
+    checked on its own, the accepted ones are saved in the database with a single
+    multi-row insert and the answer contains a status for each item, in the same order.
+    """
+
+    s = sanitize()
+    if not s[0]:
+        return s[1]
+
+    data = dict(s[1])
+    client = s[2]
+
+    if "results" not in data:
+        return {"status": "error", "msg": "Missing field \'results\'",
+                "code": erreursClient.MANQUE_CHAMP_REQUETE.value}
+    if not isinstance(data["results"], list):
+        return {"status": "error", "msg": "Invalid value for parameter \'results\'",
+                "code": erreursClient.VALEUR_INVALIDE.value}
+
+    soumissions = []
+    statuts = []
+    for item in data["results"]:
+        if not isinstance(item, dict) or "nodeid" not in item or "payload" not in item:
+            statuts.append({"status": "error", "msg": "Missing field \'nodeid\' or \'payload\'",
+                            "code": erreursClient.MANQUE_CHAMP_REQUETE.value})
+        else:
+            soumissions.append((item["nodeid"], item["payload"]))
+            statuts.append(None)
+
+    # the accepted results are saved with a single multi-row insert
+    erreurs = iter(traiter_resultats(client, soumissions, mon_projet.schema_total()))
+    nb_acceptes = 0
+    for i, item in enumerate(data["results"]):
+        if statuts[i] is not None:
+            continue
+        erreur = next(erreurs)
+        if erreur is not None:
+            statuts[i] = {"nodeid": item["nodeid"], **erreur}
+        else:
+            nb_acceptes += 1
+            statuts[i] = {"nodeid": item["nodeid"], "status": "ok",
+                          "msg": "Work successfully submitted",
+                          "code": erreursClient.PAS_ERREUR.value}
+
+    return {
+        "status": "ok",
+        "msg": "{}/{} results successfully submitted".format(nb_acceptes, len(statuts)),
+        "code": erreursClient.PAS_ERREUR.value,
+        "statuses": statuts}
+
+
 @post('/api/v1/drop-task')
 def drop_task():
     """Used by the slave server to drop a task"""
@@ -585,7 +663,7 @@ def drop_task():
         return s[1]
 
     data = dict(s[1])
-    client = sessions_maitres[data["mastertoken"]]
+    client = s[2]
 
     if "nodeid" not in data:
         return {"status": "error", "msg": "Missing field \'nodeid\'",
@@ -601,11 +679,12 @@ def drop_task():
             "msg": "No matching node found",
             "code": erreursClient.NOEUD_INEXISTANT.value}
 
-    if mon_noeud.statut != statutNoeud.ACTIF:
-        return {"status": "error", "msg": "Node is not active ! (status {})".format(
-            mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
+    with client.verrou:
+        if mon_noeud.statut != statutNoeud.ACTIF:
+            return {"status": "error", "msg": "Node is not active ! (status {})".format(
+                mon_noeud.statut), "code": erreursClient.MAUVAIS_STATUT_NOEUD.value}
 
-    mon_noeud.abandonner_tache()
+        mon_noeud.abandonner_tache()
 
     return {
         "status": "ok",
@@ -620,7 +699,7 @@ def ret_sysinfo():
     running on different computers)"""
 
     r = {}
-    for c in sessions_maitres.values():
+    for c in repartiteur.liste_clients():
         tmp = {}
         for idnoeud, noeud in c.liste_noeuds():
             tmp[idnoeud] = {
@@ -654,7 +733,77 @@ def ret_sysinfo():
         "unites": r,
         "nb_densifications_totales": mon_projet.nb_densifications,
         "nb_densifcations_effectuees": mon_projet.nb_densifications_effectuees,
-        "avancement": avancement}
+        "avancement": avancement,
+        "file_taches": repartiteur.producteur.taille(),
+        "etat_repartition": repartiteur.etat.name,
+        "nb_cannibalisations": repartiteur.nb_cannibalisations}
+
+
+def formater_ndjson(colonnes: List[str], blocs: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    """Turns the blocks of rows read from the database into NDJSON, one object per row"""
+
+    for bloc in blocs:
+        yield "".join([json.dumps(dict(zip(colonnes, ligne))) + "\n"
+                       for ligne in bloc]).encode("utf-8")
+
+
+def formater_csv(colonnes: List[str], blocs: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    """Turns the blocks of rows read from the database into CSV, with a header line"""
+
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon)
+    ecrivain.writerow(colonnes)
+    for bloc in blocs:
+        ecrivain.writerows(bloc)
+        yield tampon.getvalue().encode("utf-8")
+        tampon.seek(0)
+        tampon.truncate()
+    if tampon.tell() > 0:   # empty export: only the header
+        yield tampon.getvalue().encode("utf-8")
+
+
+@route('/api/v1/results')
+def export_results():
+    """Streams the results of the project, the best ones (according to the densification
+    variable) first.
+
+    Query parameters:
+        key: the key of the project
+        format: (optionnal) "ndjson" (default) or "csv"
+        niv_densification: (optionnal) only exports the results of this densification level
+
+    The rows are read from the database and sent by blocks (chunked response), so that the
+    memory used doesn't depend on the number of results."""
+
+    # pylint: disable=no-member
+    if request.query.get("key") != clef_secrete:
+        return {"status": "error",
+                "msg": "Authentification failed",
+                "code": erreursClient.ECHEC_AUTH.value}
+
+    format_export = request.query.get("format", "ndjson")
+    if format_export not in ("ndjson", "csv"):
+        return {"status": "error",
+                "msg": "Unknown format '{}' (ndjson or csv)".format(format_export),
+                "code": erreursClient.VALEUR_INVALIDE.value}
+
+    niveau = request.query.get("niv_densification")
+    if niveau is not None:
+        try:
+            niveau = int(niveau)
+        except ValueError:
+            return {"status": "error",
+                    "msg": "niv_densification should be an integer",
+                    "code": erreursClient.VALEUR_INVALIDE.value}
+
+    blocs = maBDD.exporter(mon_projet.var_densification, niveau, taille_bloc_export)
+    if format_export == "csv":
+        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        response.headers['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(
+            nom_projet)
+        return formater_csv(maBDD.colonnes, blocs)
+    response.headers['Content-Type'] = 'application/x-ndjson'
+    return formater_ndjson(maBDD.colonnes, blocs)
 
 
 @post('/api/v1/unregister-master')
@@ -665,12 +814,9 @@ def unregister_master():
     if not s[0]:
         return s[1]
 
-    data = dict(s[1])
-
-    client = sessions_maitres[data["mastertoken"]]
+    client = s[2]
     nom = client.nom
-    for noeud in client.noeuds.values():
-        noeud.abandonner_tache()
+    # the tasks of its nodes are handed out again
     client.deconnecter()
     logging.info("Slave server {} [{}] has disconnected".format(
         nom, request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')))
@@ -686,18 +832,24 @@ def serve_webui(fichier):
     return static_file(fichier, root='webui/')
 
 
-def init(projet: ProjetCascada) -> None:
+def init(projet: ProjetCascada, reprendre: bool = False) -> None:
     """Initializes the server.
 
     Params:
         projet: the cascada project object
+        reprendre: (optionnal) whether the execution resumes from the last checkpoint
+                   (<project name>.reprise.json), if there is one, instead of starting
+                   over; defaults to False
     """
 
     global nom_projet
     global maBDD
-    global sequenceur
     global mon_projet
     global clef_secrete
+    global repartiteur
+    global arret_faucheuse
+    global arret_reprise
+    global fichier_reprise
 
     logging.info("\n\n\n")
     logging.info("**** SERVER INITIALIZATION ****")
@@ -710,16 +862,48 @@ def init(projet: ProjetCascada) -> None:
     mon_projet = projet
     nom_projet = mon_projet.nom
     clef_secrete = projet.password
-    maBDD = db.controlleurBDD(nom_projet, mon_projet.schema_total(), "db_cred.json")
-    sequenceur = mon_projet.sequenceur
-
-
-def launch(port: int = 8088, host: str = '0.0.0.0') -> None:
+    maBDD = stockage.creer_stockage(mon_projet.moteur_bdd, nom_projet, mon_projet.schema_total(),
+                                    schema_entree=mon_projet.schema_entree,
+                                    fichier_login="db_cred.json",
+                                    fichier_journal=nom_projet + ".journal")
+
+    if repartiteur is not None:
+        repartiteur.arreter()
+    repartiteur = Repartiteur(mon_projet, maBDD, taille_file_taches,
+                              taille_grille=taille_grille)
+    fichier_reprise = nom_projet + ".reprise.json"
+    if reprendre:
+        etat = reprise.lire_point_reprise(fichier_reprise)
+        if etat is not None:
+            logging.info("Resuming from the checkpoint {}".format(fichier_reprise))
+            repartiteur.restaurer(etat)
+    repartiteur.demarrer()
+
+    if arret_faucheuse is not None:
+        arret_faucheuse.set()
+    arret_faucheuse = threading.Event()
+    threading.Thread(target=boucle_faucheuse, args=(arret_faucheuse,), name="cascada-faucheuse",
+                     daemon=True).start()
+
+    if arret_reprise is not None:
+        arret_reprise.set()
+    arret_reprise = threading.Event()
+    threading.Thread(target=boucle_reprise, args=(arret_reprise,), name="cascada-reprise",
+                     daemon=True).start()
+
+
+def launch(port: int = 8088, host: str = '0.0.0.0', mode: str = "wsgiref",
+           nb_threads: int = 32) -> None:
     """Launches the server.
 
     Params:
         port: the port the server should listen on
         host: the adress the server should bind to
+        mode: (optionnal) either "wsgiref", bottle's default single-threaded server, or "async",
+                    an asyncio server supporting keep-alive connections that runs the request
+                    handlers on a pool of threads (see serveur_async.py); defaults to "wsgiref"
+        nb_threads: (optionnal) the number of threads running the request handlers in the
+                    "async" mode; defaults to 32
 
     Returns:
         None
@@ -729,4 +913,9 @@ def launch(port: int = 8088, host: str = '0.0.0.0') -> None:
     """
 
     logging.info("**** SERVER IS STARTING ****")
-    run(host=host, port=port, debug=False)
+    if mode == "async":
+        serveur_async.lancer(default_app(), host=host, port=port, nb_threads=nb_threads)
+    elif mode == "wsgiref":
+        run(host=host, port=port, debug=False)
+    else:
+        raise ValueError("Unknown server mode '{}'".format(mode))
@@ -0,0 +1,302 @@
+"""Defines an asyncio-based HTTP server, used to serve the bottle application to many
+concurrently connected slave servers.
+
+The connections (including keep-alive ones) are handled by the event loop, while the
+request handlers, which may wait on the database, run on a pool of threads: a slow query
+only holds one thread and never stalls the other connections."""
+
+from typing import Callable, Dict, List, Tuple
+
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+
+TAILLE_MAX_ENTETES = 64 * 1024
+TAILLE_MAX_CORPS = 64 * 1024 * 1024
+
+
+class RequeteInvalide(Exception):
+    """The request sent by the client could not be understood"""
+
+    def __init__(self, statut: int = 400):
+        self.statut = statut
+
+
+class ServeurAsync():
+    """Serves a WSGI application over HTTP/1.1 using asyncio"""
+
+    def __init__(self, app: Callable, host: str = '0.0.0.0', port: int = 8088,
+                 nb_threads: int = 32, delai_inactivite: float = 75.):
+        """Initializes the server
+
+        Params:
+            app: the WSGI application (eg bottle.default_app())
+            host: the adress the server should bind to
+            port: the port the server should listen on
+            nb_threads: the number of threads running the request handlers
+            delai_inactivite: the number of seconds after which an idle keep-alive connection
+                              is closed
+        """
+
+        self.app = app
+        self.host = host
+        self.port = port
+        self.delai_inactivite = delai_inactivite
+        self.executeur = ThreadPoolExecutor(max_workers=nb_threads,
+                                            thread_name_prefix="cascada-http")
+
+    def lancer(self) -> None:
+        """Runs the server until it is interrupted"""
+        try:
+            asyncio.run(self._servir())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executeur.shutdown(wait=False)
+
+    async def _servir(self) -> None:
+        serveur = await asyncio.start_server(self._connexion, self.host, self.port,
+                                             limit=TAILLE_MAX_ENTETES)
+        logging.info("Asynchronous server listening on {}:{}".format(self.host, self.port))
+        async with serveur:
+            await serveur.serve_forever()
+
+    async def _connexion(self, reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+        """Handles a connection, which can carry several requests (keep-alive)"""
+
+        pair = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    ligne = await asyncio.wait_for(reader.readline(), self.delai_inactivite)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    # the line is longer than the limit of the stream
+                    await self._ecrire_erreur(writer, int(HTTPStatus.REQUEST_URI_TOO_LONG))
+                    break
+                if not ligne:
+                    break
+                if ligne in (b'\r\n', b'\n'):  # tolerated between two requests
+                    continue
+
+                try:
+                    environ, garder = await self._lire_requete(ligne, reader, pair)
+                except RequeteInvalide as e:
+                    await self._ecrire_erreur(writer, e.statut)
+                    break
+
+                garder = await self._repondre(environ, writer, garder)
+                if not garder:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _lire_requete(self, ligne: bytes, reader: asyncio.StreamReader,
+                            pair) -> Tuple[Dict, bool]:
+        """Reads a request and builds the matching WSGI environment
+
+        Returns:
+            dict: the WSGI environment
+            bool: whether the connection should be kept open after the answer
+        """
+
+        try:
+            methode, cible, version = ligne.decode('latin-1').strip().split(' ', 2)
+        except ValueError:
+            raise RequeteInvalide
+
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise RequeteInvalide(int(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED))
+
+        entetes = {}
+        taille = 0
+        while True:
+            try:
+                ligne = await reader.readline()
+            except ValueError:
+                # the line is longer than the limit of the stream
+                raise RequeteInvalide(int(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE))
+            taille += len(ligne)
+            if taille > TAILLE_MAX_ENTETES:
+                raise RequeteInvalide(int(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE))
+            if ligne in (b'\r\n', b'\n', b''):
+                break
+            nom, _, valeur = ligne.decode('latin-1').partition(':')
+            entetes[nom.strip().lower()] = valeur.strip()
+
+        if 'transfer-encoding' in entetes:
+            raise RequeteInvalide(int(HTTPStatus.NOT_IMPLEMENTED))
+
+        try:
+            longueur = int(entetes.get('content-length', 0))
+        except ValueError:
+            raise RequeteInvalide
+        if not 0 <= longueur <= TAILLE_MAX_CORPS:
+            raise RequeteInvalide(int(HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
+        corps = await reader.readexactly(longueur) if longueur > 0 else b''
+
+        chemin, _, requete = cible.partition('?')
+        connexion = entetes.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            garder = connexion != 'close'
+        else:
+            garder = connexion == 'keep-alive'
+
+        environ = {
+            'REQUEST_METHOD': methode,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': chemin,
+            'QUERY_STRING': requete,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': pair[0] if pair else '',
+            'CONTENT_LENGTH': str(longueur),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(corps),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if 'content-type' in entetes:
+            environ['CONTENT_TYPE'] = entetes['content-type']
+        for nom, valeur in entetes.items():
+            if nom not in ('content-type', 'content-length'):
+                environ['HTTP_' + nom.upper().replace('-', '_')] = valeur
+
+        return environ, garder
+
+    async def _repondre(self, environ: Dict, writer: asyncio.StreamWriter,
+                        garder: bool) -> bool:
+        """Runs the application on a worker thread and sends its answer
+
+        Returns:
+            bool: whether the connection should be kept open
+        """
+
+        boucle = asyncio.get_running_loop()
+        statut, entetes, corps = await boucle.run_in_executor(self.executeur, appeler_wsgi,
+                                                              self.app, environ)
+
+        noms = {nom.lower() for nom, valeur in entetes}
+        # without a length, the body is sent in chunks (HTTP/1.1) or until the connection
+        # is closed (HTTP/1.0)
+        par_blocs = False
+        if 'content-length' not in noms:
+            if isinstance(corps, (list, tuple)):
+                entetes.append(('Content-Length', str(sum(len(b) for b in corps))))
+            elif environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                entetes.append(('Transfer-Encoding', 'chunked'))
+                par_blocs = True
+            else:
+                garder = False
+        entetes.append(('Connection', 'keep-alive' if garder else 'close'))
+
+        tete = "{} {}\r\n".format(environ['SERVER_PROTOCOL'], statut)
+        tete += "".join("{}: {}\r\n".format(nom, valeur) for nom, valeur in entetes)
+        writer.write((tete + "\r\n").encode('latin-1'))
+
+        try:
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                pass
+            elif isinstance(corps, (list, tuple)):
+                for bloc in corps:
+                    writer.write(bloc)
+            else:
+                # the body is a generator that might be doing some work (database...),
+                # we pull it from the worker threads as well
+                iterateur = iter(corps)
+                while True:
+                    bloc = await boucle.run_in_executor(self.executeur, next, iterateur, None)
+                    if bloc is None:
+                        break
+                    if len(bloc) == 0:
+                        continue
+                    if par_blocs:
+                        writer.write("{:x}\r\n".format(len(bloc)).encode('latin-1'))
+                        writer.write(bloc)
+                        writer.write(b'\r\n')
+                    else:
+                        writer.write(bloc)
+                    await writer.drain()
+                if par_blocs:
+                    writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            if hasattr(corps, 'close'):
+                await boucle.run_in_executor(self.executeur, corps.close)
+
+        return garder
+
+    async def _ecrire_erreur(self, writer: asyncio.StreamWriter, statut: int) -> None:
+        raison = HTTPStatus(statut).phrase
+        writer.write("HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(
+            statut, raison).encode('latin-1'))
+        await writer.drain()
+
+
+def appeler_wsgi(app: Callable, environ: Dict) -> Tuple[str, List[Tuple[str, str]], object]:
+    """Calls the WSGI application
+
+    Returns:
+        str: the status line (eg "200 OK")
+        list: the headers
+        iterable: the body
+    """
+
+    reponse = {}
+
+    def start_response(statut, entetes, exc_info=None):
+        reponse['statut'] = statut
+        reponse['entetes'] = list(entetes)
+        return lambda donnees: None  # the write() callable is not supported
+
+    corps = app(environ, start_response)
+    if isinstance(corps, (list, tuple)):
+        # the whole body is already there (this is the case of most of the API's answers)
+        pass
+    else:
+        # some applications only call start_response() when their body is first iterated
+        iterateur = iter(corps)
+        premier = next(iterateur, None)
+
+        def corps_complet(premier=premier, iterateur=iterateur, original=corps):
+            try:
+                if premier is not None:
+                    yield premier
+                yield from iterateur
+            finally:
+                if hasattr(original, 'close'):
+                    original.close()
+
+        if premier is None:
+            if hasattr(corps, 'close'):
+                corps.close()
+            corps = []
+        else:
+            corps = corps_complet()
+
+    return reponse['statut'], reponse['entetes'], corps
+
+
+def lancer(app: Callable, host: str = '0.0.0.0', port: int = 8088, nb_threads: int = 32) -> None:
+    """Serves app until the process is interrupted
+
+    Params:
+        app: the WSGI application
+        host: the adress the server should bind to
+        port: the port the server should listen on
+        nb_threads: the number of threads running the request handlers
+    """
+
+    ServeurAsync(app, host, port, nb_threads).lancer()
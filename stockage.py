@@ -0,0 +1,436 @@
+"""Defines the interface of the storage backends, which save the results and drive the
+densification, and the function used to pick one for a project"""
+
+import atexit
+import logging
+import math
+import threading
+from functools import wraps
+from numbers import Number
+from typing import Dict, Iterator, List, Type, Tuple
+
+import vartypes
+from ecrivain import EcrivainGroupe
+from journal import EcrivainJournal
+from voisins import IndexVoisins
+
+
+class BDDException(Exception):
+    pass
+
+
+class BDDExceptionTableNonValidee(BDDException):
+    """The supplied name for the project matches an existing table that is not compatible with
+    the supplied scheme for the project"""
+
+
+class BDDExceptionVariableNonValide(BDDException):
+    """At least one of the names choosed for the variables has been rejected by the
+    database server.
+    Please choose another one"""
+
+
+class BDDExceptionResultatsIngerable(BDDException):
+    """Query result could not be interpreted by the program"""
+
+
+class BDDExceptionIndexImpossible(BDDException):
+    """The unique index could not be added to the existing table of the project, most likely
+    because it already contains duplicate records.
+    Please remove them first"""
+
+
+def apres_ecritures(methode):
+    """Makes the decorated method of the controller wait for the results saved so far to be
+    written, so that it reads them"""
+
+    @wraps(methode)
+    def methode_apres_ecritures(self, *args, **kwargs):
+        self.ecrivain.vider()
+        return methode(self, *args, **kwargs)
+
+    return methode_apres_ecritures
+
+
+def avec_verrou(methode):
+    """Serializes the calls made to the decorated method of the controller, which reads or
+    changes the densification state"""
+
+    @wraps(methode)
+    def methode_verrouillee(self, *args, **kwargs):
+        with self.verrou:
+            return methode(self, *args, **kwargs)
+
+    return methode_verrouillee
+
+
+# the name of the unique index on the columns generated by the server and the densification level
+NOM_INDEX_UNIQUE = "csc_unicite"
+
+
+class Stockage():
+    """The storage backend of a project: saves the results and finds the most promising ones
+    to densify around.
+
+    The results are written by a background thread (see EcrivainGroupe); the backends only
+    have to supply _ecrire_lot() and the queries."""
+
+    def __init__(self, nom_projet: str, schema: Dict[str, Type[vartypes.csc_var]],
+                 schema_entree: Dict[str, Type[vartypes.csc_var]] = None):
+        """Initializes the state shared by the backends
+
+        Params:
+            nom_projet: the name given to the project, used to create/open a table
+            schema: the complete data scheme (see controlleurBDD)
+            schema_entree: (optionnal) the part of the scheme generated by the server; a record
+                           is unique for these variables and the densification level.
+                           Defaults to the whole scheme
+        """
+
+        self.nom_projet = nom_projet
+        self.schema = schema
+        self.verrou = threading.RLock()
+
+        if "id" in schema or "niv_densification" in schema:
+            raise BDDExceptionVariableNonValide
+
+        if schema_entree is None:
+            schema_entree = schema
+        # the columns of the unique index, which makes the duplicate records impossible (for
+        # instance when a cannibalized task is computed twice) and the lookups fast
+        self.colonnes_uniques = [nom for nom in schema if nom in schema_entree]
+        self.colonnes_uniques.append("niv_densification")
+        # the columns of the records, as written and exported
+        self.colonnes = list(schema.keys()) + ["niv_densification"]
+
+        self.seuil_densification = None
+        self.variable_densification = None
+        self.offset_cour_densification = 0
+        self.limite_select = None
+        # the best records of the level, fetched once by densifier(); candidats[0] is the
+        # record of rank offset_candidats
+        self.candidats = []
+        self.offset_candidats = 0
+        # the input coordinates of the records of the level, to bound the candidates
+        self.index_voisins = None
+        self.bornes_candidats = None    # (variables, bounds of each candidate), see bornes()
+
+        self.densifie = False
+
+        self.a_afficher_erreur_plus_echantillon = False
+
+        # the densification depth
+        # we have no choice but to save it in the table; if we don't, each time we'll reach a
+        # new densification level, we run the risk of "drowning" the best candidates of the
+        # old level with new records
+        self.niveau_densification = 1
+
+        self.ecrivain = None
+
+    def _demarrer_ecrivain(self, taille_lot: int, delai_max: float,
+                           fichier_journal: str = None) -> None:
+        """Starts the buffered writer, once the table is ready; the results are logged in
+        fichier_journal before being written, if given (see EcrivainJournal)"""
+
+        # the results are written by batches, in a single transaction each
+        if fichier_journal is None:
+            self.ecrivain = EcrivainGroupe(self._ecrire_lot, taille_lot=taille_lot,
+                                           delai_max=delai_max)
+        else:
+            self.ecrivain = EcrivainJournal(self._ecrire_lot, fichier_journal,
+                                            self._encoder_ligne, self._decoder_ligne,
+                                            taille_lot=taille_lot, delai_max=delai_max)
+        self.ecrivain.start()
+        atexit.register(self.fermer)
+
+    def _encoder_ligne(self, ligne: Dict[str, vartypes.csc_var]) -> List[Number]:
+        """Turns a row (as returned by _caster_resultat()) into the list of its values"""
+        return [ligne[c].value for c in self.colonnes]
+
+    def _decoder_ligne(self, valeurs: List[Number]) -> Dict[str, vartypes.csc_var]:
+        """Turns a list of values back into a row"""
+        types = list(self.schema.values()) + [vartypes.csc_int32]
+        return {c: t(v) for c, t, v in zip(self.colonnes, types, valeurs)}
+
+    def enregistrer(self, resultat: Dict[str, vartypes.csc_var]):
+        """Saves the result of a computation in the database
+
+        Params:
+            resultat: the result of the computation, with the following shape:
+                                {"variable name": variable_value}
+                        variable_value being an instance of the cascada type matching the
+                        type assigned to said variable in the scheme provided during the
+                        initialization
+
+                        Example:
+                            {"K": csc_float(7.4), "n": csc_uint32(14638), "E": csc_float(15.9)}
+
+        Returns:
+            None
+
+        Note:
+            The result is written shortly after by the buffered writer, see vider(); if the
+            results are logged, it is on disk once the call returns
+        """
+
+        self.ecrivain.ajouter(self._caster_resultat(resultat))
+
+    def enregistrer_lot(self, resultats: List[Dict[str, vartypes.csc_var]]):
+        """Saves the results of several computations in the database
+
+        Params:
+            resultats: a list of results, each of them having the shape expected by enregistrer()
+
+        Returns:
+            None
+        """
+
+        self.ecrivain.ajouter_lot([self._caster_resultat(r) for r in resultats])
+
+    def vider(self) -> None:
+        """Waits until every result saved so far is written in the database"""
+        self.ecrivain.vider()
+
+    def fermer(self) -> None:
+        """Writes the pending results and stops the buffered writer"""
+        if self.ecrivain is not None:
+            self.ecrivain.arreter()
+
+    def _caster_resultat(self,
+                         resultat: Dict[str, vartypes.csc_var]) -> Dict[str, vartypes.csc_var]:
+        """Recasts a result according to the scheme and tags it with the current
+        densification level"""
+
+        r2 = {}
+        for nom, type_var in self.schema.items():
+            r2[nom] = type_var(resultat[nom])
+        r2["niv_densification"] = vartypes.csc_int32(self.niveau_densification)
+        return r2
+
+    def densification_en_cours(self) -> bool:
+        """Checks whether a densification procedure is running
+
+        Returns:
+            True if a densification procedure is running; False if not
+        """
+
+        return self.densifie
+
+    @avec_verrou
+    def schema_suivant(self,
+                       schema_entree: Dict[str,
+                                           Type[vartypes.csc_var]]) -> Dict[str,
+                                                                            Tuple[Number,
+                                                                                  Number,
+                                                                                  Number]]:
+        """Does most of the densification work.
+        This consists in finding the best/most promising values
+        for the parameters sent to the client and "zooming" on them
+        and increasing the resolution (ie the step size between
+        each sample point) near these points.
+
+        Params:
+            schema_entree: a scheme with the same shape as the scheme used to
+                        initialize the database controller, but it should only
+                        cointain the so-called outgoing variables that will be
+                        sent to the slave servers, as these are the ones the
+                        master have full control over
+
+        Returns:
+            dict: a dictionnary which keys are the keys of schema_entree and the values
+                being 3-value tuples (<center value>, <immediately inferior neighbor>,
+                <immediately superior neighbor>). The center value is the value that was
+                previously computed by the client and determined to be "promising". Each
+                of the neighbors coordinates (say there are N of them) are computed by
+                iteratively setting the other coordinates (N-1 variables) to their respective
+                value in the center vector, and then looking up the closet neighbors for the
+                remaining "free" coordinate amongst the records of the DB having the other,
+                N-1 variables set to their value.
+                Some neighbors might be missing, for instance if the selected record is the one
+                having the maximum values for the coordinates (is that case, their is no upper
+                neighbor), then they are replaced by <center value>.
+                If there are no new promising configurations to fetch (because the maximum number
+                of candidates as computed in densifier() has been reached), the function returns
+                None; in that case, one should call densifier() again.
+        """
+
+        if not self.densifie:
+            return None
+
+        # the neighbors are looked up in the index of the level built by densifier(), the
+        # densification variable being left out (it's what we're trying to maximize)
+        bornes = self._candidat_suivant([n for n in schema_entree
+                                         if n != self.variable_densification])
+        if bornes is None:
+            return None
+
+        if self.offset_cour_densification >= self.limite_select:
+            self.densifie = False
+
+        # offset_cour_densification-1 because we just incremented it
+        logging.info(
+            "\tNew scheme drawn: {}, offset {}".format(
+                bornes, self.offset_cour_densification - 1))
+
+        return bornes
+
+    @avec_verrou
+    def etat_densification(self) -> Dict:
+        """Returns the densification state, to be saved in a checkpoint (see
+        restaurer_densification())"""
+
+        return {"niveau": self.niveau_densification,
+                "densifie": self.densifie,
+                "seuil": self.seuil_densification,
+                "variable": self.variable_densification,
+                "offset": self.offset_cour_densification,
+                "offset_candidats": self.offset_candidats,
+                "limite": self.limite_select}
+
+    @apres_ecritures
+    @avec_verrou
+    def restaurer_densification(self, etat: Dict) -> None:
+        """Restores the densification state returned by etat_densification(), for instance
+        after a restart; the candidates of the level are fetched again"""
+
+        self.niveau_densification = etat["niveau"]
+        self.seuil_densification = etat["seuil"]
+        self.variable_densification = etat["variable"]
+        self.limite_select = etat["limite"]
+        self.densifie = etat["densifie"]
+        self.candidats = []
+        self.index_voisins = None
+        self.bornes_candidats = None
+        if self.densifie:
+            # the candidates were drawn from the previous level
+            self._lire_niveau(self.niveau_densification - 1, self.limite_select,
+                              etat["offset_candidats"])
+        self.offset_cour_densification = etat["offset"]
+
+    def _charger_candidats(self, candidats: List[Dict], offset: int,
+                           enregistrements: List[Dict[str, Number]]) -> None:
+        """Keeps the best records of the level, as fetched by densifier() from rank offset, and
+        indexes the input coordinates of the records of the level (enregistrements)"""
+
+        self.candidats = list(candidats)
+        self.offset_candidats = offset
+        self.index_voisins = IndexVoisins(enregistrements, self.colonnes_uniques[:-1])
+        self.bornes_candidats = None
+
+    def _candidat_suivant(self, noms: List[str]) -> Dict[str, Tuple[Number, Number, Number]]:
+        """Returns the box of the next candidate of the level, without asking the database
+
+        Params:
+            noms: the variables to bound
+
+        Returns:
+            dict: the box (see schema_suivant()), or None (and the densification ends) if every
+                  candidate was handed out
+        """
+
+        i = self.offset_cour_densification - self.offset_candidats
+        if not 0 <= i < len(self.candidats):
+            self.densifie = False
+            return None
+
+        # all the candidates are bounded at once, the first time one is asked for
+        if self.bornes_candidats is None or self.bornes_candidats[0] != noms:
+            self.bornes_candidats = (noms, self.index_voisins.bornes(self.candidats, noms))
+
+        self.offset_cour_densification += 1
+        return self.bornes_candidats[1][i]
+
+    def _calculer_limite(self, seuil: float, count: int) -> int:
+        """Computes the number of records to draw at the current level, knowing it generated
+        count records"""
+
+        logging.info(
+            "Densification procedure on {} initialized. Current densifcation level is {}; "
+            "this level has generated {} records".format(
+                self.variable_densification,
+                self.niveau_densification,
+                count))
+
+        # Computing the number of records we're keeping
+        if self.niveau_densification == 1:
+            limite = int(math.ceil(seuil * count))
+        else:
+
+            # We know that last time we drew limite_select configurations,
+            # therefore each configuration would have had count/limite_select iterations.
+            # Using a max to avoid division by zero errors
+            limite = int(math.ceil(seuil * count / max(self.limite_select, 1)))
+
+        if limite == 0 and not self.a_afficher_erreur_plus_echantillon:
+            logging.warning(
+                "No record found. "
+                "Likely cause: records for this step have all been previously computed. "
+                "Fix: adjust the numerical paramters for the densification. "
+                "The issue we keep happening for the other densifications but this warning will "
+                "only show up once."
+            )
+            self.a_afficher_erreur_plus_echantillon = True
+
+        logging.info("\tFor this densification step, {} schemes will be drawn".format(limite))
+        return limite
+
+    # To be supplied by the backends
+
+    def _ecrire_lot(self, lignes: List[Dict[str, vartypes.csc_var]]):
+        """Writes a batch of results (as returned by _caster_resultat()) in a single
+        transaction, ignoring the ones already saved; called by the buffered writer"""
+        raise NotImplementedError
+
+    def existe(self, valeurs: Dict[str, vartypes.csc_var]) -> bool:
+        """Checks if a record containing valeurs exists"""
+        raise NotImplementedError
+
+    def enregistrements_dans(self,
+                             bornes: Dict[str, Tuple[Number, Number]]) -> List[Dict[str, Number]]:
+        """Fetches the records which variables are within the supplied limits"""
+        raise NotImplementedError
+
+    def densifier(self, seuil: float, variable: str, offset: int = 0):
+        """Sets up the densification of the next level (see controlleurBDD.densifier())"""
+        raise NotImplementedError
+
+    def _lire_niveau(self, niveau: int, limite: int, offset: int) -> None:
+        """Fetches the candidates of a level and the input coordinates of its records, then
+        gives them to _charger_candidats()"""
+        raise NotImplementedError
+
+    def exporter(self, ordre: str, niveau: int = None,
+                 taille_bloc: int = 1000) -> Iterator[List[Tuple]]:
+        """Streams the records (see controlleurBDD.exporter())"""
+        raise NotImplementedError
+
+
+def creer_stockage(moteur: str, nom_projet: str, schema: Dict[str, Type[vartypes.csc_var]],
+                   schema_entree: Dict[str, Type[vartypes.csc_var]] = None,
+                   fichier_login: str = "db_cred.json", **options) -> Stockage:
+    """Opens the storage backend of a project
+
+    Params:
+        moteur: "mysql" (a MySQL/MariaDB server, which login info is in fichier_login) or
+                "sqlite" (an embedded database, in the file <nom_projet>.sqlite3)
+        nom_projet: the name given to the project
+        schema: the complete data scheme
+        schema_entree: (optionnal) the part of the scheme generated by the server
+        fichier_login: (optionnal) the login info of the MySQL server
+        options: passed on to the backend
+
+    Returns:
+        Stockage: the backend
+    """
+
+    # the backends are only imported when used: the MySQL connector isn't needed to run
+    # with SQLite
+    if moteur == "mysql":
+        import db
+        return db.controlleurBDD(nom_projet, schema, fichier_login, schema_entree=schema_entree,
+                                 **options)
+    elif moteur == "sqlite":
+        import db_sqlite
+        return db_sqlite.controlleurSQLite(nom_projet, schema, schema_entree=schema_entree,
+                                           **options)
+    raise ValueError("Unknown storage backend {}".format(moteur))
@@ -0,0 +1,424 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from compteur import CompteurLogRange, CompteurRange
+from ordres import OrdreAleatoire, OrdreHalton, OrdreInverse, OrdreProgressif
+from projet import ProjetCascada
+from reprise import ecrire_point_reprise, lire_point_reprise
+from repartiteur import Repartiteur, A_REESSAYER
+from seq import Sequenceur
+from vartypes import csc_float, csc_uint32
+
+
+class BDDMemoire():
+    """A database controller that never densifies and doesn't store anything"""
+
+    def __init__(self, enregistrements=None):
+        self.enregistrements = enregistrements if enregistrements is not None else []
+
+    def existe(self, valeurs):
+        # the completion bitmap should answer instead
+        raise AssertionError("existe() called for {}".format(valeurs))
+
+    def enregistrements_dans(self, bornes):
+        return [e for e in self.enregistrements
+                if all(b[0] <= e[nom] <= b[1] for nom, b in bornes.items())]
+
+    def densification_en_cours(self):
+        return False
+
+    def etat_densification(self):
+        return {}
+
+    def restaurer_densification(self, etat):
+        pass
+
+
+class BDDReprise(BDDMemoire):
+    """A database controller which records are looked up one by one, as after a restart"""
+
+    def existe(self, valeurs):
+        return {nom: v.value for nom, v in valeurs.items()} in self.enregistrements
+
+
+class BDDBoites(BDDMemoire):
+    """A database controller which densification yields a fixed list of candidate boxes"""
+
+    def __init__(self, boites):
+        BDDMemoire.__init__(self)
+        self.boites = boites
+        self.restantes = []
+        self.densifie = False
+        self.nb_densifications = 0
+
+    def densification_en_cours(self):
+        return self.densifie
+
+    def densifier(self, facteur_selection, var_densification):
+        self.nb_densifications += 1
+        self.restantes = list(self.boites)
+        self.densifie = True
+
+    def schema_suivant(self, schema_densification):
+        if len(self.restantes) == 0:
+            self.densifie = False
+            return None
+        return self.restantes.pop(0)
+
+
+class TestRepartiteur(unittest.TestCase):
+
+    NB_THREADS = 16
+    NB_NOEUDS = 4
+    COTE = 60
+
+    def setUp(self):
+        schema = {"X": csc_float, "Y": csc_float}
+        sequenceur = Sequenceur(schema, {"X": (0, 1, self.COTE, np.linspace),
+                                         "Y": (0, 1, self.COTE, np.linspace)})
+        projet = ProjetCascada("Stress", sequenceur, {"E": csc_float}, schema, "E",
+                               0, 0.5, 1, "mdp")
+        self.repartiteur = Repartiteur(projet, BDDMemoire(), taille_file_taches=64)
+        self.repartiteur.demarrer()
+
+        self.grille = set()
+        for x in np.linspace(0, 1, self.COTE):
+            for y in np.linspace(0, 1, self.COTE):
+                self.grille.add((csc_float(x).value, csc_float(y).value))
+
+        self.termines = []
+        self.verrou_termines = threading.Lock()
+
+    def esclave(self, graine, proba_abandon):
+        alea = random.Random(graine)
+        client = self.repartiteur.ouvrir_session("esclave")
+        noeuds = [client.recuperer_noeud(client.ajouter_noeud()) for i in range(self.NB_NOEUDS)]
+        fini = False
+        while not fini:
+            for noeud in noeuds:
+                tache = self.repartiteur.obtenir_tache()
+                if tache is A_REESSAYER:
+                    # the held tasks are completed below, which lets the level end
+                    time.sleep(0.01)
+                    break
+                if tache is None:
+                    fini = True
+                    break
+                self.assertTrue(self.repartiteur.charger_tache(client, noeud, tache))
+
+            for noeud in noeuds:
+                with client.verrou:
+                    if noeud.tache_calcul is None:
+                        continue
+                    if not fini and alea.random() < proba_abandon:
+                        noeud.abandonner_tache()
+                    else:
+                        with self.verrou_termines:
+                            for valeurs in noeud.tache_calcul.configurations():
+                                self.termines.append((valeurs["X"].value, valeurs["Y"].value))
+                        noeud.terminer_tache()
+
+    def lancer_esclaves(self, proba_abandon):
+        esclaves = [threading.Thread(target=self.esclave, args=(i, proba_abandon))
+                    for i in range(self.NB_THREADS)]
+        for e in esclaves:
+            e.start()
+        for e in esclaves:
+            e.join(60)
+            self.assertFalse(e.is_alive())
+
+    def test_ni_doublon_ni_perte(self):
+        self.lancer_esclaves(0.)
+
+        self.assertEqual(set(self.termines), self.grille)
+        # every allocation was completed: the only tasks computed twice are the
+        # cannibalized ones
+        self.assertEqual(len(self.termines),
+                         len(self.grille) + self.repartiteur.nb_cannibalisations)
+        self.assertEqual(len(self.repartiteur.baux), 0)
+
+    def test_abandons(self):
+        self.lancer_esclaves(0.2)
+
+        self.assertEqual(set(self.termines), self.grille)
+        self.assertEqual(len(self.repartiteur.taches_a_redistribuer), 0)
+        self.assertEqual(len(self.repartiteur.baux), 0)
+
+    def test_session_fermee(self):
+        # a task obtained just before the session of the slave server is closed is handed
+        # out again, instead of being leased to a node nobody will ever hear of
+        for fermer in (lambda client: client.deconnecter(),
+                       lambda client: self.repartiteur.expirer_sessions(-10)):
+            client = self.repartiteur.ouvrir_session("esclave")
+            noeud = client.recuperer_noeud(client.ajouter_noeud())
+            tache = self.repartiteur.obtenir_tache()
+            while tache is A_REESSAYER:
+                tache = self.repartiteur.obtenir_tache()
+            fermer(client)
+
+            self.assertFalse(self.repartiteur.charger_tache(client, noeud, tache))
+            self.assertIsNone(noeud.tache_calcul)
+            self.assertEqual(len(self.repartiteur.baux), 0)
+            self.assertEqual(self.repartiteur.taches_a_redistribuer, [tache])
+            self.assertEqual(self.repartiteur.obtenir_tache(), tache)
+            autre = self.repartiteur.ouvrir_session("autre")
+            noeud = autre.recuperer_noeud(autre.ajouter_noeud())
+            self.assertTrue(self.repartiteur.charger_tache(autre, noeud, tache))
+            noeud.terminer_tache()
+
+    def test_deja_calcules(self):
+        # the records already in the database (eg before a restart) are not handed out
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+        deja = sorted(self.grille)[::7]
+        bdd = BDDMemoire([{"X": x, "Y": y} for x, y in deja])
+        projet = self.repartiteur.projet
+        projet.sequenceur.reset()
+        self.repartiteur = Repartiteur(projet, bdd, taille_file_taches=64)
+        self.repartiteur.demarrer()
+
+        self.lancer_esclaves(0.)
+
+        self.assertEqual(set(self.termines), self.grille - set(deja))
+
+    def test_reprise(self):
+        # a dispatcher restored from a checkpoint taken mid-level hands out every point that
+        # wasn't computed, and only them
+        client = self.repartiteur.ouvrir_session("avant")
+        noeuds = [client.recuperer_noeud(client.ajouter_noeud()) for i in range(self.NB_NOEUDS)]
+        calcules = []
+        for tour in range(100):
+            for noeud in noeuds:
+                tache = self.repartiteur.obtenir_tache()
+                while tache is A_REESSAYER:
+                    tache = self.repartiteur.obtenir_tache()
+                self.assertTrue(self.repartiteur.charger_tache(client, noeud, tache))
+            if tour == 99:
+                # the checkpoint is taken with leased tasks and tasks to hand out again
+                noeuds[0].abandonner_tache()
+                noeuds[1].abandonner_tache()
+                break
+            for noeud in noeuds:
+                if tour % 3 == 0 and noeud is noeuds[3]:
+                    noeud.abandonner_tache()
+                    continue
+                for valeurs in noeud.tache_calcul.configurations():
+                    calcules.append({"X": valeurs["X"].value, "Y": valeurs["Y"].value})
+                noeud.terminer_tache()
+        self.assertEqual(len(self.repartiteur.taches_a_redistribuer), 2)
+
+        with tempfile.TemporaryDirectory() as dossier:
+            fichier = os.path.join(dossier, "reprise.json")
+            ecrire_point_reprise(fichier, self.repartiteur.etat_reprise())
+            etat = lire_point_reprise(fichier)
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+
+        # the server restarts: the nodes and their tasks are lost
+        projet = self.repartiteur.projet
+        projet.sequenceur = Sequenceur(projet.schema_entree, projet.sequenceur.schema_compteurs)
+        self.repartiteur = Repartiteur(projet, BDDReprise(calcules), taille_file_taches=64)
+        self.repartiteur.restaurer(etat)
+        self.assertLess(projet.sequenceur.nb_iters_realisees, len(self.grille))
+        self.repartiteur.demarrer()
+
+        self.lancer_esclaves(0.)
+
+        self.termines += [(c["X"], c["Y"]) for c in calcules]
+        self.assertEqual(set(self.termines), self.grille)
+        self.assertEqual(len(self.termines),
+                         len(self.grille) + self.repartiteur.nb_cannibalisations)
+
+    def test_compteurs(self):
+        # the lazy counters take the same values as numpy.linspace, and the points already
+        # computed are found on their axes as well
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+        deja = sorted(self.grille)[::7]
+        projet = self.repartiteur.projet
+        projet.sequenceur = Sequenceur(projet.schema_entree,
+                                       {"X": (0, 1, self.COTE, CompteurRange),
+                                        "Y": (0, 1, self.COTE, CompteurRange)})
+        self.repartiteur = Repartiteur(projet, BDDMemoire([{"X": x, "Y": y} for x, y in deja]),
+                                       taille_file_taches=64)
+        self.repartiteur.demarrer()
+
+        self.lancer_esclaves(0.)
+
+        self.assertEqual(set(self.termines), self.grille - set(deja))
+
+    def test_ordres(self):
+        # whatever the traversal order, each point of the grid is computed
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+        projet = self.repartiteur.projet
+        for ordre in [OrdreInverse(), OrdreHalton(), OrdreAleatoire(1), OrdreProgressif()]:
+            with self.subTest(ordre=type(ordre).__name__):
+                projet.sequenceur = Sequenceur(projet.schema_entree,
+                                               projet.sequenceur.schema_compteurs, ordre)
+                self.repartiteur = Repartiteur(projet, BDDMemoire(), taille_file_taches=64)
+                self.repartiteur.demarrer()
+                self.termines = []
+
+                self.lancer_esclaves(0.1)
+
+                self.assertEqual(set(self.termines), self.grille)
+                self.repartiteur.arreter()
+
+    def test_grilles(self):
+        # the tasks are sub-grids, handed out and cannibalized as a whole
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+        projet = self.repartiteur.projet
+        projet.sequenceur.reset()
+        self.repartiteur = Repartiteur(projet, BDDMemoire(), taille_file_taches=512,
+                                       taille_grille=100)
+        self.repartiteur.demarrer()
+
+        self.lancer_esclaves(0.2)
+
+        self.assertEqual(set(self.termines), self.grille)
+        self.assertEqual(len(self.repartiteur.taches_a_redistribuer), 0)
+        self.assertEqual(len(self.repartiteur.baux), 0)
+
+    def test_densification(self):
+        # the tasks of the first level are the grid, the next level is made of two boxes
+        # of 3x3 points (facteur_amplification is 1)
+        self.repartiteur.arreter()
+        self.repartiteur.producteur.join()
+        projet = self.repartiteur.projet
+        projet.nb_densifications = 1
+        projet.schema_densification = {"X": csc_float, "Y": csc_float}
+        projet.sequenceur = Sequenceur(projet.schema_entree, {"X": (0, 1, 3, np.linspace),
+                                                              "Y": (0, 1, 3, np.linspace)})
+        bdd = BDDBoites([{"X": (0, 2, 3), "Y": (0, 2, 3)},
+                         {"X": (0, 4, 5), "Y": (0, 4, 5)}])
+        self.repartiteur = Repartiteur(projet, bdd, taille_file_taches=4)
+        self.repartiteur.demarrer()
+
+        self.lancer_esclaves(0.1)
+
+        attendus = set()
+        for bornes in [(0, 1), (2, 3), (4, 5)]:
+            for x in np.linspace(*bornes, 3):
+                for y in np.linspace(*bornes, 3):
+                    attendus.add((csc_float(x).value, csc_float(y).value))
+        self.assertEqual(set(self.termines), attendus)
+        self.assertEqual(bdd.nb_densifications, 1)
+        self.assertTrue(projet.execution_terminee)
+
+    def tearDown(self):
+        self.repartiteur.arreter()
+
+
+class TestSequenceur(unittest.TestCase):
+    """Checks the ways of reading the sequence against its enumeration by suivant()"""
+
+    SCHEMA = {"X": csc_float, "N": csc_uint32, "Y": csc_float}
+    COMPTEURS = {"X": (0, 1, 5, np.linspace), "N": (2, 14, 4, np.linspace),
+                 "Y": (-1, 1, 3, CompteurRange)}
+    ORDRES = [None, OrdreInverse(), OrdreHalton(), OrdreAleatoire(3), OrdreProgressif()]
+
+    def enumerer(self, ordre, compteurs=None):
+        sequenceur = Sequenceur(self.SCHEMA, compteurs or self.COMPTEURS, ordre)
+        configurations = []
+        configuration = sequenceur.suivant()
+        while configuration is not None:
+            configurations.append(self.valeurs(configuration))
+            configuration = sequenceur.suivant()
+        self.assertEqual(len(configurations), sequenceur.nb_iters_total)
+        return configurations
+
+    def valeurs(self, configuration):
+        return tuple([configuration[nom].value for nom in self.SCHEMA])
+
+    def test_configuration_a(self):
+        for ordre in self.ORDRES:
+            with self.subTest(ordre=type(ordre).__name__):
+                configurations = self.enumerer(ordre)
+                sequenceur = Sequenceur(self.SCHEMA, self.COMPTEURS, ordre)
+                for k, configuration in enumerate(configurations):
+                    self.assertEqual(self.valeurs(sequenceur.configuration_a(k)), configuration)
+                with self.assertRaises(IndexError):
+                    sequenceur.configuration_a(len(configurations))
+                # the counter didn't move
+                self.assertEqual(self.valeurs(sequenceur.suivant()), configurations[0])
+
+    def test_aller_a(self):
+        for ordre in self.ORDRES:
+            with self.subTest(ordre=type(ordre).__name__):
+                configurations = self.enumerer(ordre)
+                sequenceur = Sequenceur(self.SCHEMA, self.COMPTEURS, ordre)
+                for k in list(range(len(configurations))) + [7, 0, 59, 13]:
+                    sequenceur.aller_a(k)
+                    self.assertEqual(self.valeurs(sequenceur.suivant()), configurations[k])
+                    self.assertEqual(sequenceur.nb_iters_realisees, k + 1)
+                    if k + 1 < len(configurations):
+                        self.assertEqual(self.valeurs(sequenceur.suivant()),
+                                         configurations[k + 1])
+                sequenceur.aller_a(len(configurations))
+                self.assertIsNone(sequenceur.suivant())
+                # the sequence can be read again once over
+                sequenceur.aller_a(1)
+                self.assertEqual(self.valeurs(sequenceur.suivant()), configurations[1])
+
+    def test_suivant_bloc(self):
+        for ordre in self.ORDRES:
+            for n in (1, 7, 60, 100):
+                with self.subTest(ordre=type(ordre).__name__, n=n):
+                    configurations = self.enumerer(ordre)
+                    sequenceur = Sequenceur(self.SCHEMA, self.COMPTEURS, ordre)
+                    lues = []
+                    bloc = sequenceur.suivant_bloc(n)
+                    while bloc is not None:
+                        self.assertLessEqual(len(bloc), n)
+                        lues.extend([tuple([ligne[nom].item() for nom in self.SCHEMA])
+                                     for ligne in bloc])
+                        # suivant() and suivant_bloc() can be used in turns
+                        configuration = sequenceur.suivant()
+                        if configuration is not None:
+                            lues.append(self.valeurs(configuration))
+                        bloc = sequenceur.suivant_bloc(n)
+                    self.assertEqual(lues, configurations)
+                    self.assertEqual(sequenceur.nb_iters_realisees, len(configurations))
+
+    def test_compteur_log(self):
+        # the counter takes the values of numpy.geomspace, up to the rounding, and its ends
+        # exactly
+        compteur = CompteurLogRange(0.01, 100, 9)
+        plage = np.geomspace(0.01, 100, 9)
+        self.assertEqual(len(compteur), 9)
+        self.assertEqual(compteur[0], 0.01)
+        self.assertEqual(compteur[8], 100.)
+        self.assertEqual(compteur[-1], 100.)
+        for i in range(9):
+            self.assertAlmostEqual(compteur[i] / plage[i], 1., places=12)
+        np.testing.assert_allclose(compteur[2:7:2], plage[2:7:2], rtol=1e-12)
+        np.testing.assert_allclose(compteur[np.array([8, 0, 3])], plage[[8, 0, 3]], rtol=1e-12)
+        np.testing.assert_allclose(list(compteur), plage, rtol=1e-12)
+        with self.assertRaises(IndexError):
+            compteur[9]
+        self.assertEqual(compteur.indice(csc_float(compteur[5]).value,
+                                         lambda v: csc_float(v).value), 5)
+
+        compteurs = dict(self.COMPTEURS, X=(0.01, 100, 9, CompteurLogRange))
+        configurations = self.enumerer(None, compteurs)
+        sequenceur = Sequenceur(self.SCHEMA, compteurs)
+        for k, configuration in enumerate(configurations):
+            self.assertEqual(self.valeurs(sequenceur.configuration_a(k)), configuration)
+        lues = []
+        bloc = sequenceur.suivant_bloc(7)
+        while bloc is not None:
+            lues.extend([tuple([ligne[nom].item() for nom in self.SCHEMA]) for ligne in bloc])
+            bloc = sequenceur.suivant_bloc(7)
+        self.assertEqual(lues, configurations)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,382 @@
+import csv
+import http.client
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from wsgiref.util import setup_testing_defaults
+
+import numpy as np
+from bottle import default_app
+
+import server
+from projet import ProjetCascada
+from seq import Sequenceur
+from serveur_async import ServeurAsync, appeler_wsgi
+from vartypes import csc_float
+
+
+def application(environ, start_response):
+    """A WSGI application answering /bonjour with a list, and /blocs with a generator"""
+
+    if environ['PATH_INFO'] == '/bonjour':
+        corps = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b"bonjour ", corps]
+
+    def blocs():
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        yield b"un,"
+        yield b""
+        yield b"deux"
+
+    return blocs()
+
+
+def port_libre() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestServeurAsync(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = port_libre()
+        serveur = ServeurAsync(application, '127.0.0.1', cls.port, nb_threads=2)
+        threading.Thread(target=serveur.lancer, daemon=True).start()
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', cls.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+    def setUp(self):
+        self.cnx = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+
+    def tearDown(self):
+        self.cnx.close()
+
+    def test_keepalive(self):
+        self.cnx.request('POST', '/bonjour', body=b"toi")
+        reponse = self.cnx.getresponse()
+        self.assertEqual(reponse.status, 200)
+        self.assertEqual(reponse.getheader('Content-Length'), '11')
+        self.assertEqual(reponse.getheader('Connection'), 'keep-alive')
+        self.assertEqual(reponse.read(), b"bonjour toi")
+        sock = self.cnx.sock
+
+        # the second request goes through the same connection
+        self.cnx.request('POST', '/bonjour', body=b"encore")
+        reponse = self.cnx.getresponse()
+        self.assertEqual(reponse.read(), b"bonjour encore")
+        self.assertIs(self.cnx.sock, sock)
+
+    def test_par_blocs(self):
+        for _ in range(2):
+            self.cnx.request('GET', '/blocs')
+            reponse = self.cnx.getresponse()
+            self.assertEqual(reponse.status, 200)
+            self.assertEqual(reponse.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(reponse.read(), b"un,deux")
+
+    def test_entete_trop_long(self):
+        # a line longer than the limit of the stream is answered, and not left unhandled
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as s:
+            s.sendall(b"GET /bonjour HTTP/1.1\r\nX-Long: " + b"a" * 2**17 + b"\r\n\r\n")
+            self.assertTrue(s.recv(1024).startswith(b"HTTP/1.1 431 "))
+
+
+class TestAPI(unittest.TestCase):
+    """Drives the API of the server in-process, on a project stored in SQLite"""
+
+    def setUp(self):
+        self.dossier = tempfile.TemporaryDirectory()
+        self.repertoire = os.getcwd()
+        os.chdir(self.dossier.name)
+        self.periode_faucheuse = server.periode_faucheuse
+        server.periode_faucheuse = 0.05
+        self.lancer()
+
+    def tearDown(self):
+        self.arreter()
+        server.periode_faucheuse = self.periode_faucheuse
+        server.taille_grille = None
+        os.chdir(self.repertoire)
+        self.dossier.cleanup()
+
+    def lancer(self, validateur=lambda x: True):
+        """Initializes the server on a 5x4 grid, and registers a slave server of 3 nodes"""
+
+        schema = {"X": csc_float, "Y": csc_float}
+        sequenceur = Sequenceur(schema, {"X": (0, 1, 5, np.linspace),
+                                         "Y": (0, 1, 4, np.linspace)})
+        projet = ProjetCascada("api", sequenceur, {"E": csc_float}, schema, "E", 0, 0.5, 1,
+                               "mdp", validateur_entree=validateur, moteur_bdd="sqlite")
+        server.init(projet)
+
+        self.token = self.appeler("/api/v1/register-master",
+                                  {"key": "mdp", "name": "esclave"})["master_token"]
+        self.noeuds = self.appeler("/api/v1/register-nodes",
+                                   {"mastertoken": self.token, "nodenumber": 3})["nodenames"]
+
+    def arreter(self):
+        server.arret_faucheuse.set()
+        server.arret_reprise.set()
+        server.repartiteur.arreter()
+        server.repartiteur.producteur.join()
+        server.maBDD.fermer()
+
+    def lancer_grilles(self):
+        """Starts the server again, the tasks being sub-grids of 10 points in which the points
+        X = 0.25 are invalid, as are the results whose E is negative"""
+
+        self.arreter()
+        server.taille_grille = 10
+        self.lancer(lambda c: c["X"].value != 0.25 and ("E" not in c or c["E"].value >= 0))
+
+    def requete(self, chemin, donnees=None, requete=""):
+        """Calls the application; POSTs donnees as JSON if they are given
+
+        Returns:
+            str: the status line
+            dict: the headers
+            bytes: the body
+        """
+
+        corps = b"" if donnees is None else json.dumps(donnees).encode("utf-8")
+        environ = {"REQUEST_METHOD": "GET" if donnees is None else "POST",
+                   "PATH_INFO": chemin, "QUERY_STRING": requete,
+                   "CONTENT_TYPE": "application/json", "CONTENT_LENGTH": str(len(corps)),
+                   "wsgi.input": io.BytesIO(corps)}
+        setup_testing_defaults(environ)
+        statut, entetes, corps = appeler_wsgi(default_app(), environ)
+        return statut, dict(entetes), b"".join(corps)
+
+    def appeler(self, chemin, donnees=None, requete=""):
+        """Calls the application and decodes its JSON answer"""
+        statut, entetes, corps = self.requete(chemin, donnees, requete)
+        self.assertEqual(statut, "200 OK")
+        return json.loads(corps)
+
+    def distribuer(self, **champs):
+        return self.appeler("/api/v1/fetch-work-batch", {"mastertoken": self.token, **champs})
+
+    def test_distribuer_lot(self):
+        rep = self.distribuer(nodeids=[self.noeuds[0], "inconnu", self.noeuds[1]])
+        self.assertEqual(rep["status"], "ok")
+        self.assertEqual(sorted(rep["tasks"]), sorted(self.noeuds[:2]))
+        self.assertNotEqual(rep["tasks"][self.noeuds[0]], rep["tasks"][self.noeuds[1]])
+        self.assertEqual(list(rep["errors"]), ["inconnu"])
+        self.assertEqual(rep["errors"]["inconnu"]["code"],
+                         server.erreursClient.VALEUR_INVALIDE.value)
+
+        # the nodes that already have a task are reported, and only the idle ones get one
+        rep = self.distribuer(nodeids=[self.noeuds[0]])
+        self.assertEqual(rep["tasks"], {})
+        self.assertEqual(rep["errors"][self.noeuds[0]]["code"],
+                         server.erreursClient.MAUVAIS_STATUT_NOEUD.value)
+        rep = self.distribuer(count=10)
+        self.assertEqual(list(rep["tasks"]), [self.noeuds[2]])
+
+        rep = self.distribuer(count="beaucoup")
+        self.assertEqual(rep["code"], server.erreursClient.VALEUR_INVALIDE.value)
+        rep = self.distribuer()
+        self.assertEqual(rep["code"], server.erreursClient.MANQUE_CHAMP_REQUETE.value)
+
+    def test_distribuer_lot_fin(self):
+        # once the sequence is over, the whole batch fails with the same error
+        taches = []
+        for i in range(10):
+            rep = self.distribuer(count=3)
+            if rep["status"] != "ok":
+                break
+            taches.extend(rep["tasks"].values())
+            self.appeler("/api/v1/submit-results-batch", {
+                "mastertoken": self.token,
+                "results": [{"nodeid": n, "payload": {**t, "E": 0}}
+                            for n, t in rep["tasks"].items()]})
+        # (the last tasks may be cannibalized)
+        self.assertEqual(len({(t["X"], t["Y"]) for t in taches}), 20)
+        self.assertEqual(rep["code"], server.erreursClient.PLUS_DE_TRAVAIL.value)
+        self.assertEqual(sorted(rep["errors"]), sorted(self.noeuds))
+
+    def test_soumettre_lot(self):
+        taches = self.distribuer(count=3)["tasks"]
+        n0, n1, n2 = self.noeuds
+        rep = self.appeler("/api/v1/submit-results-batch", {
+            "mastertoken": self.token,
+            "results": [{"nodeid": n0, "payload": {**taches[n0], "E": 1.5}},
+                        {"payload": {"E": 2}},
+                        {"nodeid": n1, "payload": {**taches[n1]}},
+                        {"nodeid": "inconnu", "payload": {"E": 3}},
+                        {"nodeid": n2, "payload": {**taches[n2], "E": 2.5}},
+                        {"nodeid": n2, "payload": {**taches[n2], "E": 3.5}}]})
+
+        # each item has its own status, in the order of the batch
+        self.assertEqual(rep["status"], "ok")
+        self.assertEqual(rep["msg"], "2/6 results successfully submitted")
+        erreurs = server.erreursClient
+        self.assertEqual([s["code"] for s in rep["statuses"]],
+                         [erreurs.PAS_ERREUR.value, erreurs.MANQUE_CHAMP_REQUETE.value,
+                          erreurs.MANQUE_VARIABLE_RESULTATS.value,
+                          erreurs.NOEUD_INEXISTANT.value, erreurs.PAS_ERREUR.value,
+                          erreurs.MAUVAIS_STATUT_NOEUD.value])
+        self.assertEqual([s.get("nodeid") for s in rep["statuses"]],
+                         [n0, None, n1, "inconnu", n2, n2])
+
+        # the accepted results are saved and their nodes are idle again; the task of the
+        # rejected ones is handed out again
+        server.maBDD.vider()
+        for n in (n0, n1, n2):
+            self.assertEqual(server.maBDD.existe({v: csc_float(taches[n][v]) for v in "XY"}),
+                             n != n1)
+        a_redistribuer = [t.versdict() for t in server.repartiteur.taches_a_redistribuer]
+        self.assertEqual(a_redistribuer, [{v: csc_float(taches[n1][v]) for v in "XY"}])
+        rep = self.distribuer(count=3)
+        self.assertEqual(sorted(rep["tasks"]), sorted(self.noeuds))
+        self.assertIn(taches[n1], rep["tasks"].values())
+
+        rep = self.appeler("/api/v1/submit-results-batch",
+                           {"mastertoken": self.token, "results": {}})
+        self.assertEqual(rep["code"], erreurs.VALEUR_INVALIDE.value)
+
+    def test_faucheuse(self):
+        rep = self.appeler("/api/v1/keepalive", {"mastertoken": self.token})
+        self.assertEqual(rep["code"], server.erreursClient.PAS_ERREUR.value)
+        client = server.repartiteur.recuperer_client(self.token)
+        self.assertGreaterEqual(client.dernier_keepalive, int(time.time()) - 1)
+        tache = self.distribuer(nodeids=[self.noeuds[0]])["tasks"][self.noeuds[0]]
+
+        # a slave server which isn't heard of any more is reaped, and the task of its nodes
+        # is handed out again
+        client.dernier_keepalive -= server.temps_max_keepalive + 10
+        limite = time.monotonic() + 5
+        while server.repartiteur.recuperer_client(self.token) is not None:
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.01)
+        rep = self.appeler("/api/v1/keepalive", {"mastertoken": self.token})
+        self.assertEqual(rep["code"], server.erreursClient.CLEF_MANQUANTE_DANS_TROUSSEAU.value)
+
+        token = self.appeler("/api/v1/register-master",
+                             {"key": "mdp", "name": "esclave"})["master_token"]
+        noeud = self.appeler("/api/v1/register-nodes",
+                             {"mastertoken": token, "nodenumber": 1})["nodenames"][0]
+        rep = self.appeler("/api/v1/fetch-work-batch", {"mastertoken": token, "count": 1})
+        self.assertEqual(rep["tasks"], {noeud: tache})
+
+    def test_exporter(self):
+        taches = self.distribuer(count=3)["tasks"]
+        self.appeler("/api/v1/submit-results-batch", {
+            "mastertoken": self.token,
+            "results": [{"nodeid": n, "payload": {**taches[n], "E": i}}
+                        for i, n in enumerate(self.noeuds)]})
+        attendus = [{**taches[n], "E": float(i), "niv_densification": 1}
+                    for i, n in reversed(list(enumerate(self.noeuds)))]
+
+        # the best records first
+        statut, entetes, corps = self.requete("/api/v1/results", requete="key=mdp")
+        self.assertEqual(entetes["Content-Type"], "application/x-ndjson")
+        self.assertEqual([json.loads(l) for l in corps.decode("utf-8").splitlines()], attendus)
+
+        statut, entetes, corps = self.requete("/api/v1/results",
+                                              requete="key=mdp&format=csv&niv_densification=1")
+        self.assertEqual(entetes["Content-Type"], "text/csv; charset=utf-8")
+        lignes = list(csv.DictReader(io.StringIO(corps.decode("utf-8"))))
+        self.assertEqual([{c: float(v) for c, v in l.items()} for l in lignes], attendus)
+        statut, entetes, corps = self.requete("/api/v1/results",
+                                              requete="key=mdp&format=csv&niv_densification=2")
+        self.assertEqual(corps, b"X,Y,E,niv_densification\r\n")
+
+        erreurs = server.erreursClient
+        self.assertEqual(self.appeler("/api/v1/results", requete="key=abc")["code"],
+                         erreurs.ECHEC_AUTH.value)
+        self.assertEqual(self.appeler("/api/v1/results", requete="key=mdp&format=xml")["code"],
+                         erreurs.VALEUR_INVALIDE.value)
+        self.assertEqual(
+            self.appeler("/api/v1/results", requete="key=mdp&niv_densification=a")["code"],
+            erreurs.VALEUR_INVALIDE.value)
+
+    def test_grilles(self):
+        self.lancer_grilles()
+        n0, n1, n2 = self.noeuds
+        taches = self.distribuer(count=3)["tasks"]
+        grille = taches[n0]["grid"]
+        self.assertEqual(grille["variables"], ["X", "Y"])
+        self.assertEqual(grille["values"], {"X": [0, 0.25, 0.5, 0.75, 1],
+                                            "Y": [0, float(np.float32(1 / 3))]})
+        self.assertEqual((grille["first"], grille["count"], grille["skip"]), (0, 10, [1, 6]))
+        self.assertEqual(taches[n1]["grid"]["first"], 10)
+
+        # the results of the skipped points are ignored; a list of the wrong length is
+        # rejected and the sub-grid is handed out again
+        points = [(x, y) for y in grille["values"]["Y"] for x in grille["values"]["X"]]
+        resultats = [None if i in grille["skip"] else {"E": i} for i in range(10)]
+        rep = self.appeler("/api/v1/submit-results-batch", {
+            "mastertoken": self.token,
+            "results": [{"nodeid": n0, "payload": {"results": resultats}},
+                        {"nodeid": n1, "payload": {"results": resultats[:9]}}]})
+        erreurs = server.erreursClient
+        self.assertEqual([s["code"] for s in rep["statuses"]],
+                         [erreurs.PAS_ERREUR.value, erreurs.VALEUR_INVALIDE.value])
+
+        server.maBDD.vider()
+        for i, (x, y) in enumerate(points):
+            self.assertEqual(server.maBDD.existe({"X": csc_float(x), "Y": csc_float(y)}),
+                             i not in grille["skip"])
+        self.assertEqual([t.versdict() for t in server.repartiteur.taches_a_redistribuer],
+                         [taches[n1]])
+        self.assertEqual(self.distribuer(nodeids=[n0])["tasks"], {n0: taches[n1]})
+
+    def test_grille_point_invalide(self):
+        self.lancer_grilles()
+        n0, n1, n2 = self.noeuds
+        taches = self.distribuer(nodeids=[n0, n1])["tasks"]
+
+        # once the sequence is over, the oldest sub-grid is cannibalized by the idle node
+        limite = time.monotonic() + 5
+        while n2 not in self.distribuer(nodeids=[n2])["tasks"]:
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.01)
+        noeud = server.repartiteur.recuperer_client(self.token).recuperer_noeud(n2)
+        tache = noeud.tache_calcul
+        self.assertEqual(tache.versdict(), taches[n0])
+
+        # a single rejected point rejects the whole sub-grid, which stays leased to the
+        # other node
+        grille = taches[n0]["grid"]
+        resultats = [None if i in grille["skip"] else {"E": 1} for i in range(10)]
+        resultats[7] = {"E": -1}
+        rep = self.appeler("/api/v1/submit-results-batch", {
+            "mastertoken": self.token,
+            "results": [{"nodeid": n0, "payload": {"results": resultats}}]})
+        statut = rep["statuses"][0]
+        self.assertEqual(statut["code"], server.erreursClient.ECHEC_VALIDATION.value)
+        self.assertIn("(point 7)", statut["msg"])
+
+        server.maBDD.vider()
+        self.assertFalse(server.maBDD.existe({"X": csc_float(0), "Y": csc_float(0)}))
+        self.assertEqual(noeud.statut, server.statutNoeud.ACTIF)
+        self.assertTrue(tache.bail_actif)
+        self.assertEqual(tache.nb_detenteurs, 1)
+        self.assertEqual(len(server.repartiteur.taches_a_redistribuer), 0)
+
+        # the other node's results are accepted
+        resultats[7] = {"E": 1}
+        rep = self.appeler("/api/v1/submit-results-batch", {
+            "mastertoken": self.token,
+            "results": [{"nodeid": n2, "payload": {"results": resultats}}]})
+        self.assertEqual(rep["statuses"][0]["code"], server.erreursClient.PAS_ERREUR.value)
+        server.maBDD.vider()
+        self.assertTrue(server.maBDD.existe({"X": csc_float(0), "Y": csc_float(0)}))
+        self.assertFalse(tache.bail_actif)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from db_sqlite import controlleurSQLite
+from journal import EcrivainJournal
+from voisins import IndexVoisins
+from vartypes import csc_float, csc_uint32
+
+
+SCHEMA = {"X": csc_float, "N": csc_uint32, "E": csc_float}
+SCHEMA_ENTREE = {"X": csc_float, "N": csc_uint32}
+
+
+class TestSQLite(unittest.TestCase):
+
+    def setUp(self):
+        self.dossier = tempfile.TemporaryDirectory()
+        self.fichier = os.path.join(self.dossier.name, "test.sqlite3")
+        self.bdd = controlleurSQLite("test", SCHEMA, SCHEMA_ENTREE, fichier=self.fichier)
+
+    def tearDown(self):
+        self.bdd.fermer()
+        self.dossier.cleanup()
+
+    def resultat(self, x, n, e):
+        return {"X": csc_float(x), "N": csc_uint32(n), "E": csc_float(e)}
+
+    def test_enregistrer(self):
+        self.bdd.enregistrer(self.resultat(0.5, 3, 1.5))
+        self.bdd.enregistrer_lot([self.resultat(1, 4, 2), self.resultat(2, 5, 3)])
+        self.bdd.vider()
+
+        self.assertTrue(self.bdd.existe({"X": csc_float(0.5), "N": csc_uint32(3)}))
+        self.assertTrue(self.bdd.existe({"X": csc_float(2), "N": csc_uint32(5)}))
+        self.assertFalse(self.bdd.existe({"X": csc_float(0.5), "N": csc_uint32(4)}))
+
+        lignes = [l for bloc in self.bdd.exporter("E") for l in bloc]
+        self.assertEqual(lignes, [(2., 5, 3., 1), (1., 4, 2., 1), (0.5, 3, 1.5, 1)])
+
+    def test_doublons(self):
+        # a record is unique for the input variables: the outputs of a task computed twice
+        # (eg a cannibalized one) don't add a second record
+        self.bdd.enregistrer(self.resultat(0.5, 3, 1.5))
+        self.bdd.enregistrer_lot([self.resultat(0.5, 3, 7), self.resultat(0.5, 3, 8)])
+        self.bdd.vider()
+
+        lignes = [l for bloc in self.bdd.exporter("E") for l in bloc]
+        self.assertEqual(lignes, [(0.5, 3, 1.5, 1)])
+
+    def test_enregistrements_dans(self):
+        self.bdd.enregistrer_lot([self.resultat(x / 4, n, x + n) for x in range(5)
+                                  for n in range(3)])
+
+        res = self.bdd.enregistrements_dans({"X": (0.25, 0.75), "N": (1, 2)})
+        self.assertEqual(sorted([(r["X"], r["N"]) for r in res]),
+                         [(x / 4, n) for x in range(1, 4) for n in (1, 2)])
+        # the bounds are included, and only the variables of the bounds are returned
+        res = self.bdd.enregistrements_dans({"X": (1, 1)})
+        self.assertEqual(sorted(res, key=lambda r: r["X"]), [{"X": 1.}] * 3)
+        self.assertEqual(self.bdd.enregistrements_dans({"X": (2, 3)}), [])
+        self.assertEqual(self.bdd.enregistrements_dans({}), [])
+
+    def test_fermer(self):
+        # the connections opened by the other threads are closed too
+        connexions = []
+        fil = threading.Thread(target=lambda: connexions.append(self.bdd.cnx))
+        fil.start()
+        fil.join()
+        self.bdd.fermer()
+        self.assertEqual(self.bdd.connexions, [])
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connexions[0].execute("SELECT 1")
+
+        # the file can be opened again, with the records it holds
+        self.bdd = controlleurSQLite("test", SCHEMA, SCHEMA_ENTREE, fichier=self.fichier)
+
+
+class TestDensification(unittest.TestCase):
+    """Checks the candidates of a densification level and the boxes drawn around them"""
+
+    ENTREE = {"X": csc_float, "N": csc_uint32}
+
+    def setUp(self):
+        self.dossier = tempfile.TemporaryDirectory()
+        self.fichier = os.path.join(self.dossier.name, "test.sqlite3")
+        self.bdd = self.ouvrir()
+
+        # a grid with holes, so that the lines of a variable differ with the other one; the
+        # best record is at a corner of the grid
+        alea = random.Random(4)
+        trous = {(1., 1), (2., 2), (0., 4), (3., 4), (0.5, 0)}
+        points = [(x, n) for x in (0., 0.5, 1., 2., 3.) for n in (0, 1, 2, 4)
+                  if (x, n) not in trous]
+        energies = alea.sample(range(len(points)), len(points))
+        self.enregistrements = [{"X": x, "N": n,
+                                 "E": float(len(points) if (x, n) == (3., 0) else e)}
+                                for (x, n), e in zip(points, energies)]
+        # (the best ones first)
+        self.enregistrements.sort(key=lambda e: -e["E"])
+        self.bdd.enregistrer_lot([{n: t(e[n]) for n, t in SCHEMA.items()}
+                                  for e in self.enregistrements])
+
+    def tearDown(self):
+        self.bdd.fermer()
+        self.dossier.cleanup()
+
+    def ouvrir(self):
+        return controlleurSQLite("test", SCHEMA, SCHEMA_ENTREE, fichier=self.fichier)
+
+    def centre(self, boite):
+        return {n: b[0] for n, b in boite.items()}
+
+    def tirer(self):
+        """Draws the boxes until the end of the level"""
+        boites = []
+        boite = self.bdd.schema_suivant(self.ENTREE)
+        while boite is not None:
+            boites.append(boite)
+            boite = self.bdd.schema_suivant(self.ENTREE)
+        self.assertFalse(self.bdd.densification_en_cours())
+        return boites
+
+    def test_candidats(self):
+        # the best records of the level are drawn in order, the offset moving forward
+        self.bdd.densifier(0.5, "E")
+        limite = int(math.ceil(0.5 * len(self.enregistrements)))
+        self.assertEqual(self.bdd.limite_select, limite)
+        self.assertEqual(self.bdd.niveau_densification, 2)
+        for rang in range(limite):
+            self.assertTrue(self.bdd.densification_en_cours())
+            boite = self.bdd.schema_suivant(self.ENTREE)
+            self.assertEqual(self.centre(boite),
+                             {n: self.enregistrements[rang][n] for n in self.ENTREE})
+            self.assertEqual(self.bdd.offset_cour_densification, rang + 1)
+
+        # until every candidate was drawn
+        self.assertFalse(self.bdd.densification_en_cours())
+        self.assertIsNone(self.bdd.schema_suivant(self.ENTREE))
+
+        # the candidates can be drawn from an offset
+        self.bdd.niveau_densification = 1
+        self.bdd.densifier(0.5, "E", offset=3)
+        self.assertEqual([self.centre(b) for b in self.tirer()],
+                         [{n: e[n] for n in self.ENTREE}
+                          for e in self.enregistrements[3:limite]])
+
+    def voisins(self, enregistrements, candidat, noms):
+        """Finds the box of a candidate by brute force"""
+
+        boite = {}
+        for nom in noms:
+            centre = candidat[nom]
+            ligne = [e[nom] for e in enregistrements
+                     if all(e[a] == candidat[a] for a in noms if a != nom)]
+            boite[nom] = (centre, max([v for v in ligne if v < centre], default=centre),
+                          min([v for v in ligne if v > centre], default=centre))
+        return boite
+
+    def test_voisins(self):
+        # every record of the level is a candidate
+        self.bdd.densifier(1., "E")
+        boites = self.tirer()
+        self.assertEqual(len(boites), len(self.enregistrements))
+        for boite, candidat in zip(boites, self.enregistrements):
+            self.assertEqual(boite, self.voisins(self.enregistrements, candidat, self.ENTREE))
+
+        # the best record has no upper neighbor along X and no lower one along N
+        self.assertEqual(boites[0], {"X": (3., 2., 3.), "N": (0, 0, 1)})
+        # the neighbors along a variable depend on the line of the other one (see the holes)
+        centres = [self.centre(b) for b in boites]
+        self.assertEqual(boites[centres.index({"X": 2., "N": 1})]["X"], (2., 0.5, 3.))
+        self.assertEqual(boites[centres.index({"X": 1., "N": 2})]["N"], (2, 0, 4))
+        self.assertEqual(boites[centres.index({"X": 2., "N": 4})]["X"], (2., 1., 2.))
+        self.assertEqual(boites[centres.index({"X": 1., "N": 0})]["X"], (1., 0., 2.))
+
+    def test_index_voisins(self):
+        # with three variables, the lines of a variable are set by the two other ones
+        alea = random.Random(7)
+        enregistrements = [{"A": a, "B": b, "C": c} for a in range(6) for b in (0, 2, 5)
+                           for c in (-1., 0.5, 3.) if alea.random() < 0.6]
+        index = IndexVoisins(enregistrements, ["A", "B", "C"])
+        for noms in (["A", "B", "C"], ["C", "A"], ["B"]):
+            with self.subTest(noms=noms):
+                candidats = alea.sample(enregistrements, 10) + [{"A": 9, "B": 2, "C": 0.5}]
+                # (the records are projected on the variables of noms)
+                projetes = [{n: e[n] for n in noms} for e in enregistrements]
+                self.assertEqual(index.bornes(candidats, noms),
+                                 [self.voisins(projetes, c, noms) for c in candidats])
+        self.assertEqual(IndexVoisins([], ["A"]).bornes([{"A": 1}], ["A"]), [{"A": (1, 1, 1)}])
+
+    def test_reprise(self):
+        # the densification state restored from a checkpoint taken in the middle of a level
+        # draws the candidates that weren't drawn yet
+        limite = int(math.ceil(0.8 * len(self.enregistrements)))
+        for offset, nb_tires in [(0, 0), (0, 1), (0, 5), (0, limite), (2, 1), (2, 4)]:
+            with self.subTest(offset=offset, nb_tires=nb_tires):
+                self.bdd.niveau_densification = 1
+                self.bdd.densifier(0.8, "E", offset)
+                boites = self.tirer()
+                self.assertEqual(len(boites), limite - offset)
+
+                self.bdd.niveau_densification = 1
+                self.bdd.densifier(0.8, "E", offset)
+                for i in range(nb_tires):
+                    self.bdd.schema_suivant(self.ENTREE)
+                etat = self.bdd.etat_densification()
+                self.bdd.fermer()
+
+                self.bdd = self.ouvrir()
+                self.bdd.restaurer_densification(etat)
+                self.assertEqual(self.bdd.niveau_densification, 2)
+                self.assertEqual(self.bdd.densification_en_cours(), nb_tires < len(boites))
+                self.assertEqual(self.tirer(), boites[nb_tires:])
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dossier = tempfile.TemporaryDirectory()
+        self.fichier = os.path.join(self.dossier.name, "journal.log")
+        self.ecrits = []
+
+    def tearDown(self):
+        self.dossier.cleanup()
+
+    def ouvrir(self):
+        return EcrivainJournal(self.ecrits.extend, self.fichier, list, tuple, taille_lot=7,
+                               delai_max=0.01)
+
+    def test_reprise(self):
+        # the rows written in the database are not written again after a restart
+        ecrivain = self.ouvrir()
+        ecrivain.start()
+        ecrivain.ajouter_lot([(i, i / 2) for i in range(10)])
+        ecrivain.vider()
+        ecrivain.arreter()
+        self.assertEqual(self.ecrits, [(i, i / 2) for i in range(10)])
+
+        # the rows logged but not written yet when the server crashes...
+        self.ecrits = []
+        ecrivain = self.ouvrir()
+        ecrivain.ajouter_lot([(i, i / 2) for i in range(10, 30)])
+        ecrivain.ajouter((30, 15.))
+        ecrivain.flux.close()
+        ecrivain.lecteur.close()
+        # ... as well as a row interrupted by the crash
+        with open(self.fichier, "ab") as f:
+            f.write(b"[31, 1")
+
+        # are written once restarted, and only them
+        ecrivain = self.ouvrir()
+        ecrivain.start()
+        ecrivain.vider()
+        ecrivain.arreter()
+        self.assertEqual(self.ecrits, [(i, i / 2) for i in range(10, 31)])
+        with open(self.fichier, "rb") as f:
+            self.assertTrue(f.read().endswith(b"[30, 15.0]\n"))
+
+    def test_ligne_longue_interrompue(self):
+        # the row interrupted by the crash is dropped whatever its length
+        ecrivain = self.ouvrir()
+        ecrivain.ajouter_lot([(i, "a" * 1000) for i in range(100)])
+        ecrivain.flux.close()
+        ecrivain.lecteur.close()
+        with open(self.fichier, "ab") as f:
+            f.write(b'[100, "' + b"b" * 3 * 2**16)
+
+        ecrivain = self.ouvrir()
+        ecrivain.start()
+        ecrivain.ajouter((101, "c"))
+        ecrivain.vider()
+        ecrivain.arreter()
+        self.assertEqual(self.ecrits, [(i, "a" * 1000) for i in range(100)] + [(101, "c")])
+
+        # even if it is the only row of the log
+        os.remove(self.fichier + ".offset")
+        with open(self.fichier, "wb") as f:
+            f.write(b'[102, "' + b"d" * 3 * 2**16)
+        self.ecrits = []
+        ecrivain = self.ouvrir()
+        ecrivain.start()
+        ecrivain.ajouter((103, "e"))
+        ecrivain.vider()
+        ecrivain.arreter()
+        self.assertEqual(self.ecrits, [(103, "e")])
+
+
+if __name__ == '__main__':
+    unittest.main()
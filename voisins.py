@@ -0,0 +1,106 @@
+"""Defines the neighbor index, which finds the closest neighbors of the densification
+candidates amongst the records of their level, without asking the database"""
+
+from numbers import Number
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+
+class IndexVoisins():
+    """The input coordinates of the records of a densification level, kept in memory.
+
+    For a variable, an "axis line" is the set of records sharing the values of the other
+    variables: the closest neighbors of a candidate along that variable are the values
+    surrounding its own on its line. Each line is kept as a sorted array of unique values, so
+    that the neighbors are found with a binary search (numpy.searchsorted).
+
+    The lines of a variable are built the first time they are needed, then kept for the
+    rest of the level."""
+
+    def __init__(self, enregistrements: Iterable[Dict[str, Number]], noms: Iterable[str]):
+        """Builds the index from the records of a level
+
+        Params:
+            enregistrements: the records of the level, as dictionnaries holding (at least)
+                             the variables of noms
+            noms: the variables that can be used by the queries
+        """
+
+        enregistrements = list(enregistrements)
+        self.colonnes = {n: np.array([e[n] for e in enregistrements]) for n in noms}
+        self.nb_enregistrements = len(enregistrements)
+        self.lignes = {}    # {(variable, other variables): {values of the others: values}}
+
+    def _lignes(self, nom: str, autres: Tuple[str, ...]) -> Dict[Tuple, np.ndarray]:
+        """Returns the lines of the variable nom, the other variables being autres"""
+
+        cle = (nom, autres)
+        lignes = self.lignes.get(cle)
+        if lignes is not None:
+            return lignes
+
+        valeurs = self.colonnes[nom]
+        if len(autres) == 0:
+            lignes = {(): np.unique(valeurs)}
+            self.lignes[cle] = lignes
+            return lignes
+
+        # sorting by the other variables, then by the variable: each line is then a
+        # contiguous, sorted block (numpy.lexsort uses its last key as the primary one)
+        ordre = np.lexsort([valeurs] + [self.colonnes[a] for a in reversed(autres)])
+        valeurs = valeurs[ordre]
+        autres_tries = [self.colonnes[a][ordre] for a in autres]
+
+        change = np.zeros(len(valeurs), dtype=bool)
+        if len(valeurs) > 0:
+            change[0] = True
+        for col in autres_tries:
+            change[1:] |= col[1:] != col[:-1]
+        debuts = np.flatnonzero(change)
+        fins = np.append(debuts[1:], len(valeurs))
+
+        lignes = {}
+        for debut, fin in zip(debuts, fins):
+            ligne = tuple(col[debut].item() for col in autres_tries)
+            lignes[ligne] = np.unique(valeurs[debut:fin])
+        self.lignes[cle] = lignes
+        return lignes
+
+    def bornes(self, candidats: List[Dict[str, Number]],
+               noms: List[str]) -> List[Dict[str, Tuple[Number, Number, Number]]]:
+        """Finds the closest neighbors of candidates, each variable of noms being searched on
+        the line set by the other ones
+
+        Params:
+            candidats: the candidates, as dictionnaries holding the variables of noms
+            noms: the variables to search the neighbors of
+
+        Returns:
+            list: for each candidate, {'<var name>': (<center value>, <inferior neighbor>,
+                  <superior neighbor>)}; a missing neighbor is replaced by the center value
+        """
+
+        resultats = [{} for c in candidats]
+        vide = np.array([])
+
+        for nom in noms:
+            autres = tuple(a for a in noms if a != nom)
+            lignes = self._lignes(nom, autres)
+
+            # the candidates on the same line are bounded at once
+            groupes = {}
+            for i, c in enumerate(candidats):
+                groupes.setdefault(tuple(c[a] for a in autres), []).append(i)
+
+            for ligne, indices in groupes.items():
+                valeurs = lignes.get(ligne, vide)
+                centres = [candidats[i][nom] for i in indices]
+                infs = np.searchsorted(valeurs, centres, side="left")
+                sups = np.searchsorted(valeurs, centres, side="right")
+                for i, centre, k_inf, k_sup in zip(indices, centres, infs, sups):
+                    inf = valeurs[k_inf - 1].item() if k_inf > 0 else centre
+                    sup = valeurs[k_sup].item() if k_sup < len(valeurs) else centre
+                    resultats[i][nom] = (centre, inf, sup)
+
+        return resultats